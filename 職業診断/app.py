@@ -1,532 +1,2786 @@
-import streamlit as st
-import google.generativeai as genai
-import time
-import base64
-import os
-import plotly.graph_objects as go
-import json
-import re  # 正規表現用
-
-# ==========================================
-# 🔧 設定エリア
-# ==========================================
-TEST_MODE = False 
-# 有効なモデルIDリスト
-MODELS_TO_TRY = ["gemini-2.5-flash", "gemini-3.0-flash", "gemini-2.5-pro"]
-MAX_TURN_COUNT = 3
-
-# ==========================================
-
-# --- ページ設定 ---
-st.set_page_config(
-    page_title="FORTUNE CAREER",
-    page_icon="🔮",
-    layout="wide",
-    initial_sidebar_state="collapsed"
-)
-
-# 背景画像のWeb URL
-URL_BG_MANSION = 'https://images.unsplash.com/photo-1560183441-6333262aa22c?q=80&w=2070&auto=format&fit=crop'
-URL_BG_ROOM = 'https://images.unsplash.com/photo-1519074069444-1ba4fff66d16?q=80&w=2070&auto=format&fit=crop'
-
-# 質問データ
-QUESTIONS = [
-    {"id": "q1", "q": "I. 魂の渇望 - 将来、仕事を通じて得たいものは？", "options": {"💰 高い年収と社会的地位（成功・野心）": "fire", "🧠 専門スキルと知的好奇心（成長・探究）": "water", "🤝 仲間からの感謝と安心感（貢献・安定）": "wind"}},
-    {"id": "q2", "q": "II. 魔力の源泉 - グループワークや部活での役割は？", "options": {"🔥 皆を引っ張るリーダー・部長タイプ": "fire", "💧 計画を立てる参謀・書記タイプ": "water", "🌿 間を取り持つ調整役・ムードメーカー": "wind"}},
-    {"id": "q3", "q": "III. 冒険の指針 - 全く新しい課題が出たらどうする？", "options": {"⚔️ 「とりあえずやってみよう」と手を動かす": "fire", "🗺️ 「まずは情報を集めよう」と教科書を開く": "water", "🛡️ 「みんなはどう思う？」と友達と相談する": "wind"}},
-    {"id": "q4", "q": "IV. 求める秘宝 - 居心地が良いと感じる環境は？", "options": {"👑 実力主義で、成果を出せば評価される場所": "fire", "📜 静かで、自分の研究や作業に没頭できる場所": "water", "🕊️ アットホームで、先輩後輩が仲良い場所": "wind"}},
-    {"id": "q5", "q": "V. 試練の刻 - バイトや部活でトラブル発生！どう動く？", "options": {"⚡️ 自分が先頭に立って、その場で解決する": "fire", "🔍 なぜ起きたか原因を分析し、再発を防ぐ": "water", "📣 周りの人に状況を伝え、協力を仰ぐ": "wind"}},
-    {"id": "q6", "q": "VI. 交信の作法 - プレゼンや発表で意識することは？", "options": {"🔥 「情熱」や「想い」を熱く伝える": "fire", "💧 「データ」や「論理」を正確に伝える": "water", "🌿 「聞き手」が楽しんでいるかを気にする": "wind"}},
-    {"id": "q7", "q": "VII. 失敗の代償 - テストや試合で負けた時、どう思う？", "options": {"🔥 「次は絶対勝つ！」と闘志を燃やす": "fire", "💧 「敗因は何か？」と冷静に分析する": "water", "🌿 「チームに申し訳ない」と責任を感じる": "wind"}},
-    {"id": "q8", "q": "VIII. 究極スキル - 今、大学生活で身につけたい力は？", "options": {"🔥 人を巻き込み、何かを成し遂げる「行動力」": "fire", "💧 物事の本質を見抜き、解決する「思考力」": "water", "🌿 誰とでも信頼関係を築ける「対人力」": "wind"}},
-    {"id": "q9", "q": "IX. 安息の地 - 休日の理想的な過ごし方は？", "options": {"🔥 イベントや旅行など、アクティブに動く": "fire", "💧 読書、映画、ゲームなど、知識を深める": "water", "🌿 友達や恋人とカフェでのんびり話す": "wind"}},
-    {"id": "q10", "q": "X. 伝説の終わり - 卒業時、周りからどう言われたい？", "options": {"🔥 「あいつは凄かった、伝説だ」": "fire", "💧 「あいつがいれば何でも解決した」": "water", "🌿 「あいつがいてくれて本当に楽しかった」": "wind"}},
-]
-
-# --- ヘルパー関数 ---
-def get_api_key():
-    if "GEMINI_API_KEY" in st.secrets:
-        return st.secrets["GEMINI_API_KEY"]
-    with st.sidebar:
-        val = st.text_input("Gemini API Key", type="password")
-        if val: return val
-    return None
-
-@st.cache_data
-def get_base64_of_bin_file(bin_file):
-    try:
-        if os.path.exists(bin_file):
-            with open(bin_file, 'rb') as f:
-                data = f.read()
-            return base64.b64encode(data).decode()
-        
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        file_path = os.path.join(script_dir, bin_file)
-        if os.path.exists(file_path):
-            with open(file_path, 'rb') as f:
-                data = f.read()
-            return base64.b64encode(data).decode()
-    except Exception:
-        return None
-    return None
-
-def apply_custom_css(bg_url):
-    st.markdown(f"""
-    <style>
-        @import url('https://fonts.googleapis.com/css2?family=Cinzel:wght@700&family=Shippori+Mincho+B1:wght@400;700;900&display=swap');
-        
-        html, body, [class*="st-"] {{
-            font-family: 'Shippori Mincho B1', serif !important;
-            color: #E0E0E0 !important;
-            font-size: 1.05rem !important; 
-        }}
-
-        [data-testid="stAppViewContainer"] {{
-            background-image: {bg_url} !important;
-            background-size: cover !important;
-            background-position: center center !important;
-            background-repeat: no-repeat !important;
-            background-attachment: fixed !important;
-        }}
-        [data-testid="stAppViewContainer"]::before {{
-            content: ""; position: fixed; top: 0; left: 0; width: 100%; height: 100%;
-            background: rgba(0, 0, 0, 0.5); z-index: -1; pointer-events: none;
-        }}
-
-        /* ▼▼▼ 追加：Manage app等の非表示設定 ▼▼▼ */
-        [data-testid="stHeader"] {{
-            display: none !important;
-            visibility: hidden !important;
-        }}
-        [data-testid="stToolbar"] {{
-            display: none !important;
-            visibility: hidden !important;
-        }}
-        .stAppDeployButton, [data-testid="stManageApp"] {{
-            display: none !important;
-            visibility: hidden !important;
-        }}
-        footer {{
-            display: none !important;
-            visibility: hidden !important;
-        }}
-        [data-testid="stDecoration"] {{
-            display: none !important;
-            visibility: hidden !important;
-        }}
-        /* ▲▲▲ ここまで ▲▲▲ */
-
-        .main-title {{
-            font-family: 'Cinzel', serif !important;
-            color: #FFD700 !important;
-            text-shadow: 0 0 10px #FFD700, 0 0 20px #000;
-            font-size: 3.5rem !important;
-            text-align: center;
-            margin-top: 20px !important;
-        }}
-
-        .intro-box {{
-            background: rgba(0, 0, 0, 0.85);
-            border: 2px solid #FFD700;
-            border-radius: 15px;
-            padding: 30px;
-            text-align: center;
-            font-size: 1.2rem; 
-            line-height: 2;
-            box-shadow: 0 0 30px rgba(0,0,0,0.8);
-        }}
-
-        h3 {{
-            font-size: 1.6rem !important;
-            color: #FFD700 !important;
-            text-shadow: 2px 2px 4px #000;
-            margin-bottom: 20px !important;
-        }}
-
-        div[role="radiogroup"] label {{
-            background-color: rgba(20, 20, 40, 0.9) !important;
-            border: 1px solid #FFD700 !important;
-            border-radius: 10px !important;
-            padding: 15px 20px !important;
-            margin-bottom: 10px !important;
-            color: white !important;
-            transition: all 0.2s ease-in-out;
-            box-shadow: 0 4px 6px rgba(0,0,0,0.5);
-        }}
-        div[role="radiogroup"] label:hover {{
-            background-color: rgba(60, 60, 80, 1.0) !important;
-            transform: translateX(5px);
-            box-shadow: 0 0 10px #FFD700;
-        }}
-        div[role="radiogroup"] label p {{
-            font-size: 1.25rem !important;
-            font-weight: bold !important; 
-            color: #FFFFFF !important;
-        }}
-
-        [data-testid="stBottom"] {{ background: transparent !important; }}
-        .stChatInput textarea {{
-            background-color: rgba(0, 0, 0, 0.8) !important;
-            color: #FFD700 !important;
-            border: 2px solid #FFD700 !important;
-            border-radius: 25px !important;
-            font-size: 1.1rem !important;
-        }}
-        div[data-testid="stChatMessage"] {{
-            background-color: rgba(20, 10, 30, 0.9) !important;
-            border: 1px solid rgba(255, 215, 0, 0.3) !important;
-            border-radius: 15px !important;
-        }}
-        div[data-testid="stChatMessage"] p {{
-            font-size: 1.1rem !important;
-            line-height: 1.6;
-        }}
-
-        /* ★ボタンデザイン */
-        @keyframes pulse-gold {{
-            0% {{ box-shadow: 0 0 0 0 rgba(255, 215, 0, 0.7); }}
-            70% {{ box-shadow: 0 0 0 15px rgba(255, 215, 0, 0); }}
-            100% {{ box-shadow: 0 0 0 0 rgba(255, 215, 0, 0); }}
-        }}
-
-        .stButton button, 
-        [data-testid="stFormSubmitButton"] button,
-        [data-testid="stDownloadButton"] button {{
-            width: 100% !important;
-            background: linear-gradient(45deg, #FFD700, #FDB931, #DAA520) !important;
-            color: #000000 !important;
-            font-weight: 900 !important;
-            border: 2px solid #8B6508 !important;
-            padding: 20px 30px !important;
-            border-radius: 50px !important;
-            font-family: 'Cinzel', serif !important;
-            font-size: 1.6rem !important;
-            text-shadow: none !important;
-            animation: pulse-gold 2s infinite !important;
-            transition: all 0.3s ease !important;
-            margin-top: 15px !important;
-        }}
-        
-        .stButton button:hover,
-        [data-testid="stFormSubmitButton"] button:hover,
-        [data-testid="stDownloadButton"] button:hover {{
-            transform: scale(1.05) !important;
-            background: linear-gradient(45deg, #FFED4B, #FFD700) !important;
-            border-color: #8B6508 !important;
-            color: #000000 !important;
-            box-shadow: 0 0 30px rgba(255, 215, 0, 0.8) !important;
-        }}
-        
-        /* 結果カード */
-        .card-frame {{
-            padding: 5px;
-            background: linear-gradient(135deg, #BF953F, #FCF6BA, #B38728, #FBF5B7);
-            border-radius: 20px;
-            box-shadow: 0 0 30px rgba(255, 215, 0, 0.3);
-            margin-bottom: 20px;
-        }}
-        .card-content {{
-            background: #1a0f2e;
-            padding: 20px;
-            border-radius: 15px;
-            text-align: center;
-        }}
-        .advice-box {{
-            background: rgba(255, 248, 220, 0.95); 
-            border: 3px double #8B4513;
-            border-radius: 10px; 
-            padding: 25px; 
-            margin-top: 30px;
-            color: #3E2723 !important;
-            font-size: 1.1rem !important;
-        }}
-        .advice-box * {{ color: #3E2723 !important; }}
-    </style>
-    """, unsafe_allow_html=True)
-
-def get_gemini_response(prompt, api_key):
-    if TEST_MODE: 
-        time.sleep(1)
-        return "【テスト】そなたの運命、しかと見届けたぞ。"
-    
-    if not api_key: return "⚠️ APIキーを設定してください。"
-    genai.configure(api_key=api_key)
-    
-    for model_name in MODELS_TO_TRY:
-        try:
-            model = genai.GenerativeModel(model_name)
-            res = model.generate_content(prompt)
-            if res.text: return res.text
-        except: continue
-    return "申し訳ございません。星々の声が届きにくくなっております。"
-
-def calculate_type():
-    scores = {"fire": 0, "water": 0, "wind": 0}
-    for q_id, val in st.session_state.answers.items():
-        for q in QUESTIONS:
-            if q["id"] == q_id:
-                scores[q["options"][val]] += 1
-    
-    sorted_scores = sorted(scores.items(), key=lambda x: x[1], reverse=True)
-    t1, s1 = sorted_scores[0]
-    t2, s2 = sorted_scores[1]
-    if s1 - s2 >= 2: return t1, t1
-    return f"{min(t1,t2)}-{max(t1,t2)}", t1
-
-def create_result_html(card_data, dynamic_data, final_advice, img_base64):
-    try:
-        # ローカル画像がない場合はWebのプレースホルダーを使用（URL形式に修正済み）
-        if img_base64:
-            img_src = f"data:image/jpeg;base64,{img_base64}"
-        else:
-            img_src = "https://placehold.co/400x400/1a0f2e/FFD700?text=Fortune+Card"
-
-        return f"""
-        <html>
-        <body style="background:#050510; color:#E0E0E0; font-family:serif; text-align:center; padding:20px;">
-            <div style="border:4px double #FFD700; padding:40px; background:#1a0f2e; border-radius:20px;">
-                <h1 style="color:#FFD700; font-family:serif;">{card_data['title']}</h1>
-                <img src="{img_src}" style="width:200px; border-radius:10px; border:2px solid #FFD700; margin: 15px 0;">
-                <h3 style="color:#FFF;">“{dynamic_data.get('desc','')}”</h3>
-                <div style="text-align:left; background:rgba(255,255,255,0.1); padding:20px; border-radius:10px;">
-                    <p><b>適職:</b> {', '.join(dynamic_data['jobs'])}</p>
-                    <p><b>助言:</b> {final_advice}</p>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
-    except: return "<html><body>Error</body></html>"
-
-# --- メイン処理 ---
-def main():
-    if "step" not in st.session_state: st.session_state.step = 0
-    if "answers" not in st.session_state: st.session_state.answers = {}
-    if "chat_history" not in st.session_state: st.session_state.chat_history = []
-    if "dynamic_result" not in st.session_state: st.session_state.dynamic_result = None
-    if "final_advice" not in st.session_state: st.session_state.final_advice = ""
-
-    api_key = get_api_key()
-    
-    # 画像ファイル読み込み
-    mansion_local = get_base64_of_bin_file("mansion.jpg")
-    room_local = get_base64_of_bin_file("room.jpg")
-    
-    # 背景切り替えロジック
-    bg_css_url = f"url('{URL_BG_MANSION}')"
-    if st.session_state.step == 0:
-        if mansion_local:
-            bg_css_url = f"url('data:image/jpeg;base64,{mansion_local}')"
-        else:
-            bg_css_url = f"url('{URL_BG_MANSION}')"
-    else:
-        if room_local:
-            bg_css_url = f"url('data:image/jpeg;base64,{room_local}')"
-        else:
-            bg_css_url = f"url('{URL_BG_ROOM}')"
-    
-    apply_custom_css(bg_css_url)
-
-    # --- STEP 0: トップ ---
-    if st.session_state.step == 0:
-        st.markdown('<div class="main-title">FORTUNE CAREER</div>', unsafe_allow_html=True)
-        st.markdown('<div style="text-align:center; margin-bottom:40px;">〜 学生のためのAI職業診断 〜</div>', unsafe_allow_html=True)
-        
-        col1, col2, col3 = st.columns([1, 2, 1])
-        with col2:
-            st.markdown("""
-            <div class="intro-box">
-                ようこそ、迷える若き魂よ。<br>
-                ここは星々の導きと、就活の叡智が交わる場所。<br>
-                あなたの真の才能と、未来のキャリアを紐解いて進ぜよう。
-            </div>
-            """, unsafe_allow_html=True)
-            if st.button("🚪 運命の扉を開く"):
-                if not api_key and not TEST_MODE:
-                    st.error("左のサイドバーからAPIキーを入力してください")
-                else:
-                    st.session_state.step = 1
-                    st.rerun()
-
-    # --- STEP 1: 質問 ---
-    elif st.session_state.step == 1:
-        st.markdown('<div class="main-title">The 10 Prophecies</div>', unsafe_allow_html=True)
-        st.markdown('<p style="text-align:center; color:#DDD; font-size:1.2rem;">そなたの価値観について、10の問いに答えよ…</p>', unsafe_allow_html=True)
-        
-        col1, col2, col3 = st.columns([1, 3, 1])
-        with col2:
-            with st.form("quiz"):
-                for q_data in QUESTIONS:
-                    st.markdown(f"<h3 style='color:#FFD700; text-shadow:1px 1px 2px #000;'>{q_data['q']}</h3>", unsafe_allow_html=True)
-                    st.radio("選択肢", list(q_data['options'].keys()), key=f"ans_{q_data['id']}", index=None, label_visibility="collapsed")
-                
-                st.markdown("<div style='height: 40px;'></div>", unsafe_allow_html=True)
-                
-                if st.form_submit_button("🔮 真実を明らかにする"):
-                    valid = True
-                    temp_ans = {}
-                    for q in QUESTIONS:
-                        val = st.session_state.get(f"ans_{q['id']}")
-                        if val is None:
-                            valid = False
-                            break
-                        temp_ans[q['id']] = val
-                    
-                    if valid:
-                        st.session_state.answers = temp_ans
-                        st.session_state.step = 2
-                        st.rerun()
-                    else:
-                        st.error("全ての問いに答えてください。")
-
-    # --- STEP 2: チャット ---
-    elif st.session_state.step == 2:
-        st.markdown('<div class="main-title">Talk with Spirits</div>', unsafe_allow_html=True)
-        
-        if not st.session_state.chat_history:
-            _, main_attr = calculate_type()
-            first_prompt = f"""
-            あなたは「運命の館」の主（占い師）であり、同時に超一流の学生キャリアコンサルタントです。
-            ユーザーの属性は「{main_attr}」です。
-            
-            【役割】
-            ・口調は「〜じゃ」「〜かのう」といった威厳ある占い師口調で話してください。
-            ・しかし、質問内容は「ガクチカ」や「自己分析」を引き出すための、非常に具体的で分かりやすいものにしてください。
-            
-            【最初の質問】
-            学生時代の経験を深掘りするために、一つ質問をしてください。
-            その際、抽象的な質問ではなく、「例えば部活でリーダーをした経験はあるか？」や「アルバイトで工夫したことはあるか？」など、
-            **具体的な例を挙げて**、学生が答えやすいように導いてください。
-            
-            【禁止】
-            ・選択肢の提示は絶対にしないこと。
-            """
-            st.session_state.chat_history.append({"role": "assistant", "content": get_gemini_response(first_prompt, api_key)})
-
-        col1, col2, col3 = st.columns([1, 3, 1])
-        with col2:
-            user_count = len([m for m in st.session_state.chat_history if m["role"] == "user"])
-            
-            for msg in st.session_state.chat_history:
-                icon = "🔮" if msg["role"] == "assistant" else "🧑‍🎓"
-                with st.chat_message(msg["role"], avatar=icon):
-                    st.write(msg["content"])
-            
-            if user_count < MAX_TURN_COUNT:
-                if val := st.chat_input("回答を入力..."):
-                    st.session_state.chat_history.append({"role": "user", "content": val})
-                    
-                    if user_count + 1 >= MAX_TURN_COUNT:
-                        next_prompt = "十分な情報が集まりました。占い師として「ふむ、そなたの進むべき道が見えたぞ...」と伝え、結果を見るよう促してください。選択肢は不要です。"
-                    else:
-                        next_prompt = f"会話履歴:{st.session_state.chat_history}\n占い師として、学生の強みを特定するための鋭い追加質問を1つだけ行ってください。「〜じゃ」口調で、かつ具体例を交えて分かりやすく聞いてください。選択肢は提示しないでください。"
-                    
-                    st.session_state.chat_history.append({"role": "assistant", "content": get_gemini_response(next_prompt, api_key)})
-                    st.rerun()
-            else:
-                st.success("運命の結果が出ました。")
-                if st.button("📜 運命の書を開く"): st.session_state.step = 3; st.rerun()
-
-    # --- STEP 3: 結果 ---
-    elif st.session_state.step == 3:
-        st.balloons()
-        st.markdown('<div class="main-title">Your Destiny Card</div>', unsafe_allow_html=True)
-        r_type, _ = calculate_type()
-        cards = {
-            "fire": {"title": "開拓の騎士", "file": "icon_fire.jpg"},
-            "water": {"title": "叡智の賢者", "file": "icon_water.jpg"},
-            "wind": {"title": "調和の精霊", "file": "icon_wind.jpg"},
-            "fire-water": {"title": "蒼炎の軍師", "file": "icon_fire_water.jpg"},
-            "fire-wind": {"title": "陽光の詩人", "file": "icon_fire_wind.jpg"},
-            "water-wind": {"title": "星詠みの司書", "file": "icon_water_wind.jpg"}
-        }
-        card_data = cards.get(r_type, cards["fire"])
-
-        if not st.session_state.dynamic_result:
-            with st.spinner("分析中..."):
-                prompt = f"""
-                以下の会話履歴から強み分析JSONを出力せよ。
-                会話履歴:{st.session_state.chat_history}
-                
-                出力フォーマット:
-                {{
-                    "skills": ["スキル1", "スキル2", "スキル3"],
-                    "jobs": ["職種1", "職種2", "職種3"],
-                    "desc": "一言キャッチコピー"
-                }}
-                
-                【重要】Markdownのコードブロック(```json)は不要です。純粋なJSONテキストのみ出力してください。
-                """
-                try:
-                    res = get_gemini_response(prompt, api_key)
-                    # 正規表現による強力なJSON抽出
-                    match = re.search(r'\{.*\}', res, re.DOTALL)
-                    if match:
-                        cleaned_res = match.group(0)
-                        st.session_state.dynamic_result = json.loads(cleaned_res)
-                    else:
-                        cleaned_res = res.replace("```json", "").replace("```", "").strip()
-                        st.session_state.dynamic_result = json.loads(cleaned_res)
-                        
-                except Exception as e:
-                    st.session_state.dynamic_result = {"skills":["分析不能"], "jobs":["全職種"], "desc":"無限の可能性"}
-                
-                adv_prompt = "診断結果に基づき、占い師として「〜じゃ」口調で、学生の背中を押すアドバイスを300文字でください。具体的な職種やアクションを含めて分かりやすく。"
-                st.session_state.final_advice = get_gemini_response(adv_prompt, api_key)
-
-        d_res = st.session_state.dynamic_result
-        col1, col2 = st.columns(2)
-        
-        with col1:
-            img_b64 = get_base64_of_bin_file(card_data['file'])
-            # 表示用画像ソース
-            if img_b64:
-                src = f"data:image/jpeg;base64,{img_b64}"
-            else:
-                src = "[https://placehold.co/400x400/1a0f2e/FFD700?text=Fortune+Card](https://placehold.co/400x400/1a0f2e/FFD700?text=Fortune+Card)"
-            
-            st.markdown(f"""
-            <div class="card-frame">
-                <div class="card-content">
-                    <h2 style="color:#FFD700;">{card_data['title']}</h2>
-                    <img src="{src}" style="width:100%; border-radius:10px; margin:10px 0;">
-                    <p style="color:#FFF; font-weight:bold;">“{d_res.get('desc','')}”</p>
-                </div>
-            </div>
-            """, unsafe_allow_html=True)
-        
-        with col2:
-            raw = {"fire":0, "water":0, "wind":0}
-            for k,v in st.session_state.answers.items():
-                for q in QUESTIONS:
-                    if q["id"]==k: raw[q["options"][v]] += 1
-            vals = [raw["fire"], raw["water"], raw["wind"], (raw["fire"]+raw["wind"])/1.5, (raw["fire"]+raw["water"])/1.5, raw["fire"]]
-            fig = go.Figure(data=go.Scatterpolar(r=vals, theta=['実行力','論理力','共感力','創造性','戦略性','実行力'], fill='toself', line_color='#FFD700'))
-            fig.update_layout(
-                paper_bgcolor='rgba(0,0,0,0)',
-                plot_bgcolor='rgba(0,0,0,0)',
-                polar=dict(
-                    bgcolor='rgba(0,0,0,0.5)',
-                    radialaxis=dict(visible=True, range=[0, 10], showticklabels=False),
-                    angularaxis=dict(tickfont=dict(color='white', size=16))
-                ),
-                margin=dict(l=40, r=40, t=40, b=40),
-                height=400
-            )
-            st.plotly_chart(fig, use_container_width=True)
-            
-            st.markdown(f"""
-            <div style="background:rgba(0,0,0,0.7); padding:20px; border-radius:10px; border:1px solid #FFD700; font-size:1.1rem;">
-                <p><b>🗝️ スキル:</b> {' / '.join(d_res.get('skills', []))}</p>
-                <p><b>💼 適職:</b> {' / '.join(d_res.get('jobs', []))}</p>
-            </div>
-            """, unsafe_allow_html=True)
-
-        st.markdown(f"<div class='advice-box'><h3>📜 Oracle's Message</h3>{st.session_state.final_advice}</div>", unsafe_allow_html=True)
-        
-        # HTMLダウンロード用 (画像URL修正済み)
-        html = create_result_html(card_data, st.session_state.dynamic_result, st.session_state.final_advice, img_b64)
-        st.download_button("📄 鑑定書を保存", data=html, file_name="result.html", mime="text/html")
-        if st.button("↩️ 戻る"): st.session_state.clear(); st.rerun()
-
-if __name__ == "__main__": main()
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+import time
+import atexit
+import base64
+import os
+import importlib
+import functools
+import numpy as np
+import json
+import re  # 正規表現用
+import hashlib
+import hmac
+import io
+import threading
+import sqlite3
+import secrets
+import socket
+import random
+import zlib
+from contextlib import closing, contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# ==========================================
+# 🔧 設定エリア
+# ==========================================
+TEST_MODE = os.environ.get("FORTUNE_TEST_MODE") == "1"
+# 有効なモデルIDリスト
+MODELS_TO_TRY = ["gemini-2.5-flash", "gemini-3.0-flash", "gemini-2.5-pro"]
+MAX_TURN_COUNT = 3
+# チャット・質問フォーム・結果のボタンを st.fragment で部分的に再実行する（計測で比較するときは環境変数で切れる）
+USE_FRAGMENTS = os.environ.get("FORTUNE_FRAGMENTS", "1") != "0"
+# 先行モデルがこの秒数(p95目安)で返らなければ次のモデルを並行して呼ぶ
+HEDGE_AFTER_SEC = 6.0
+# 1モデルあたりの打ち切り時間（秒）
+MODEL_TIMEOUT_SEC = 30.0
+# サーキットブレーカー: 直近CIRCUIT_WINDOW回のうちエラー率がしきい値を超えたモデルを一時的に外す
+CIRCUIT_WINDOW = 20
+CIRCUIT_MIN_CALLS = 4
+CIRCUIT_ERROR_RATE = 0.5
+CIRCUIT_COOLDOWN_SEC = 60
+# この秒数より古い結果は、遮断の判断にも並び順にも使わない（一時的なエラーでいつまでも後回しにしない）
+CIRCUIT_WINDOW_SEC = 300
+# 接続を保持しておくAPIキーの最大数（超えたら最も古いキーの接続を閉じる）
+CLIENT_POOL_MAX_KEYS = 8
+# Gemini呼び出しの流量制限（1分あたりの回数 / トークン数。プロセス全体とAPIキーごと）
+RATE_LIMIT_GLOBAL_RPM = 120
+RATE_LIMIT_GLOBAL_TPM = 1_000_000
+RATE_LIMIT_KEY_RPM = 60
+RATE_LIMIT_KEY_TPM = 500_000
+# 枠が空くのを待つ行列の長さの上限 / 1回の呼び出しで待つ最大秒数
+RATE_LIMIT_QUEUE_MAX = 200
+RATE_LIMIT_MAX_WAIT_SEC = 90
+# トークン数の見積もりに足す返答分 / 429を受けたAPIキーを休ませる秒数
+RATE_LIMIT_REPLY_TOKENS = 800
+RATE_LIMIT_PENALTY_SEC = 10
+# 最初の質問の作り置き（属性ごとの個数 / 有効期限 / 保存先 "memory" か "sqlite"）
+OPENING_POOL_SIZE = 5
+OPENING_CACHE_TTL_SEC = 6 * 3600
+OPENING_CACHE_MAX_ENTRIES = 100
+OPENING_CACHE_BACKEND = "memory"
+# セッションの保存先（"memory" / "sqlite" / "redis"）。URLの ?s=<トークン> で続きから再開できる。
+# 既定の memory はそのプロセスの中だけなので、別のレプリカや再起動後も再開するには sqlite（同じディスク）か redis にする
+SESSION_BACKEND = os.environ.get("FORTUNE_SESSION_BACKEND", "memory")
+SESSION_REDIS_URL = os.environ.get("FORTUNE_REDIS_URL", "redis://localhost:6379/0")
+SESSION_TTL_SEC = 24 * 3600
+SESSION_MAX_ENTRIES = 10000
+# 保存する会話1件あたりの最大文字数
+SESSION_MAX_TURN_CHARS = 2000
+# STEP3の結果生成ジョブ（SQLiteに状態と結果を残し、再読み込みや接続の切断をまたいで同じジョブを受け取る）:
+# 結果を残す時間 / 実行中の印を更新する間隔 / この秒数更新が途絶えた実行中のジョブは止まったとみなして引き取る / 他プロセスの結果を見に行く間隔
+RESULT_JOB_TTL_SEC = 24 * 3600
+RESULT_JOB_HEARTBEAT_SEC = 10
+RESULT_JOB_STALE_SEC = 60
+RESULT_JOB_POLL_SEC = 1.0
+# 結果画面で分析・アドバイスを待つ上限（秒）。過ぎたら定型文を出し、もう一度占うと続きのジョブにつながる
+RESULT_WAIT_TIMEOUT_SEC = 180
+# TEST_MODEのストリーミング疑似応答（初回トークンまでの待ち / トークン間隔, 秒）
+TEST_MODE_FIRST_TOKEN_DELAY = 0.5
+TEST_MODE_TOKEN_DELAY = 0.03
+# TEST_MODEの疑似クライアントへの追加設定（ベンチマーク用。例: {"delay": 2.0, "jitter": 0.3, "error_rate": {"gemini-2.5-flash": 0.1}}）
+FAKE_CLIENT_OPTIONS = json.loads(os.environ.get("FORTUNE_FAKE_CLIENT") or "{}")
+# 画像を static/ から配信する（Falseなら従来どおりbase64でCSSに埋め込む）。
+# ファイル名に内容ハッシュが入るので長期キャッシュしてよいが、streamlit の静的配信は Cache-Control を付けられないため、
+# 付けるならリバースプロキシ/CDNで ./app/static/ に設定する
+STATIC_ASSET_MODE = True
+# 変換時の画質。AVIFは同じ数値だとWebPより大きくなるので低めにし、それでもWebPより小さくならない画像はAVIFを作らない
+WEBP_QUALITY = 80
+AVIF_QUALITY = 55
+# 背景画像・カード画像の書き出し幅（px）
+BG_WIDTHS = [640, 1280, 1920]
+CARD_WIDTHS = [400, 800]
+# 結果のレーダーチャート: plotly.js を読み込まない軽量な "svg" か、"plotly"（?chart=svg / ?chart=plotly でも切り替え可）
+RADAR_CHART_MODE = "svg"
+# 鑑定書（HTML/PDF）の書き出し: 同時に生成する数 / 保持する件数 / 待ち時間の上限（秒）
+EXPORT_WORKERS = 2
+EXPORT_CACHE_MAX_ENTRIES = 200
+EXPORT_TIMEOUT_SEC = 60
+# 呼び出しの記録（トレース）: メモリに残す件数 / JSONLがこの大きさを超えたら .1 に回して書き直す / JSONLへまとめて書き出す間隔（秒）
+TRACE_BUFFER_SIZE = 1000
+TRACE_LOG_MAX_BYTES = 20 * 1024 * 1024
+TRACE_FLUSH_INTERVAL_SEC = 1.0
+# Prometheus形式のメトリクスを書き出す間隔（秒）
+METRICS_EXPORT_INTERVAL_SEC = 15
+# 所要時間ヒストグラムの区切り（秒）
+TRACE_LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+# ?profile=1（pyinstrumentがあれば ?profile=pyinstrument も可）でそのセッションの再実行をプロファイルし、この秒数を超えた分だけ残す
+PROFILE_SLOW_SEC = 1.0
+PROFILE_TOP_N = 25
+# 保存しておくプロファイルの数（超えたら古いものから消す）
+PROFILE_MAX_FILES = 50
+
+# ==========================================
+
+# 背景画像のWeb URL
+URL_BG_MANSION = 'https://images.unsplash.com/photo-1560183441-6333262aa22c?q=80&w=2070&auto=format&fit=crop'
+URL_BG_ROOM = 'https://images.unsplash.com/photo-1519074069444-1ba4fff66d16?q=80&w=2070&auto=format&fit=crop'
+
+# 静的アセットの置き場所（.streamlit/config.toml の enableStaticServing で ./app/static/ に公開される）
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(SCRIPT_DIR, "static")
+STATIC_URL = "app/static"
+OPENING_CACHE_PATH = os.path.join(SCRIPT_DIR, "oracle_cache.sqlite3")
+SESSION_DB_PATH = os.path.join(SCRIPT_DIR, "sessions.sqlite3")
+RESULT_JOB_DB_PATH = os.path.join(SCRIPT_DIR, "result_jobs.sqlite3")
+# スパンのJSONL / Prometheusのテキスト（static/ に置くと ./app/static/metrics.txt で取得できる）/ プロファイルの保存先。
+# 環境変数を空にすると書き出さない
+TRACE_LOG_PATH = os.environ.get("FORTUNE_TRACE_LOG", os.path.join(SCRIPT_DIR, "traces.jsonl"))
+METRICS_TEXTFILE_PATH = os.environ.get("FORTUNE_METRICS_TEXTFILE", os.path.join(STATIC_DIR, "metrics.txt"))
+PROFILE_DIR = os.path.join(SCRIPT_DIR, "profiles")
+# ?profile と、メトリクスページのスパン・プロファイル・呼び出し履歴の表示は、?ops= にこの値を付けたときだけ使える。
+# 空なら誰にも使わせない（集計値はこれまでどおり誰でも見られる）
+OPS_TOKEN = os.environ.get("FORTUNE_OPS_TOKEN", "")
+
+# フォントは FONT_DIR にまとめて置く。files が揃っているフォントはサブセット化して static/ から配信し、
+# 揃っていなければ google のGoogle Fontsを <link> で読む（Cinzel・Shippori Mincho B1 はSIL OFLなので同梱できる）
+FONT_DIR = os.path.join(SCRIPT_DIR, "fonts")
+FONTS = {
+    "--jp-font": {"family": "Shippori Mincho B1", "generic": "serif", "google": "Shippori+Mincho+B1:wght@400;700;900",
+                  "files": {"400": "ShipporiMinchoB1-Regular.ttf", "700": "ShipporiMinchoB1-Bold.ttf", "800": "ShipporiMinchoB1-ExtraBold.ttf"}},
+    "--title-font": {"family": "Cinzel", "generic": "serif", "google": "Cinzel:wght@700",
+                     "files": {"700": "Cinzel-Bold.ttf"}},
+}
+# PDFの鑑定書に埋め込むフォント（IPAexゴシック）
+PDF_FONT_FILE = "ipaexg.ttf"
+# モデルの返答・相談者の入力の表示に使うフォント。サブセットにない漢字だけ別の書体になるのを避けるため、
+# --jp-font をサブセットで配信するときは、文章ごと端末の明朝体で表示する
+REPLY_FONT_STACK = "'Hiragino Mincho ProN','Yu Mincho','Noto Serif JP',serif"
+# サブセットに必ず含める文字（ASCII・かな・和文記号・全角英数）
+SUBSET_EXTRA_RANGES = [(0x20, 0x7E), (0x3000, 0x30FF), (0xFF01, 0xFF9F)]
+
+# 結果カード
+CARDS = {
+    "fire": {"title": "開拓の騎士", "file": "icon_fire.jpg"},
+    "water": {"title": "叡智の賢者", "file": "icon_water.jpg"},
+    "wind": {"title": "調和の精霊", "file": "icon_wind.jpg"},
+    "fire-water": {"title": "蒼炎の軍師", "file": "icon_fire_water.jpg"},
+    "fire-wind": {"title": "陽光の詩人", "file": "icon_fire_wind.jpg"},
+    "water-wind": {"title": "星詠みの司書", "file": "icon_water_wind.jpg"}
+}
+
+# 質問データ
+QUESTIONS = [
+    {"id": "q1", "q": "I. 魂の渇望 - 将来、仕事を通じて得たいものは？", "options": {"💰 高い年収と社会的地位（成功・野心）": "fire", "🧠 専門スキルと知的好奇心（成長・探究）": "water", "🤝 仲間からの感謝と安心感（貢献・安定）": "wind"}},
+    {"id": "q2", "q": "II. 魔力の源泉 - グループワークや部活での役割は？", "options": {"🔥 皆を引っ張るリーダー・部長タイプ": "fire", "💧 計画を立てる参謀・書記タイプ": "water", "🌿 間を取り持つ調整役・ムードメーカー": "wind"}},
+    {"id": "q3", "q": "III. 冒険の指針 - 全く新しい課題が出たらどうする？", "options": {"⚔️ 「とりあえずやってみよう」と手を動かす": "fire", "🗺️ 「まずは情報を集めよう」と教科書を開く": "water", "🛡️ 「みんなはどう思う？」と友達と相談する": "wind"}},
+    {"id": "q4", "q": "IV. 求める秘宝 - 居心地が良いと感じる環境は？", "options": {"👑 実力主義で、成果を出せば評価される場所": "fire", "📜 静かで、自分の研究や作業に没頭できる場所": "water", "🕊️ アットホームで、先輩後輩が仲良い場所": "wind"}},
+    {"id": "q5", "q": "V. 試練の刻 - バイトや部活でトラブル発生！どう動く？", "options": {"⚡️ 自分が先頭に立って、その場で解決する": "fire", "🔍 なぜ起きたか原因を分析し、再発を防ぐ": "water", "📣 周りの人に状況を伝え、協力を仰ぐ": "wind"}},
+    {"id": "q6", "q": "VI. 交信の作法 - プレゼンや発表で意識することは？", "options": {"🔥 「情熱」や「想い」を熱く伝える": "fire", "💧 「データ」や「論理」を正確に伝える": "water", "🌿 「聞き手」が楽しんでいるかを気にする": "wind"}},
+    {"id": "q7", "q": "VII. 失敗の代償 - テストや試合で負けた時、どう思う？", "options": {"🔥 「次は絶対勝つ！」と闘志を燃やす": "fire", "💧 「敗因は何か？」と冷静に分析する": "water", "🌿 「チームに申し訳ない」と責任を感じる": "wind"}},
+    {"id": "q8", "q": "VIII. 究極スキル - 今、大学生活で身につけたい力は？", "options": {"🔥 人を巻き込み、何かを成し遂げる「行動力」": "fire", "💧 物事の本質を見抜き、解決する「思考力」": "water", "🌿 誰とでも信頼関係を築ける「対人力」": "wind"}},
+    {"id": "q9", "q": "IX. 安息の地 - 休日の理想的な過ごし方は？", "options": {"🔥 イベントや旅行など、アクティブに動く": "fire", "💧 読書、映画、ゲームなど、知識を深める": "water", "🌿 友達や恋人とカフェでのんびり話す": "wind"}},
+    {"id": "q10", "q": "X. 伝説の終わり - 卒業時、周りからどう言われたい？", "options": {"🔥 「あいつは凄かった、伝説だ」": "fire", "💧 「あいつがいれば何でも解決した」": "water", "🌿 「あいつがいてくれて本当に楽しかった」": "wind"}},
+]
+
+# 採点用の索引: 質問ID → 行番号、選択肢テキスト → 列番号、(質問, 選択肢) → 属性のone-hot
+ELEMENTS = ["fire", "water", "wind"]
+QUESTION_INDEX = {q["id"]: i for i, q in enumerate(QUESTIONS)}
+OPTION_INDEX = [{opt: j for j, opt in enumerate(q["options"])} for q in QUESTIONS]
+# 整数にしておくと属性スコアも整数のまま（batch.py のJSONにも 1.0 ではなく 1 と出る）
+OPTION_MATRIX = np.zeros((len(QUESTIONS), max(len(q["options"]) for q in QUESTIONS), len(ELEMENTS)), dtype=np.int8)
+for _i, _q in enumerate(QUESTIONS):
+    for _j, _elem in enumerate(_q["options"].values()):
+        OPTION_MATRIX[_i, _j, ELEMENTS.index(_elem)] = 1
+
+# レーダーチャートの軸 = 属性スコア @ RADAR_MATRIX
+RADAR_AXES = ['実行力', '論理力', '共感力', '創造性', '戦略性']
+RADAR_MATRIX = np.array([
+    # 実行力 論理力 共感力 創造性  戦略性
+    [1, 0, 0, 1 / 1.5, 1 / 1.5],  # fire
+    [0, 1, 0, 0,       1 / 1.5],  # water
+    [0, 0, 1, 1 / 1.5, 0],        # wind
+])
+
+# --- スタイル ---
+# 全画面共通のスタイル（フォントは build_stylesheet() で --jp-font / --title-font に割り当てる）
+BASE_CSS = """
+html, body, [class*="st-"] {
+    font-family: var(--jp-font) !important;
+    color: #E0E0E0 !important;
+    font-size: 1.05rem !important; 
+}
+/* 生成された文章・入力された文章（--reply-font は build_stylesheet() で決める） */
+[data-testid="stChatMessage"] *, .advice-box, .advice-box *, .oracle-text, .oracle-text * {
+    font-family: var(--reply-font) !important;
+}
+
+[data-testid="stAppViewContainer"] {
+    background-size: cover !important;
+    background-position: center center !important;
+    background-repeat: no-repeat !important;
+    background-attachment: fixed !important;
+}
+[data-testid="stAppViewContainer"]::before {
+    content: ""; position: fixed; top: 0; left: 0; width: 100%; height: 100%;
+    background: rgba(0, 0, 0, 0.5); z-index: -1; pointer-events: none;
+}
+
+/* ▼▼▼ 追加：Manage app等の非表示設定 ▼▼▼ */
+[data-testid="stHeader"] {
+    display: none !important;
+    visibility: hidden !important;
+}
+[data-testid="stToolbar"] {
+    display: none !important;
+    visibility: hidden !important;
+}
+.stAppDeployButton, [data-testid="stManageApp"] {
+    display: none !important;
+    visibility: hidden !important;
+}
+footer {
+    display: none !important;
+    visibility: hidden !important;
+}
+[data-testid="stDecoration"] {
+    display: none !important;
+    visibility: hidden !important;
+}
+/* ▲▲▲ ここまで ▲▲▲ */
+
+.main-title {
+    font-family: var(--title-font) !important;
+    color: #FFD700 !important;
+    text-shadow: 0 0 10px #FFD700, 0 0 20px #000;
+    font-size: 3.5rem !important;
+    text-align: center;
+    margin-top: 20px !important;
+}
+
+.intro-box {
+    background: rgba(0, 0, 0, 0.85);
+    border: 2px solid #FFD700;
+    border-radius: 15px;
+    padding: 30px;
+    text-align: center;
+    font-size: 1.2rem; 
+    line-height: 2;
+    box-shadow: 0 0 30px rgba(0,0,0,0.8);
+}
+
+h3 {
+    font-size: 1.6rem !important;
+    color: #FFD700 !important;
+    text-shadow: 2px 2px 4px #000;
+    margin-bottom: 20px !important;
+}
+
+div[role="radiogroup"] label {
+    background-color: rgba(20, 20, 40, 0.9) !important;
+    border: 1px solid #FFD700 !important;
+    border-radius: 10px !important;
+    padding: 15px 20px !important;
+    margin-bottom: 10px !important;
+    color: white !important;
+    transition: all 0.2s ease-in-out;
+    box-shadow: 0 4px 6px rgba(0,0,0,0.5);
+}
+div[role="radiogroup"] label:hover {
+    background-color: rgba(60, 60, 80, 1.0) !important;
+    transform: translateX(5px);
+    box-shadow: 0 0 10px #FFD700;
+}
+div[role="radiogroup"] label p {
+    font-size: 1.25rem !important;
+    font-weight: bold !important; 
+    color: #FFFFFF !important;
+}
+
+[data-testid="stBottom"] { background: transparent !important; }
+.stChatInput textarea {
+    background-color: rgba(0, 0, 0, 0.8) !important;
+    color: #FFD700 !important;
+    border: 2px solid #FFD700 !important;
+    border-radius: 25px !important;
+    font-size: 1.1rem !important;
+}
+div[data-testid="stChatMessage"] {
+    background-color: rgba(20, 10, 30, 0.9) !important;
+    border: 1px solid rgba(255, 215, 0, 0.3) !important;
+    border-radius: 15px !important;
+}
+div[data-testid="stChatMessage"] p {
+    font-size: 1.1rem !important;
+    line-height: 1.6;
+}
+
+/* ★ボタンデザイン */
+@keyframes pulse-gold {
+    0% { box-shadow: 0 0 0 0 rgba(255, 215, 0, 0.7); }
+    70% { box-shadow: 0 0 0 15px rgba(255, 215, 0, 0); }
+    100% { box-shadow: 0 0 0 0 rgba(255, 215, 0, 0); }
+}
+
+.stButton button, 
+[data-testid="stFormSubmitButton"] button,
+[data-testid="stDownloadButton"] button {
+    width: 100% !important;
+    background: linear-gradient(45deg, #FFD700, #FDB931, #DAA520) !important;
+    color: #000000 !important;
+    font-weight: 900 !important;
+    border: 2px solid #8B6508 !important;
+    padding: 20px 30px !important;
+    border-radius: 50px !important;
+    font-family: var(--title-font) !important;
+    font-size: 1.6rem !important;
+    text-shadow: none !important;
+    animation: pulse-gold 2s infinite !important;
+    transition: all 0.3s ease !important;
+    margin-top: 15px !important;
+}
+
+.stButton button:hover,
+[data-testid="stFormSubmitButton"] button:hover,
+[data-testid="stDownloadButton"] button:hover {
+    transform: scale(1.05) !important;
+    background: linear-gradient(45deg, #FFED4B, #FFD700) !important;
+    border-color: #8B6508 !important;
+    color: #000000 !important;
+    box-shadow: 0 0 30px rgba(255, 215, 0, 0.8) !important;
+}
+
+/* 結果カード */
+.card-frame {
+    padding: 5px;
+    background: linear-gradient(135deg, #BF953F, #FCF6BA, #B38728, #FBF5B7);
+    border-radius: 20px;
+    box-shadow: 0 0 30px rgba(255, 215, 0, 0.3);
+    margin-bottom: 20px;
+}
+.card-content {
+    background: #1a0f2e;
+    padding: 20px;
+    border-radius: 15px;
+    text-align: center;
+}
+.advice-box {
+    background: rgba(255, 248, 220, 0.95); 
+    border: 3px double #8B4513;
+    border-radius: 10px; 
+    padding: 25px; 
+    margin-top: 30px;
+    color: #3E2723 !important;
+    font-size: 1.1rem !important;
+}
+.advice-box * { color: #3E2723 !important; }
+"""
+
+# --- プロンプト ---
+# 占い師の人格はsystem instructionとして固定し、会話はuser/modelのターンとして渡す
+ORACLE_PERSONA = """あなたは「運命の館」の主（占い師）であり、同時に超一流の学生キャリアコンサルタントです。
+
+【役割】
+・口調は「〜じゃ」「〜かのう」といった威厳ある占い師口調で話してください。
+・しかし、質問内容は「ガクチカ」や「自己分析」を引き出すための、非常に具体的で分かりやすいものにしてください。
+
+【禁止】
+・選択肢の提示は絶対にしないこと。"""
+
+def build_opening_prompt(main_attr):
+    return f"""ユーザーの属性は「{main_attr}」です。
+
+【最初の質問】
+学生時代の経験を深掘りするために、一つ質問をしてください。
+その際、抽象的な質問ではなく、「例えば部活でリーダーをした経験はあるか？」や「アルバイトで工夫したことはあるか？」など、
+**具体的な例を挙げて**、学生が答えやすいように導いてください。"""
+
+FOLLOW_UP_INSTRUCTION = "（指示: 占い師として、学生の強みを特定するための鋭い追加質問を1つだけ行ってください。「〜じゃ」口調で、かつ具体例を交えて分かりやすく聞いてください。選択肢は提示しないでください。）"
+CLOSING_INSTRUCTION = "（指示: 十分な情報が集まりました。占い師として「ふむ、そなたの進むべき道が見えたぞ...」と伝え、結果を見るよう促してください。選択肢は不要です。）"
+
+def build_chat_contents(history, opening, instruction=None):
+    """チャット履歴をSDKの contents 形式（user/model が交互に並ぶターン）に変換する。
+    instruction は最後のユーザー発言に添えて送る。"""
+    contents = [{"role": "user", "parts": [opening]}]
+    for msg in history:
+        role = "model" if msg["role"] == "assistant" else "user"
+        contents.append({"role": role, "parts": [msg["content"]]})
+    if instruction and contents[-1]["role"] == "user":
+        contents[-1]["parts"].append(instruction)
+    return contents
+
+def format_transcript(history):
+    """分析用に会話を「占い師: …」「学生: …」の行にまとめる"""
+    return "\n".join(f"{'占い師' if m['role'] == 'assistant' else '学生'}: {m['content']}" for m in history)
+
+def build_analysis_prompt(history):
+    return f"""
+    以下の会話履歴から強み分析JSONを出力せよ。
+    会話履歴:
+    {format_transcript(history)}
+    
+    出力フォーマット:
+    {{
+        "skills": ["スキル1", "スキル2", "スキル3"],
+        "jobs": ["職種1", "職種2", "職種3"],
+        "desc": "一言キャッチコピー"
+    }}
+    
+    【重要】Markdownのコードブロック(```json)は不要です。純粋なJSONテキストのみ出力してください。
+    """
+
+# 強み分析はJSONモード＋スキーマ指定で受け取る
+ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "skills": {"type": "array", "items": {"type": "string"}},
+        "jobs": {"type": "array", "items": {"type": "string"}},
+        "desc": {"type": "string"},
+    },
+    "required": ["skills", "jobs", "desc"],
+}
+ANALYSIS_CONFIG = {"response_mime_type": "application/json", "response_schema": ANALYSIS_SCHEMA}
+ANALYSIS_FALLBACK = {"skills":["分析不能"], "jobs":["全職種"], "desc":"無限の可能性"}
+# どのモデルからも応答が得られなかったときの返答
+ORACLE_FALLBACK_TEXT = "申し訳ございません。星々の声が届きにくくなっております。"
+
+def build_repair_prompt(bad_output, error):
+    return f"""次のテキストは強み分析JSONとして不正です（{error}）。
+内容はできるだけ保ったまま、skills（文字列3つ）・jobs（文字列3つ）・desc（一言キャッチコピー）を持つJSONに直して出力してください。
+
+{bad_output}"""
+
+def build_advice_prompt(history, card_title):
+    # 分析と同時に投げるので、分析結果ではなく会話と診断タイプを材料にする
+    return f"""学生の診断タイプは「{card_title}」です。
+会話履歴:
+{format_transcript(history)}
+
+診断結果に基づき、占い師として「〜じゃ」口調で、学生の背中を押すアドバイスを300文字でください。具体的な職種やアクションを含めて分かりやすく。"""
+
+# --- ヘルパー関数 ---
+def get_server_api_key():
+    """サーバー側（secrets）に置いたキー。利用者が入力したキーは含めない。"""
+    if "GEMINI_API_KEY" in st.secrets:
+        return st.secrets["GEMINI_API_KEY"]
+    return None
+
+def get_api_key():
+    if key := get_server_api_key():
+        return key
+    with st.sidebar:
+        val = st.text_input("Gemini API Key", type="password")
+        if val: return val
+    return None
+
+@st.cache_data
+def get_base64_of_bin_file(bin_file):
+    try:
+        if os.path.exists(bin_file):
+            with open(bin_file, 'rb') as f:
+                data = f.read()
+            return base64.b64encode(data).decode()
+        
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        file_path = os.path.join(script_dir, bin_file)
+        if os.path.exists(file_path):
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            return base64.b64encode(data).decode()
+    except Exception:
+        return None
+    return None
+
+def _write_atomic(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def _publish_original(src_name):
+    """src_name をそのまま static/ に置き、そのURLを返す（ファイル名に内容ハッシュを含める）"""
+    with open(os.path.join(SCRIPT_DIR, src_name), 'rb') as f:
+        raw = f.read()
+    stem, ext = os.path.splitext(src_name)
+    fname = f"{stem}.{hashlib.sha256(raw).hexdigest()[:12]}{ext}"
+    path = os.path.join(STATIC_DIR, fname)
+    if not os.path.exists(path):
+        _write_atomic(path, raw)
+    return f"{STATIC_URL}/{fname}"
+
+def _build_image_variants(src_name, widths, encode=True):
+    """src_name のリサイズ済みWebP/AVIFを static/ に書き出し、配信情報を返す。
+    配信情報は画像ごとのJSONにも残し、encode=False なら書き出し済みの分だけを読む（なければ None）。"""
+    # 元画像の内容ハッシュをファイル名に含めるので、画像を差し替えればURLも変わる
+    with open(os.path.join(SCRIPT_DIR, src_name), 'rb') as f:
+        raw = f.read()
+    digest = hashlib.sha256(raw).hexdigest()[:12]
+    stem = os.path.splitext(src_name)[0]
+    manifest_path = os.path.join(STATIC_DIR, f"{stem}.{digest}.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            return json.load(f)
+    if not encode: return None
+
+    from PIL import Image
+    Image.init()
+    formats = [("webp", "WEBP", "image/webp", WEBP_QUALITY)]
+    if ".avif" in Image.registered_extensions():
+        formats.insert(0, ("avif", "AVIF", "image/avif", AVIF_QUALITY))
+
+    encoded = []  # [(幅, {拡張子: バイト列})]
+    with Image.open(io.BytesIO(raw)) as img:
+        img = img.convert("RGB")
+        for w in sorted({min(w, img.width) for w in widths}):
+            resized = img.resize((w, round(img.height * w / img.width)), Image.LANCZOS)
+            data = {}
+            for ext, fmt, _, quality in formats:
+                buf = io.BytesIO()
+                resized.save(buf, fmt, quality=quality)
+                data[ext] = buf.getvalue()
+            encoded.append((w, data))
+    # どれかの幅でWebP以上の大きさになるなら、その画像はAVIFを配信しない（ブラウザは先に並べた形式を選ぶため）
+    if any(len(data.get("avif", b"")) >= len(data["webp"]) for _, data in encoded):
+        formats = [f for f in formats if f[0] != "avif"]
+
+    variants = []
+    for w, data in encoded:
+        entry = {"width": w}
+        for ext, *_ in formats:
+            fname = f"{stem}.{digest}.{w}.{ext}"
+            _write_atomic(os.path.join(STATIC_DIR, fname), data[ext])
+            entry[ext] = f"{STATIC_URL}/{fname}"
+        variants.append(entry)
+    asset = {"formats": [(ext, mime) for ext, _, mime, _ in formats], "variants": variants}
+    _write_atomic(manifest_path, json.dumps(asset).encode("utf-8"))
+    return asset
+
+class StaticAssetBuilder:
+    """画像の変換をバックグラウンドで進め、できた画像から get() で返す。
+    書き出し済みの画像はすぐ使い、初回起動直後で変換中の画像は None（呼び出し側が従来の表示にフォールバックする）。
+    originals に挙げた画像は、変換が終わるまでの代わりに元のファイルを static/ に置き、original() でそのURLを返す。"""
+    def __init__(self, targets, originals=()):
+        self.manifest = {}
+        self.originals = {}
+        pending = []
+        for name, widths in targets:
+            try:
+                asset = _build_image_variants(name, widths, encode=False)
+                if asset: self.manifest[name] = asset
+                else:
+                    pending.append((name, widths))
+                    if name in originals: self.originals[name] = _publish_original(name)
+            except Exception:
+                continue
+        self.building = bool(pending)
+        if pending:
+            threading.Thread(target=self._run, args=(pending,), name="static-assets", daemon=True).start()
+
+    def _run(self, pending):
+        for name, widths in pending:
+            try:
+                self.manifest[name] = _build_image_variants(name, widths)
+            except Exception:
+                continue
+        self.building = False
+
+    def get(self, name):
+        return self.manifest.get(name)
+
+    def original(self, name):
+        return self.originals.get(name)
+
+@st.cache_resource(show_spinner=False)
+def build_static_assets():
+    """画像をリサイズ済みWebP/AVIFに変換して static/ に書き出す StaticAssetBuilder を返す（変換は裏で行う）。
+    静的配信が無効、または書き込めない環境では空dictを返し、従来のbase64埋め込みにフォールバックする。"""
+    if not STATIC_ASSET_MODE or not st.get_option("server.enableStaticServing"):
+        return {}
+    try:
+        os.makedirs(STATIC_DIR, exist_ok=True)
+    except OSError:
+        return {}
+
+    # トップ画面の背景から順に変換する
+    targets = [("mansion.jpg", BG_WIDTHS), ("room.jpg", BG_WIDTHS)]
+    cards = [c["file"] for c in CARDS.values()]
+    targets += [(name, CARD_WIDTHS) for name in cards]
+    return StaticAssetBuilder(targets, originals=cards)
+
+def get_background_css(file_name, fallback_url):
+    sel = '[data-testid="stAppViewContainer"]'
+    assets = build_static_assets()
+    asset = assets.get(file_name)
+    if not asset:
+        # 変換が終わるまでの間は、大きな背景画像をbase64で毎回送らずWeb上の画像を使う
+        local = None if getattr(assets, "building", False) else get_base64_of_bin_file(file_name)
+        bg_url = f"url('data:image/jpeg;base64,{local}')" if local else f"url('{fallback_url}')"
+        return f"{sel} {{ background-image: {bg_url} !important; }}"
+
+    # 小さい画面向けから順に、画面幅に応じたサイズを選ばせる
+    rules = []
+    prev_width = 0
+    for v in asset["variants"]:
+        sources = ", ".join(f"url('{v[ext]}') type('{mime}')" for ext, mime in asset["formats"])
+        rule = f"{sel} {{ background-image: url('{v['webp']}') !important; background-image: image-set({sources}) !important; }}"
+        rules.append(f"@media (min-width: {prev_width + 1}px) {{ {rule} }}" if prev_width else rule)
+        prev_width = v["width"]
+    return "\n".join(rules)
+
+def get_card_img_html(file_name, style):
+    assets = build_static_assets()
+    asset = assets.get(file_name)
+    if not asset:
+        # 変換が終わるまでの間は、base64で毎回送らず元のJPEGを static/ から配信する
+        original = assets.original(file_name) if hasattr(assets, "original") else None
+        if original:
+            return f'<img src="{original}" style="{style}">'
+        img_b64 = get_base64_of_bin_file(file_name)
+        src = f"data:image/jpeg;base64,{img_b64}" if img_b64 else "https://placehold.co/400x400/1a0f2e/FFD700?text=Fortune+Card"
+        return f'<img src="{src}" style="{style}">'
+
+    sources = ""
+    for ext, mime in asset["formats"]:
+        srcset = ", ".join(f"{v[ext]} {v['width']}w" for v in asset["variants"])
+        sources += f'<source type="{mime}" srcset="{srcset}" sizes="(max-width: 768px) 100vw, 50vw">'
+    return f'<picture>{sources}<img src="{asset["variants"][-1]["webp"]}" style="{style}"></picture>'
+
+def _build_font_subset(file_name):
+    """フォントをアプリで使う文字だけに絞ったWOFF2を static/ に書き出し、ファイル名を返す。
+    フォントファイルや fontTools がなければ None（Google Fontsにフォールバック）。"""
+    src = os.path.join(FONT_DIR, file_name)
+    if not os.path.exists(src): return None
+    try:
+        from fontTools import subset
+    except ImportError:
+        return None
+
+    # 質問文・UI文言はこのファイルにすべて書かれているので、ソース中の文字＋かな・記号類を収録する
+    with open(os.path.abspath(__file__), encoding="utf-8") as f:
+        chars = set(f.read())
+    for lo, hi in SUBSET_EXTRA_RANGES:
+        chars.update(chr(c) for c in range(lo, hi + 1))
+    text = "".join(sorted(c for c in chars if c.isprintable()))
+
+    with open(src, 'rb') as f:
+        digest = hashlib.sha256(f.read() + text.encode()).hexdigest()[:12]
+    fname = f"{os.path.splitext(os.path.basename(src))[0]}.{digest}.woff2"
+    out = os.path.join(STATIC_DIR, fname)
+    if not os.path.exists(out):
+        try:
+            options = subset.Options()
+            options.flavor = "woff2"
+            ttf = subset.load_font(src, options)
+            subsetter = subset.Subsetter(options)
+            subsetter.populate(text=text)
+            subsetter.subset(ttf)
+            tmp = f"{out}.{os.getpid()}.tmp"
+            subset.save_font(ttf, tmp, options)
+            os.replace(tmp, out)
+        except Exception:
+            return None
+    return fname
+
+def minify_css(css):
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,])\s*", r"\1", css)
+    return css.replace(": ", ":").replace(";}", "}").strip()
+
+@st.cache_resource(show_spinner=False)
+def build_stylesheet():
+    """フォント指定を組み込んでミニファイしたスタイルシートをプロセスごとに1回だけ作る。
+    静的配信できれば static/ に書き出して {"href": URL}、できなければ {"inline": CSS} を返す。
+    Google Fontsを使うときは、そのURLを "fonts" に入れる（CSSの @import を経由させずにページから直接読む）。"""
+    static_ok = bool(STATIC_ASSET_MODE and st.get_option("server.enableStaticServing"))
+    if static_ok:
+        try:
+            os.makedirs(STATIC_DIR, exist_ok=True)
+        except OSError:
+            static_ok = False
+
+    faces, google, font_vars = [], [], []
+    for var, font in FONTS.items():
+        # 太さごとのファイルが1つでも欠けたら、そのフォントはまるごとGoogle Fontsから読む
+        subsets = {weight: _build_font_subset(f) for weight, f in font["files"].items()} if static_ok else {}
+        self_hosted = bool(subsets) and all(subsets.values())
+        if self_hosted:
+            faces += [f"@font-face{{font-family:'{font['family']}';src:url('{fname}') format('woff2');font-weight:{weight};font-display:swap}}"
+                      for weight, fname in subsets.items()]
+        else:
+            google.append(f"family={font['google']}")
+        stack = f"'{font['family']}',{font['generic']}"
+        font_vars.append(f"{var}:{stack}")
+        if var == "--jp-font":
+            # Google Fontsは全文字を持つので、返答もそのまま同じ書体で表示できる
+            font_vars.append(f"--reply-font:{REPLY_FONT_STACK if self_hosted else stack}")
+
+    css = "".join(faces) + ":root{" + ";".join(font_vars) + "}" + minify_css(BASE_CSS)
+    fonts = f"https://fonts.googleapis.com/css2?{'&'.join(google)}&display=swap" if google else None
+
+    if static_ok:
+        fname = f"app.{hashlib.sha256(css.encode()).hexdigest()[:12]}.css"
+        out = os.path.join(STATIC_DIR, fname)
+        try:
+            if not os.path.exists(out):
+                tmp = f"{out}.{os.getpid()}.tmp"
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    f.write(css)
+                os.replace(tmp, out)
+            return {"href": f"{STATIC_URL}/{fname}", "fonts": fonts}
+        except OSError:
+            pass
+    return {"inline": css, "fonts": fonts}
+
+def apply_custom_css(bg_css):
+    # 固定部分はキャッシュされる外部CSSを参照し、毎回送るのは背景の指定だけにする
+    sheet = build_stylesheet()
+    fonts = ""
+    if sheet["fonts"]:
+        fonts = ('<link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>'
+                 f'<link rel="stylesheet" href="{sheet["fonts"]}">')
+    if "href" in sheet:
+        st.markdown(f'{fonts}<link rel="stylesheet" href="{sheet["href"]}"><style>{bg_css}</style>', unsafe_allow_html=True)
+    else:
+        st.markdown(f"{fonts}<style>{sheet['inline']}{bg_css}</style>", unsafe_allow_html=True)
+
+# 重いライブラリは使うステップまで読み込まず、トップ画面を描いた後に裏で読み込んでおく
+WARMUP_MODULES = ["google.generativeai", "google.ai.generativelanguage", "plotly.graph_objects"]
+
+@st.cache_resource(show_spinner=False)
+def start_warmup():
+    """WARMUP_MODULES の読み込みをプロセスで1回だけバックグラウンドで始める"""
+    def run():
+        for name in WARMUP_MODULES:
+            try:
+                importlib.import_module(name)
+            except Exception:
+                pass  # 失敗しても使う時点で改めて import される
+    thread = threading.Thread(target=run, name="warmup", daemon=True)
+    thread.start()
+    return thread
+
+# --- 計測（トレース・メトリクス・プロファイル） ---
+class Tracer:
+    """処理1つ分（スパン）の記録。直近の分をメモリに残し、Prometheus形式の集計も持つ。
+    JSONLへの追記は呼び出し元を待たせないよう溜めておき、専用のスレッドがまとめて書き出す。"""
+    def __init__(self, buffer_size, log_path, log_max_bytes, buckets, flush_interval=TRACE_FLUSH_INTERVAL_SEC):
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.recent = deque(maxlen=buffer_size)
+        self.log_path = log_path
+        self.log_max_bytes = log_max_bytes
+        self.buckets = buckets
+        self.flush_interval = flush_interval
+        self.counters = {}  # (メトリクス名, ラベル) -> 値
+        self.histograms = {}  # ラベル -> [区切りごとの累積件数..., 件数, 合計秒]
+        # 書き出し待ちの行。ディスクが詰まっても際限なく溜めず、古いものから捨てて数える
+        self.pending = deque(maxlen=buffer_size * 10)
+        self.stopped = threading.Event()
+        if log_path:
+            threading.Thread(target=self._flush_loop, name="trace-writer", daemon=True).start()
+            atexit.register(self.close)
+
+    def record(self, span):
+        line = json.dumps(span, ensure_ascii=False, default=str) + "\n"
+        with self.lock:
+            self.recent.append(span)
+            self._aggregate(span)
+            if self.log_path:
+                if len(self.pending) == self.pending.maxlen:
+                    self._count("fortune_trace_dropped_total", ())
+                self.pending.append(line)
+
+    def _flush_loop(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """書き出しスレッドを止め、残っている分を書き出す（プロセス終了時にも呼ばれる）"""
+        self.stopped.set()
+        self.flush()
+
+    def flush(self):
+        """書き出し待ちのスパンをまとめてJSONLに追記する"""
+        with self.write_lock:
+            with self.lock:
+                lines = list(self.pending)
+                self.pending.clear()
+            if lines:
+                self._write("".join(lines))
+
+    def _count(self, name, labels, value=1):
+        self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def _aggregate(self, span):
+        attrs = span["attrs"]
+        labels = (("span", span["name"]), ("model", attrs.get("model") or ""), ("status", span["status"]))
+        hist = self.histograms.setdefault(labels, [0] * (len(self.buckets) + 1) + [0.0])
+        for i, le in enumerate(self.buckets):
+            if span["duration"] <= le: hist[i] += 1
+        hist[-2] += 1
+        hist[-1] += span["duration"]
+        # トークン数はモデルへの呼び出し1回ごとのスパンだけで数える（親のスパンは合計を持つだけ）
+        if span["name"] == "oracle.attempt":
+            for kind in ("prompt", "response"):
+                if attrs.get(f"{kind}_tokens"):
+                    self._count("fortune_tokens_total", labels[:2] + (("kind", kind),), attrs[f"{kind}_tokens"])
+        if attrs.get("retries"):
+            self._count("fortune_retries_total", labels[:1], attrs["retries"])
+        if attrs.get("fallback"):
+            self._count("fortune_fallback_total", labels[:1])
+
+    def _write(self, data):
+        try:
+            if os.path.exists(self.log_path) and os.path.getsize(self.log_path) > self.log_max_bytes:
+                os.replace(self.log_path, self.log_path + ".1")
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(data)
+        except OSError:
+            pass  # 記録に失敗しても診断は止めない
+
+    def prometheus(self, extra=()):
+        """Prometheusのテキスト形式。extra は (名前, 種類, ラベル, 値) の並び"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {k: list(v) for k, v in self.histograms.items()}
+        lines = ["# TYPE fortune_span_duration_seconds histogram"]
+        for labels, hist in sorted(histograms.items()):
+            for le, n in zip(self.buckets + ["+Inf"], hist):
+                lines.append(f"fortune_span_duration_seconds_bucket{_prom_labels(labels + (('le', le),))} {n}")
+            lines.append(f"fortune_span_duration_seconds_count{_prom_labels(labels)} {hist[-2]}")
+            lines.append(f"fortune_span_duration_seconds_sum{_prom_labels(labels)} {hist[-1]:.6f}")
+        rows = sorted((name, "counter", labels, value) for (name, labels), value in counters.items()) + list(extra)
+        typed = set()
+        for name, kind, labels, value in rows:
+            if name not in typed:
+                lines.append(f"# TYPE {name} {kind}")
+                typed.add(name)
+            lines.append(f"{name}{_prom_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+def _prom_labels(labels):
+    if not labels: return ""
+    def esc(v):
+        return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}"
+
+@st.cache_resource(show_spinner=False)
+def get_tracer():
+    return Tracer(TRACE_BUFFER_SIZE, TRACE_LOG_PATH, TRACE_LOG_MAX_BYTES, TRACE_LATENCY_BUCKETS)
+
+# 実行中のスパン（スレッドごと）。ワーカーで動く処理は親を持たず、session で同じ利用者の記録とつなげる
+_trace_ctx = threading.local()
+
+def _new_span(name, attrs):
+    parent = getattr(_trace_ctx, "span", None)
+    return {
+        "name": name,
+        "trace_id": parent["trace_id"] if parent else secrets.token_hex(8),
+        "span_id": secrets.token_hex(4),
+        "parent_id": parent["span_id"] if parent else None,
+        "session": current_owner(),
+        "start": time.time(),
+        "attrs": dict(attrs),
+    }
+
+@contextmanager
+def span(name, **attrs):
+    """with の中の処理をスパンとして記録する。受け取ったdictに属性を書き足せ、"outcome" を入れるとそれが結果になる。
+    st.rerun() などの制御用の例外は失敗として扱わない。"""
+    s = _new_span(name, attrs)
+    parent = getattr(_trace_ctx, "span", None)
+    _trace_ctx.span = s
+    error = None
+    try:
+        yield s["attrs"]
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        # 途中で放棄されたジェネレーターが後から閉じられたときは、その時点のスパンを巻き戻さない
+        if getattr(_trace_ctx, "span", None) is s:
+            _trace_ctx.span = parent
+        s["duration"] = round(time.time() - s["start"], 6)
+        outcome = s["attrs"].pop("outcome", "ok")
+        s["status"] = "error" if error else outcome
+        if error: s["error"] = repr(error)
+        get_tracer().record(s)
+
+def record_span(name, started, status, **attrs):
+    """終わった処理を started（time.time()）から今までのスパンとして記録する"""
+    s = _new_span(name, attrs)
+    s["start"] = started
+    s["duration"] = round(time.time() - started, 6)
+    s["status"] = status
+    get_tracer().record(s)
+
+def annotate_span(**attrs):
+    """実行中のスパンに属性を書き込む"""
+    s = getattr(_trace_ctx, "span", None)
+    if s: s["attrs"].update(attrs)
+
+def add_to_span(**values):
+    """実行中のスパンの数値の属性に足し込む"""
+    s = getattr(_trace_ctx, "span", None)
+    if s is None: return
+    for k, v in values.items():
+        s["attrs"][k] = s["attrs"].get(k, 0) + (v or 0)
+
+def metrics_text():
+    """Prometheusのテキスト形式のメトリクス（スパンの集計に流量制限とモデルの状態を足す）"""
+    limiter = get_rate_limiter().metrics()
+    extra = [("fortune_rate_limit_waiting", "gauge", (), limiter["waiting"])]
+    extra += [("fortune_rate_limit_events_total", "counter", (("event", k),), limiter[k])
+              for k in ("admitted", "queued", "skipped", "rejected", "timeout", "penalized")]
+    extra += [("fortune_model_circuit_open", "gauge", (("model", m),), int(h["state"] != "closed"))
+              for m, h in sorted(get_health_board().metrics().items())]
+    return get_tracer().prometheus(extra)
+
+def write_metrics_textfile(path):
+    """書きかけを読まれないよう、一時ファイルに書いてから置き換える"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(metrics_text())
+    os.replace(tmp, path)
+
+@st.cache_resource(show_spinner=False)
+def start_metrics_exporter():
+    """METRICS_TEXTFILE_PATH にメトリクスを定期的に書き出すスレッドをプロセスで1つ起動する"""
+    if not METRICS_TEXTFILE_PATH: return None
+    def run():
+        while True:
+            try:
+                write_metrics_textfile(METRICS_TEXTFILE_PATH)
+            except Exception:
+                pass  # 書き出せなくても次の周期で再試行する
+            time.sleep(METRICS_EXPORT_INTERVAL_SEC)
+    thread = threading.Thread(target=run, name="metrics-exporter", daemon=True)
+    thread.start()
+    return thread
+
+# 保存したプロファイル（新しいものが後ろ）
+@st.cache_resource(show_spinner=False)
+def get_profile_log():
+    return deque(maxlen=PROFILE_MAX_FILES)
+
+def ops_access():
+    """運用者として開かれているか（?ops= が OPS_TOKEN と一致する）"""
+    given = st.query_params.get("ops", "")
+    return bool(OPS_TOKEN) and hmac.compare_digest(given.encode(), OPS_TOKEN.encode())
+
+def profile_mode():
+    """このセッションのプロファイル設定。?profile=1 / pyinstrument で有効になり、?profile=0 で止まる（どちらも ?ops= が必要）"""
+    requested = st.query_params.get("profile")
+    if requested is not None and ops_access():
+        st.session_state.profile_mode = None if requested in ("", "0", "off") else (
+            "pyinstrument" if requested == "pyinstrument" else "cprofile")
+    return st.session_state.get("profile_mode")
+
+def _start_profiler(mode):
+    if mode == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+            profiler = Profiler(async_mode="disabled")
+            profiler.start()
+            return profiler
+        except ImportError:
+            pass  # 入っていなければ cProfile で取る
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def _save_profile(profiler, name, seconds):
+    """遅かった実行のプロファイルを PROFILE_DIR に保存し、ログに要約を残して保存先を返す"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stem = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{name.replace(':', '_')}-{secrets.token_hex(3)}")
+    if hasattr(profiler, "output_html"):  # pyinstrument
+        path = stem + ".html"
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(profiler.output_html())
+        summary = profiler.output_text()
+    else:
+        import pstats
+        path = stem + ".prof"
+        profiler.dump_stats(path)
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+        summary = out.getvalue()
+    get_profile_log().append({"at": time.time(), "name": name, "seconds": round(seconds, 3),
+                              "session": current_owner(), "path": path, "summary": summary})
+    _prune_profiles()
+    return path
+
+def _prune_profiles():
+    """PROFILE_DIR のファイルが PROFILE_MAX_FILES を超えたら古いものから消す（ファイル名は保存時刻から始まる）"""
+    for name in sorted(os.listdir(PROFILE_DIR))[:-PROFILE_MAX_FILES]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, name))
+        except OSError:
+            pass  # 他のプロセスが先に消した
+
+@contextmanager
+def traced_run(name):
+    """スクリプトの実行1回（アプリ全体 / fragmentだけ）をスパンにする。
+    ?profile を付けたセッションでは実行をプロファイルし、PROFILE_SLOW_SEC を超えたものを保存する。"""
+    # 全体の実行中に呼ばれたfragmentは、外側の実行のプロファイルに含まれる
+    mode = profile_mode() if getattr(_trace_ctx, "span", None) is None else None
+    started = time.time()
+    profiler = _start_profiler(mode) if mode else None
+    with span(name, step=st.session_state.get("step", 0)) as attrs:
+        try:
+            yield attrs
+        finally:
+            if profiler:
+                (profiler.stop if hasattr(profiler, "output_html") else profiler.disable)()
+                seconds = time.time() - started
+                if seconds >= PROFILE_SLOW_SEC:
+                    try:
+                        attrs["profile"] = _save_profile(profiler, name, seconds)
+                    except OSError:
+                        pass
+
+# --- モデルの健康状態（サーキットブレーカー） ---
+class ModelCircuit:
+    """1モデル分の直近の成否とレイテンシ。closed → open → half_open → closed と遷移する。"""
+    def __init__(self):
+        self.results = deque(maxlen=CIRCUIT_WINDOW)  # (成功したか, 秒, 記録した時刻)
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.trial_started = 0.0
+        self.served = 0
+
+    def recent(self, now=None):
+        """CIRCUIT_WINDOW_SEC 以内の結果"""
+        since = (now or time.time()) - CIRCUIT_WINDOW_SEC
+        return [r for r in self.results if r[2] >= since]
+
+    def error_rate(self, now=None):
+        results = self.recent(now)
+        if not results: return 0.0
+        return sum(1 for ok, *_ in results if not ok) / len(results)
+
+    def rank_error_rate(self, now=None):
+        """並び替えに使うエラー率。CIRCUIT_MIN_CALLS 回に満たないうちは1回の失敗で順位を落とさない"""
+        if len(self.recent(now)) < CIRCUIT_MIN_CALLS: return 0.0
+        return self.error_rate(now)
+
+    def latency(self, pct):
+        lat = sorted(sec for ok, sec, _ in self.recent() if ok)
+        if not lat: return None
+        return lat[min(len(lat) - 1, int(len(lat) * pct))]
+
+class ModelHealthBoard:
+    """全セッション共通のモデル別サーキットブレーカーと健康スコアボード"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.circuits = {}
+
+    def _circuit(self, model_name):
+        return self.circuits.setdefault(model_name, ModelCircuit())
+
+    def record(self, model_name, ok, latency):
+        with self.lock:
+            c = self._circuit(model_name)
+            now = time.time()
+            c.results.append((ok, latency, now))
+            if ok: c.served += 1
+            if c.state == "half_open":
+                c.trial_started = 0.0
+                if ok:
+                    c.state = "closed"
+                    c.results.clear()
+                    c.results.append((ok, latency, now))
+                else:
+                    c.state, c.opened_at = "open", now
+            elif (c.state == "closed" and len(c.recent(now)) >= CIRCUIT_MIN_CALLS
+                  and c.error_rate(now) >= CIRCUIT_ERROR_RATE):
+                c.state, c.opened_at = "open", now
+
+    def order(self, models, trials=None):
+        """開いている回路を除き、直近の健康状態が良い順に並べ替える。全滅時は元の順序のまま返す。
+        trials にdictを渡すと、半開のお試し枠を取ったモデルを入れる（呼び出し後に release() で戻す）。"""
+        with self.lock:
+            now = time.time()
+            usable = []
+            for i, m in enumerate(models):
+                c = self._circuit(m)
+                if c.state == "open" and now - c.opened_at >= CIRCUIT_COOLDOWN_SEC:
+                    c.state = "half_open"
+                if c.state == "open": continue
+                if c.state == "half_open":
+                    # 半開中はお試しの1本だけ通す（返し忘れた枠もタイムアウト後には戻す）
+                    if now - c.trial_started < MODEL_TIMEOUT_SEC: continue
+                    c.trial_started = now
+                    if trials is not None: trials[m] = now
+                # 誤差程度の差では設定順を崩さないよう、エラー率は1割・レイテンシは1秒単位で比べる
+                p50 = c.latency(0.5)
+                usable.append((round(c.rank_error_rate(now), 1), round(p50 or 0.0), i, m))
+        if not usable: return list(models)
+        return [m for *_, m in sorted(usable)]
+
+    def release(self, trials):
+        """order() で取ったお試し枠のうち、結果を record() しなかった分を戻す
+        （先に別のモデルが返った・呼ぶ前に打ち切った・モデルの不調ではない失敗だったなど）"""
+        with self.lock:
+            for m, started in trials.items():
+                c = self._circuit(m)
+                if c.state == "half_open" and c.trial_started == started:
+                    c.trial_started = 0.0
+
+    def metrics(self):
+        with self.lock:
+            return {
+                m: {
+                    "state": c.state,
+                    "calls": len(c.recent()),
+                    "error_rate": round(c.error_rate(), 3),
+                    "p50_sec": c.latency(0.5),
+                    "p95_sec": c.latency(0.95),
+                    "served": c.served,
+                }
+                for m, c in self.circuits.items()
+            }
+
+@st.cache_resource(show_spinner=False)
+def get_health_board():
+    return ModelHealthBoard()
+
+# --- 流量制限（全セッション共通） ---
+class TokenBucket:
+    """1分あたり rate_per_min まで使えるバケツ。使った分は時間とともに回復し、最大で1分ぶん貯まる。"""
+    def __init__(self, rate_per_min):
+        self.capacity = float(rate_per_min)
+        self.rate = rate_per_min / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if now <= self.updated: return
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """amount を使えるようになるまでの秒数。上限より大きい要求は満杯になった時点で通す。"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount, now):
+        self._refill(now)
+        self.level -= amount
+
+    def drain(self, seconds, now):
+        """429を受けたときなど、seconds 秒は空かないようにする"""
+        self._refill(now)
+        self.level = min(self.level, -self.rate * seconds)
+
+class RateLimiter:
+    """Gemini呼び出しの流量制限。プロセス全体とAPIキーごとに、回数/分とトークン数/分のバケツを持つ。
+    枠がなければ1本の行列に並んで待ち、枠が空いたら最も長く待たされているセッションから順に通す。"""
+    def __init__(self, global_rpm, global_tpm, key_rpm, key_tpm, max_queue, max_wait):
+        self.key_limits = (key_rpm, key_tpm)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.cond = threading.Condition()
+        self.global_buckets = (TokenBucket(global_rpm), TokenBucket(global_tpm))
+        self.key_buckets = OrderedDict()  # api_key -> (回数, トークン)
+        self.queue = []  # 到着順のチケット
+        self.last_served = OrderedDict()  # owner -> 最後に通した時刻
+        self.seq = 0
+        self.counts = {"admitted": 0, "queued": 0, "skipped": 0, "rejected": 0, "timeout": 0, "penalized": 0}
+
+    def _buckets(self, api_key):
+        # 使われたキーは後ろへ回し、あふれたら最も長く使われていないキーから捨てる
+        buckets = self.key_buckets.get(api_key)
+        if buckets is None:
+            buckets = self.key_buckets[api_key] = tuple(TokenBucket(limit) for limit in self.key_limits)
+            while len(self.key_buckets) > 1000:
+                self.key_buckets.popitem(last=False)
+        else:
+            self.key_buckets.move_to_end(api_key)
+        return self.global_buckets + buckets
+
+    def _wait_time(self, api_key, tokens, now):
+        # バケツは (全体の回数, 全体のトークン, キーの回数, キーのトークン) の順
+        return max(b.wait_time(amount, now) for b, amount in zip(self._buckets(api_key), (1, tokens) * 2))
+
+    def _take(self, api_key, tokens, owner, now):
+        for b, amount in zip(self._buckets(api_key), (1, tokens) * 2):
+            b.take(amount, now)
+        self.last_served[owner] = now
+        self.last_served.move_to_end(owner)
+        while len(self.last_served) > 1000:
+            self.last_served.popitem(last=False)
+        self.counts["admitted"] += 1
+
+    def _pick(self, now):
+        """いま通せるチケットのうち、前回通してから最も時間の空いたセッションのものを選ぶ。
+        通せるものがなければ (None, 次に空くまでの秒数)"""
+        ready, delay = [], None
+        for t in self.queue:
+            w = self._wait_time(t["api_key"], t["tokens"], now)
+            if w == 0:
+                ready.append(t)
+            else:
+                delay = w if delay is None else min(delay, w)
+        if ready:
+            return min(ready, key=lambda t: (self.last_served.get(t["owner"], 0.0), t["seq"])), 0.0
+        return None, delay
+
+    def acquire(self, api_key, tokens, owner=None, block=True, on_wait=None):
+        """1回分の枠を取る。block=False なら空いていなければすぐ諦める（ヘッジや作り置き用）。
+        待っている間は行列での順番(1始まり)が変わるたびに on_wait(順番) を呼ぶ。"""
+        with self.cond:
+            now = time.monotonic()
+            if not self.queue and self._wait_time(api_key, tokens, now) == 0:
+                self._take(api_key, tokens, owner, now)
+                return True
+            if not block:
+                self.counts["skipped"] += 1
+                return False
+            if len(self.queue) >= self.max_queue:
+                self.counts["rejected"] += 1
+                return False
+            self.seq += 1
+            ticket = {"api_key": api_key, "tokens": tokens, "owner": owner, "seq": self.seq}
+            self.queue.append(ticket)
+            self.counts["queued"] += 1
+        deadline = time.monotonic() + self.max_wait
+
+        position = None
+        try:
+            while True:
+                with self.cond:
+                    now = time.monotonic()
+                    chosen, delay = self._pick(now)
+                    if chosen is ticket:
+                        self.queue.remove(ticket)
+                        self._take(api_key, tokens, owner, now)
+                        self.cond.notify_all()
+                        return True
+                    if chosen is not None:
+                        self.cond.notify_all()  # 選ばれたチケットの待ち手を起こす
+                    if now >= deadline:
+                        self.counts["timeout"] += 1
+                        return False
+                    current = self.queue.index(ticket) + 1
+                    if current == position or on_wait is None:
+                        self.cond.wait(timeout=min(delay or 1.0, deadline - now, 1.0))
+                        continue
+                position = current
+                on_wait(position)
+        finally:
+            with self.cond:
+                if ticket in self.queue:
+                    self.queue.remove(ticket)
+                    self.cond.notify_all()
+
+    def position(self, owner):
+        """owner の呼び出しの行列での順番（1始まり）。並んでいなければ0"""
+        with self.cond:
+            for i, t in enumerate(self.queue):
+                if t["owner"] == owner:
+                    return i + 1
+            return 0
+
+    def penalize(self, api_key, seconds):
+        with self.cond:
+            now = time.monotonic()
+            self._buckets(api_key)[2].drain(seconds, now)
+            self.counts["penalized"] += 1
+
+    def metrics(self):
+        with self.cond:
+            return {"waiting": len(self.queue), "keys": len(self.key_buckets), **self.counts}
+
+RATE_LIMIT_NOTICE = "⏳ 星々への問いかけが混み合っておる… そなたの順番は {pos} 番目じゃ"
+
+@st.cache_resource(show_spinner=False)
+def get_rate_limiter():
+    return RateLimiter(RATE_LIMIT_GLOBAL_RPM, RATE_LIMIT_GLOBAL_TPM, RATE_LIMIT_KEY_RPM, RATE_LIMIT_KEY_TPM,
+                       RATE_LIMIT_QUEUE_MAX, RATE_LIMIT_MAX_WAIT_SEC)
+
+def estimate_tokens(prompt, system_instruction=None):
+    """流量制限用の見積もり。日本語はおおむね1文字1トークンとして返答分を足す"""
+    text = prompt if isinstance(prompt, str) else json.dumps(prompt, ensure_ascii=False)
+    return len(text) + len(system_instruction or "") + RATE_LIMIT_REPLY_TOKENS
+
+# 行列の「誰の呼び出しか」。スクリプトのスレッドではセッションID、ワーカーでは run_as() で渡された値
+_call_owner = threading.local()
+
+def current_owner():
+    owner = getattr(_call_owner, "value", None)
+    if owner is None:
+        ctx = get_script_run_ctx(suppress_warning=True)
+        owner = ctx.session_id if ctx else None
+    return owner
+
+def run_as(owner, fn, *args, **kwargs):
+    """ワーカースレッドで fn を owner（セッション）の呼び出しとして実行する"""
+    _call_owner.value = owner
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _call_owner.value = None
+
+def _is_rate_limited(error):
+    return type(error).__name__ == "ResourceExhausted" or "429" in str(error)
+
+# --- Gemini呼び出し ---
+class PooledModel:
+    """GenerativeModel の代わりに、プールした接続（GenerativeServiceClient）で generate_content を呼ぶ。
+    GenerativeModel には接続を渡す引数がないので、リクエストはSDKの変換関数で同じ形に組み立てる。"""
+    def __init__(self, service, model_name, system_instruction=None):
+        from google.generativeai.types import content_types
+        self.service = service
+        self.model_name = model_name if "/" in model_name else f"models/{model_name}"
+        self.system_instruction = content_types.to_content(system_instruction) if system_instruction else None
+
+    def generate_content(self, contents, stream=False, generation_config=None, timeout=None):
+        from google.generativeai import protos
+        from google.generativeai.types import content_types, generation_types
+        request = protos.GenerateContentRequest(
+            model=self.model_name,
+            contents=content_types.to_contents(contents),
+            generation_config=generation_types.to_generation_config_dict(generation_config),
+            system_instruction=self.system_instruction,
+        )
+        # 役割のない最後のメッセージは相談者の発言として送る（GenerativeModel と同じ）
+        if request.contents and not request.contents[-1].role:
+            request.contents[-1].role = "user"
+        if stream:
+            with generation_types.rewrite_stream_error():
+                iterator = self.service.stream_generate_content(request, timeout=timeout)
+            return generation_types.GenerateContentResponse.from_iterator(iterator)
+        return generation_types.GenerateContentResponse.from_response(self.service.generate_content(request, timeout=timeout))
+
+class GeminiClientPool:
+    """APIキーごとの接続と (モデル名, system_instruction) ごとのモデルを使い回す。
+    genai.configure() はプロセス全体の設定を書き換えるため、セッションごとに呼ばずキー別のクライアントを持つ。
+    上限を超えて追い出したキーの接続は、貸し出し中の呼び出しがすべて返ってから閉じる。"""
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        # api_key -> {"service": GenerativeServiceClient（gRPCの接続を保持し続ける）, "models": {...}, "users": 貸し出し中の数, "evicted": bool}
+        self.services = OrderedDict()
+
+    @contextmanager
+    def model(self, api_key, model_name, system_instruction=None):
+        """with の間だけモデルを貸す（その間は接続を閉じない）"""
+        # 読み込みが重いので、最初に呼ぶとき（STEP2に入るとき）まで遅らせる
+        from google.ai import generativelanguage as glm
+        evicted = []
+        with self.lock:
+            entry = self.services.get(api_key)
+            if entry is None:
+                service = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+                entry = self.services[api_key] = {"service": service, "models": {}, "users": 0, "evicted": False}
+                while len(self.services) > self.max_keys:
+                    _, old = self.services.popitem(last=False)
+                    old["evicted"] = True
+                    if old["users"] == 0: evicted.append(old)
+            else:
+                self.services.move_to_end(api_key)
+            key = (model_name, system_instruction)
+            model = entry["models"].get(key)
+            if model is None:
+                model = entry["models"][key] = PooledModel(entry["service"], model_name, system_instruction)
+            entry["users"] += 1
+        for old in evicted:
+            self._close(old)
+        try:
+            yield model
+        finally:
+            with self.lock:
+                entry["users"] -= 1
+                close = entry["evicted"] and entry["users"] == 0
+            if close:
+                self._close(entry)
+
+    def _close(self, entry):
+        try:
+            entry["service"].transport.close()
+        except Exception:
+            pass
+
+@st.cache_resource(show_spinner=False)
+def get_client_pool():
+    return GeminiClientPool(CLIENT_POOL_MAX_KEYS)
+
+class GeminiClient:
+    """google.generativeai を使う本番用クライアント"""
+    def __init__(self, api_key):
+        self.api_key = api_key
+        self.pool = get_client_pool()
+
+    def generate(self, model_name, prompt, system_instruction=None, generation_config=None, usage=None):
+        """usage にdictを渡すと、応答の usage_metadata からトークン数を書き込む"""
+        try:
+            with self.pool.model(self.api_key, model_name, system_instruction) as model:
+                res = model.generate_content(prompt, generation_config=generation_config, timeout=MODEL_TIMEOUT_SEC)
+        except Exception as e:
+            self._check_rate_limited(e)
+            raise
+        self._read_usage(res, usage)
+        return res.text
+
+    def stream(self, model_name, prompt, system_instruction=None, usage=None):
+        try:
+            # 読み終わる（または途中で閉じられる）まで接続を借りたままにする
+            with self.pool.model(self.api_key, model_name, system_instruction) as model:
+                for chunk in model.generate_content(prompt, stream=True, timeout=MODEL_TIMEOUT_SEC):
+                    # usage_metadata は途中の断片では途中までの数、最後の断片で確定値になる
+                    self._read_usage(chunk, usage)
+                    if chunk.text:
+                        yield chunk.text
+        except Exception as e:
+            self._check_rate_limited(e)
+            raise
+
+    def _read_usage(self, res, usage):
+        meta = getattr(res, "usage_metadata", None)
+        if usage is None or not meta: return
+        usage["prompt_tokens"] = meta.prompt_token_count
+        usage["response_tokens"] = meta.candidates_token_count
+
+    def _check_rate_limited(self, error):
+        # 429が返ったらこのキーの枠をしばらく空けず、後続は行列で待たせる
+        if _is_rate_limited(error):
+            get_rate_limiter().penalize(self.api_key, RATE_LIMIT_PENALTY_SEC)
+
+class FakeGeminiClient:
+    """TEST_MODE・検証用の疑似クライアント。モデルごとに遅延(秒)や例外、確率的なエラーを注入できる。
+    jitter を指定すると遅延が ±jitter の割合でばらつく。"""
+    def __init__(self, reply="【テスト】そなたの運命、しかと見届けたぞ。", delays=None, errors=None,
+                 first_token_delay=TEST_MODE_FIRST_TOKEN_DELAY, token_delay=TEST_MODE_TOKEN_DELAY,
+                 json_reply='{"skills": ["行動力", "分析力", "傾聴力"], "jobs": ["企画職", "コンサルタント", "人事"], "desc": "【テスト】星に導かれし者"}',
+                 delay=1.0, jitter=0.0, error_rate=None):
+        self.reply = reply
+        self.json_reply = json_reply
+        self.delays = delays or {}
+        self.errors = errors or {}
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+        self.delay = delay
+        self.jitter = jitter
+        self.error_rate = error_rate or {}
+
+    def _sleep(self, seconds):
+        if self.jitter:
+            seconds *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        time.sleep(max(seconds, 0))
+
+    def _maybe_fail(self, model_name):
+        if model_name in self.errors:
+            raise self.errors[model_name]
+        if random.random() < self.error_rate.get(model_name, 0):
+            raise RuntimeError(f"疑似エラー: {model_name}")
+
+    def _fill_usage(self, usage, prompt, system_instruction, reply):
+        # トークン数は流量制限の見積もりと同じく1文字1トークンとみなす
+        if usage is None: return
+        usage["prompt_tokens"] = estimate_tokens(prompt, system_instruction) - RATE_LIMIT_REPLY_TOKENS
+        usage["response_tokens"] = len(reply)
+
+    def generate(self, model_name, prompt, system_instruction=None, generation_config=None, usage=None):
+        self._sleep(self.delays.get(model_name, self.delay))
+        self._maybe_fail(model_name)
+        reply = self.reply
+        if generation_config and generation_config.get("response_mime_type") == "application/json":
+            reply = self.json_reply
+        self._fill_usage(usage, prompt, system_instruction, reply)
+        return reply
+
+    def stream(self, model_name, prompt, system_instruction=None, usage=None):
+        self._sleep(self.delays.get(model_name, self.first_token_delay))
+        self._maybe_fail(model_name)
+        self._fill_usage(usage, prompt, system_instruction, self.reply)
+        for token in self.reply:
+            yield token
+            time.sleep(self.token_delay)
+
+# ヘッジ用のスレッドプール（プロセス全体で共有）。スクリプトは再実行のたびに評価し直されるので、共有物は cache_resource に置く
+@st.cache_resource(show_spinner=False)
+def get_oracle_pool():
+    return ThreadPoolExecutor(max_workers=32, thread_name_prefix="oracle")
+
+# 直近の呼び出し結果（負け・タイムアウト・エラーを含む）
+@st.cache_resource(show_spinner=False)
+def get_hedge_events():
+    return deque(maxlen=500)
+
+def _get_client(api_key):
+    if TEST_MODE: return FakeGeminiClient(**FAKE_CLIENT_OPTIONS)
+    if not api_key: return None
+    return GeminiClient(api_key)
+
+def _record_attempt(model_name, outcome, started, error=None, usage=None):
+    latency = round(time.time() - started, 3)
+    get_hedge_events().append({
+        "model": model_name, "outcome": outcome, "latency": latency,
+        "error": repr(error) if error else None, "at": time.time(),
+    })
+    # 呼び出し1回分のスパンを残し、呼び出し元（oracle.generate / oracle.stream）には回数とトークン数を足し込む
+    usage = usage or {}
+    record_span("oracle.attempt", started, outcome, model=model_name, error=repr(error) if error else None, **usage)
+    add_to_span(attempts=1, **usage)
+    if outcome == "ok":
+        annotate_span(model=model_name)
+    # 打ち切ったヘッジの片割れは成否不明なので健康状態には数えない。
+    # APIキーの誤りやキーごとの429はモデルの不調ではないので、全員で共有する回路には数えない
+    if outcome in ("ok", "lost"):
+        get_health_board().record(model_name, True, latency)
+    elif outcome != "cancelled" and (error is None or _is_model_failure(error)):
+        get_health_board().record(model_name, False, latency)
+
+def _is_model_failure(error):
+    """モデル側の失敗（5xx・期限切れ・モデルが見つからない）か。HTTPステータスを持たない例外（通信断など）も含める"""
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return code >= 500 or code in (404, 408)
+    return not _is_rate_limited(error)
+
+def hedged_generate(client, prompt, models=None, hedge_after=None, timeout=None,
+                    system_instruction=None, generation_config=None, admit=None):
+    """先頭のモデルから呼び出し、hedge_after 秒で返らなければ次のモデルも並行して呼ぶ。
+    最初に返ったテキストを (モデル名, テキスト) で返し、全滅なら (None, None)。
+    admit(block) は呼び出しごとの流量制限の枠取り。ヘッジは block=False で、空きがなければ見送る。"""
+    board = get_health_board()
+    trials = {}
+    models = board.order(models or MODELS_TO_TRY, trials)
+    try:
+        return _hedged_generate(client, prompt, models, HEDGE_AFTER_SEC if hedge_after is None else hedge_after,
+                                MODEL_TIMEOUT_SEC if timeout is None else timeout, system_instruction, generation_config, admit)
+    finally:
+        board.release(trials)
+
+def _hedged_generate(client, prompt, models, hedge_after, timeout, system_instruction, generation_config, admit):
+    pending = {}
+    next_idx = 0
+    last_launch = 0.0
+
+    def launch():
+        nonlocal next_idx, last_launch
+        model_name = models[next_idx]
+        next_idx += 1
+        last_launch = time.time()
+        usage = {}
+        future = get_oracle_pool().submit(client.generate, model_name, prompt, system_instruction, generation_config, usage)
+        pending[future] = (model_name, last_launch, usage)
+
+    winner = (None, None)
+    if admit is not None and not admit(True):
+        return winner
+    launch()
+    while pending:
+        now = time.time()
+        wait_for = min(started + timeout for _, started, _ in pending.values()) - now
+        if next_idx < len(models):
+            wait_for = min(wait_for, last_launch + hedge_after - now)
+        done, _ = wait(pending, timeout=max(wait_for, 0), return_when=FIRST_COMPLETED)
+
+        for f in done:
+            model_name, started, usage = pending.pop(f)
+            try:
+                text = f.result()
+            except Exception as e:
+                _record_attempt(model_name, "error", started, e)
+                continue
+            if text and winner[0] is None:
+                _record_attempt(model_name, "ok", started, usage=usage)
+                winner = (model_name, text)
+            else:
+                _record_attempt(model_name, "empty" if not text else "lost", started, usage=usage)
+        if winner[0]: break
+
+        # 期限切れの呼び出しは見捨てる（スレッド自体はSDK側のtimeoutで終わる）
+        now = time.time()
+        for f, (model_name, started, _) in list(pending.items()):
+            if now - started >= timeout:
+                pending.pop(f)
+                f.cancel()
+                _record_attempt(model_name, "timeout", started)
+
+        # 失敗で空いた、またはヘッジ時間を過ぎたら次のモデルを投入
+        if next_idx < len(models) and (not pending or now - last_launch >= hedge_after):
+            # 失敗の後は枠を待ってでも呼ぶが、ヘッジは流量に余裕があるときだけ
+            if admit is None or admit(not pending):
+                launch()
+            elif pending:
+                last_launch = now
+            else:
+                break
+
+    for f, (model_name, started, _) in pending.items():
+        f.cancel()
+        _record_attempt(model_name, "cancelled", started)
+    return winner
+
+def rate_limited(api_key, prompt, system_instruction=None, block=None, on_wait=None):
+    """hedged_generate() に渡す枠取り関数。block を指定すると常にその待ち方をする。"""
+    limiter, tokens, owner = get_rate_limiter(), estimate_tokens(prompt, system_instruction), current_owner()
+    def admit(wait_for_slot):
+        return limiter.acquire(api_key, tokens, owner, block=wait_for_slot if block is None else block, on_wait=on_wait)
+    return admit
+
+def get_gemini_response(prompt, api_key, system_instruction=None, generation_config=None):
+    """prompt は文字列、または build_chat_contents() の contents"""
+    client = _get_client(api_key)
+    if client is None: return "⚠️ APIキーを設定してください。"
+
+    with span("oracle.generate") as attrs:
+        _, text = hedged_generate(client, prompt, system_instruction=system_instruction, generation_config=generation_config,
+                                  admit=rate_limited(api_key, prompt, system_instruction))
+        _finish_oracle_span(attrs, fallback=not text)
+    if text: return text
+    return ORACLE_FALLBACK_TEXT
+
+def _finish_oracle_span(attrs, fallback):
+    """呼び出し全体のスパンに再試行回数と結果を書く。1回も呼べずに定型文を返したら流量制限で断られた分"""
+    attempts = attrs.get("attempts", 0)
+    attrs["retries"] = max(attempts - 1, 0)
+    attrs["fallback"] = fallback
+    if fallback:
+        attrs["outcome"] = "fallback" if attempts else "rate_limited"
+
+def stream_gemini_response(prompt, api_key, system_instruction=None):
+    """get_gemini_response のストリーミング版。届いた順にテキスト断片をyieldする。"""
+    started = time.time()
+    first = True
+    with span("oracle.stream") as attrs:
+        for chunk in _stream_gemini_chunks(prompt, api_key, system_instruction):
+            if first:
+                # 初回トークンまでの時間（TTFT）を記録しておく
+                ttft = time.time() - started
+                st.session_state.setdefault("ttft_log", []).append(ttft)
+                attrs["ttft"] = round(ttft, 3)
+                first = False
+            yield chunk
+        _finish_oracle_span(attrs, fallback=attrs.get("fallback", False))
+
+def _stream_gemini_chunks(prompt, api_key, system_instruction=None):
+    client = _get_client(api_key)
+    if client is None:
+        yield "⚠️ APIキーを設定してください。"
+        return
+
+    # 混んでいるときは行列での順番を表示して待つ（スクリプトのスレッドで動くので画面に出せる）
+    notice = st.empty()
+    admit = rate_limited(api_key, prompt, system_instruction, block=True,
+                         on_wait=lambda pos: notice.info(RATE_LIMIT_NOTICE.format(pos=pos)))
+    # ストリーミングはヘッジしない（表示し始めた文章は差し替えられず、並行して流すとトークンが倍かかる）。
+    # 遅いモデルを避けるのは健康状態の並べ替えに任せ、失敗したときだけ次のモデルへ移る
+    board = get_health_board()
+    trials = {}
+    try:
+        for model_name in board.order(MODELS_TO_TRY, trials):
+            admitted = admit(True)
+            notice.empty()
+            if not admitted: break
+            started = time.time()
+            yielded = False
+            usage = {}
+            try:
+                for chunk in client.stream(model_name, prompt, system_instruction, usage):
+                    yielded = True
+                    yield chunk
+            except Exception as e:
+                _record_attempt(model_name, "error", started, e, usage)
+                # 途中まで表示済みなら別モデルでやり直さない
+                if yielded:
+                    annotate_span(outcome="partial")
+                    return
+                continue
+            if yielded:
+                _record_attempt(model_name, "ok", started, usage=usage)
+                return
+            _record_attempt(model_name, "empty", started, usage=usage)
+        annotate_span(fallback=True)
+        yield ORACLE_FALLBACK_TEXT
+    finally:
+        # 先のモデルで済んで呼ばなかったモデルのお試し枠を戻す
+        board.release(trials)
+
+# --- 最初の質問の作り置き（STEP2） ---
+class MemoryResponseStore:
+    """プロセス内のTTL付きストア。1つのキーに複数の応答（バリアント）を溜めておける。
+    上限を超えたら古く作ったものから捨てる（取り出すと消えるので、読み出し順での並べ替えはしない）。"""
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # 連番 -> (key, value, 作成時刻)
+        self.seq = 0
+
+    def _expire(self, now):
+        for i, (_, _, created) in list(self.entries.items()):
+            if now - created > self.ttl:
+                del self.entries[i]
+
+    def put(self, key, value):
+        with self.lock:
+            self.seq += 1
+            self.entries[self.seq] = (key, value, time.time())
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def take(self, key):
+        """キーに溜まっている応答を古い順に1つ取り出す（取り出した応答は消える）"""
+        with self.lock:
+            self._expire(time.time())
+            for i, (k, value, _) in self.entries.items():
+                if k == key:
+                    del self.entries[i]
+                    return value
+        return None
+
+    def count(self, key):
+        with self.lock:
+            self._expire(time.time())
+            return sum(1 for k, _, _ in self.entries.values() if k == key)
+
+class SqliteResponseStore:
+    """MemoryResponseStore と同じ使い方で、中身をSQLiteファイルに残す（再起動しても消えない）"""
+    def __init__(self, path, ttl, max_entries):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        with closing(self._connect()) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS responses (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, value TEXT NOT NULL, created REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_key ON responses (key, id)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def put(self, key, value):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT INTO responses (key, value, created) VALUES (?, ?, ?)", (key, value, time.time()))
+            conn.execute("DELETE FROM responses WHERE id NOT IN (SELECT id FROM responses ORDER BY id DESC LIMIT ?)", (self.max_entries,))
+
+    def take(self, key):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+            row = conn.execute("SELECT id, value FROM responses WHERE key = ? ORDER BY id LIMIT 1", (key,)).fetchone()
+            if row is None: return None
+            conn.execute("DELETE FROM responses WHERE id = ?", (row[0],))
+            return row[1]
+
+    def count(self, key):
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM responses WHERE key = ? AND created >= ?", (key, time.time() - self.ttl)).fetchone()[0]
+
+class OpeningQuestionPool:
+    """属性ごとに最初の質問を OPENING_POOL_SIZE 個ずつ作り置き、使ったら裏で補充する。
+    作り置きは利用者全員で共有するので、補充にはサーバー側のキーだけを使う（なければ補充しない）。"""
+    def __init__(self, store, size, api_key):
+        self.store = store
+        self.size = size
+        self.api_key = api_key
+        self.lock = threading.Lock()
+        self.refilling = set()
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="opening")
+
+    def _key(self, main_attr):
+        # プロンプトを書き換えたら古い作り置きは使われないようにする
+        digest = hashlib.sha256((ORACLE_PERSONA + build_opening_prompt(main_attr)).encode()).hexdigest()[:12]
+        return f"{'test:' if TEST_MODE else ''}opening:{main_attr}:{digest}"
+
+    def take(self, main_attr):
+        return self.store.take(self._key(main_attr))
+
+    def refill(self, main_attr):
+        """足りない分をバックグラウンドで生成する。すでに補充中・サーバー側のキーがないときは何もしない。"""
+        if not self.api_key and not TEST_MODE: return
+        key = self._key(main_attr)
+        with self.lock:
+            if key in self.refilling: return
+            self.refilling.add(key)
+        self.executor.submit(self._refill, key, main_attr, self.api_key)
+
+    def _refill(self, key, main_attr, api_key):
+        try:
+            client = _get_client(api_key)
+            if client is None: return
+            contents = build_chat_contents([], build_opening_prompt(main_attr))
+            for _ in range(self.size - self.store.count(key)):
+                # 作り置きは利用者の呼び出しを優先し、枠が空いているときだけ作る
+                _, text = hedged_generate(client, contents, system_instruction=ORACLE_PERSONA,
+                                          admit=rate_limited(api_key, contents, ORACLE_PERSONA, block=False))
+                # 失敗時の定型文は作り置かない
+                if not text: break
+                self.store.put(key, text)
+        finally:
+            with self.lock:
+                self.refilling.discard(key)
+
+@st.cache_resource(show_spinner=False)
+def get_opening_pool():
+    if OPENING_CACHE_BACKEND == "sqlite":
+        store = SqliteResponseStore(OPENING_CACHE_PATH, OPENING_CACHE_TTL_SEC, OPENING_CACHE_MAX_ENTRIES)
+    else:
+        store = MemoryResponseStore(OPENING_CACHE_TTL_SEC, OPENING_CACHE_MAX_ENTRIES)
+    return OpeningQuestionPool(store, OPENING_POOL_SIZE, get_server_api_key())
+
+# --- セッションの保存（複数プロセス・再起動をまたいで再開する） ---
+SESSION_FORMAT_VERSION = 1
+SESSION_TOKEN_RE = re.compile(r"[A-Za-z0-9_-]{16,64}")
+
+def encode_session(state):
+    """セッションを小さなバイト列にする。回答は質問順の選択肢番号、会話は (0=相談者/1=占い師, 本文) の組。"""
+    payload = {
+        "v": SESSION_FORMAT_VERSION,
+        "s": state.get("step", 0),
+        "a": encode_answers(state.get("answers", {})).tolist(),
+        "c": [[0 if m["role"] == "user" else 1, m["content"][:SESSION_MAX_TURN_CHARS]] for m in state.get("chat_history", [])],
+        # 定型文の結果は保存しない（復元したときに作り直す）
+        "r": None if state.get("result_failed") else state.get("dynamic_result"),
+        "f": "" if state.get("result_failed") else state.get("final_advice", ""),
+    }
+    return zlib.compress(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+def decode_session(data):
+    """encode_session() の逆。形式が違う・壊れているときは None"""
+    try:
+        payload = json.loads(zlib.decompress(data))
+    except (zlib.error, ValueError):
+        return None
+    if payload.get("v") != SESSION_FORMAT_VERSION: return None
+    answers = {}
+    for q, i in zip(QUESTIONS, payload["a"]):
+        options = list(q["options"])
+        if 0 <= i < len(options):
+            answers[q["id"]] = options[i]
+    return {
+        "step": payload["s"],
+        "answers": answers,
+        "chat_history": [{"role": "user" if role == 0 else "assistant", "content": text} for role, text in payload["c"]],
+        "dynamic_result": payload["r"],
+        "final_advice": payload["f"],
+    }
+
+class MemorySessionStore:
+    """プロセス内のTTL付きLRU。1プロセスで動かすとき用"""
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # トークン -> (データ, 更新時刻)
+
+    def get(self, token):
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is None: return None
+            if time.time() - entry[1] > self.ttl:
+                del self.entries[token]
+                return None
+            return entry[0]
+
+    def put(self, token, data):
+        with self.lock:
+            self.entries[token] = (data, time.time())
+            self.entries.move_to_end(token)
+            now = time.time()
+            while self.entries:
+                oldest, (_, updated) = next(iter(self.entries.items()))
+                if len(self.entries) <= self.max_entries and now - updated <= self.ttl: break
+                del self.entries[oldest]
+
+    def delete(self, token):
+        with self.lock:
+            self.entries.pop(token, None)
+
+class SqliteSessionStore:
+    """SQLiteファイルに置く。同じディスクを見るプロセス同士と再起動後で共有できる"""
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        with closing(self._connect()) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions (token TEXT PRIMARY KEY, data BLOB NOT NULL, updated REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def get(self, token):
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT data FROM sessions WHERE token = ? AND updated >= ?", (token, time.time() - self.ttl)).fetchone()
+        return row[0] if row else None
+
+    def put(self, token, data):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO sessions (token, data, updated) VALUES (?, ?, ?)", (token, data, time.time()))
+            conn.execute("DELETE FROM sessions WHERE updated < ?", (time.time() - self.ttl,))
+
+    def delete(self, token):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM sessions WHERE token = ?", (token,))
+
+class RedisSessionStore:
+    """Redisプロトコルのサーバー（Redis本体や互換の代替サーバー）に置く。期限切れはサーバー側で消える"""
+    def __init__(self, url, ttl, prefix="fortune:session:"):
+        import redis
+        self.client = redis.Redis.from_url(url, socket_timeout=2, socket_connect_timeout=2)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, token):
+        return self.client.get(self.prefix + token)
+
+    def put(self, token, data):
+        self.client.set(self.prefix + token, data, ex=int(self.ttl))
+
+    def delete(self, token):
+        self.client.delete(self.prefix + token)
+
+@st.cache_resource(show_spinner=False)
+def get_session_store():
+    if SESSION_BACKEND == "redis":
+        return RedisSessionStore(SESSION_REDIS_URL, SESSION_TTL_SEC)
+    if SESSION_BACKEND == "sqlite":
+        return SqliteSessionStore(SESSION_DB_PATH, SESSION_TTL_SEC)
+    return MemorySessionStore(SESSION_TTL_SEC, SESSION_MAX_ENTRIES)
+
+def restore_session():
+    """URLのトークンで保存済みのセッションを読み込む。なければ新しいトークンを発行する。"""
+    token = st.query_params.get("s")
+    if token and SESSION_TOKEN_RE.fullmatch(token):
+        try:
+            data = get_session_store().get(token)
+        except Exception:
+            data = None  # 保存先に届かなくても診断自体は続けられるようにする
+        saved = decode_session(data) if data else None
+        if saved:
+            st.session_state.update(saved)
+            st.session_state.session_token = token
+            st.session_state.session_saved = hashlib.sha256(data).digest()
+            return
+    st.session_state.session_token = secrets.token_urlsafe(16)
+    st.query_params["s"] = st.session_state.session_token
+
+def save_session():
+    """中身が変わっていれば保存する。トップ画面だけ見て帰った人は保存しない。"""
+    if st.session_state.get("step", 0) == 0 or "session_token" not in st.session_state: return
+    data = encode_session(st.session_state)
+    digest = hashlib.sha256(data).digest()
+    if st.session_state.get("session_saved") == digest: return
+    try:
+        get_session_store().put(st.session_state.session_token, data)
+        st.session_state.session_saved = digest
+    except Exception:
+        pass  # 次の保存で再試行する
+
+def reset_session():
+    """最初からやり直す。保存済みのセッションも消して新しいトークンにする"""
+    token = st.session_state.get("session_token")
+    if token:
+        try:
+            get_session_store().delete(token)
+        except Exception:
+            pass
+    st.session_state.clear()
+    st.query_params.pop("s", None)
+
+# --- 結果生成（STEP3） ---
+# 内側でヘッジ呼び出しを使うので get_oracle_pool() とは別のプールで動かす
+@st.cache_resource(show_spinner=False)
+def get_result_pool():
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="result")
+
+class ResultJobTable:
+    """結果生成ジョブの状態と結果を (セッション, 回答と会話のハッシュ, 種類) ごとに置くSQLiteの表。
+    同じディスクを見るプロセス同士と再起動後で共有できる。状態は running → done / failed。"""
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS result_jobs (
+                session TEXT NOT NULL, key TEXT NOT NULL, kind TEXT NOT NULL,
+                state TEXT NOT NULL, worker TEXT NOT NULL, result TEXT, error TEXT,
+                created REAL NOT NULL, updated REAL NOT NULL,
+                PRIMARY KEY (session, key, kind))""")
+            conn.execute("CREATE INDEX IF NOT EXISTS result_jobs_updated ON result_jobs (updated)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def claim(self, job, worker, stale_after):
+        """job を引き受けられるか調べる。("done", 結果) / ("running", None)（他が実行中）/
+        ("claimed", None)（未実行・失敗・止まっていたので worker が実行中にした）のどれかを返す"""
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM result_jobs WHERE updated < ?", (now - self.ttl,))
+            row = conn.execute("SELECT state, result, updated FROM result_jobs WHERE session = ? AND key = ? AND kind = ?", job).fetchone()
+            if row and row[0] == "done":
+                return "done", json.loads(row[1])
+            if row and row[0] == "running" and row[2] >= now - stale_after:
+                return "running", None
+            conn.execute("INSERT OR REPLACE INTO result_jobs (session, key, kind, state, worker, created, updated) "
+                         "VALUES (?, ?, ?, 'running', ?, ?, ?)", (*job, worker, now, now))
+            return "claimed", None
+
+    def finish(self, job, worker, result=None, error=None):
+        # 止まったとみなされて他に引き取られていたら、そちらの記録を上書きしない
+        with closing(self._connect()) as conn, conn:
+            conn.execute("UPDATE result_jobs SET state = ?, result = ?, error = ?, updated = ? "
+                         "WHERE session = ? AND key = ? AND kind = ? AND worker = ?",
+                         ("failed" if error else "done", None if error else json.dumps(result, ensure_ascii=False),
+                          error, time.time(), *job, worker))
+
+    def heartbeat(self, worker):
+        """worker が実行中のジョブに、まだ動いている印を付ける"""
+        with closing(self._connect()) as conn, conn:
+            conn.execute("UPDATE result_jobs SET updated = ? WHERE worker = ? AND state = 'running'", (time.time(), worker))
+
+    def counts(self):
+        with closing(self._connect()) as conn:
+            return dict(conn.execute("SELECT state, COUNT(*) FROM result_jobs GROUP BY state").fetchall())
+
+class ResultJobRunner:
+    """結果生成ジョブをプロセス内のスレッドプールで動かし、状態と結果を ResultJobTable に残す。
+    同じジョブの投入は1つにまとめる: このプロセスで動いていればそのFutureを返し、終わっていれば表の結果を、
+    他のプロセスが動かしていれば表を見に行って終わるのを待つFutureを返す（止まっていたら引き取って実行する）。
+    表を見に行くのはプールとは別の1本のスレッドで、待っているだけのジョブでプールの枠を使わない。"""
+    def __init__(self, table, pool):
+        self.table = table
+        self.pool = pool
+        self.worker = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(3)}"
+        self.lock = threading.Lock()
+        self.futures = {}  # (session, key, kind) -> Future（終わるまで）
+        self.following = {}  # 他のプロセスが実行中のジョブ -> (Future, fn, args)
+        self.counts = {"started": 0, "attached": 0, "finished": 0, "followed": 0, "failed": 0}
+        threading.Thread(target=self._heartbeat_loop, name="result-heartbeat", daemon=True).start()
+        threading.Thread(target=self._follow_loop, name="result-follow", daemon=True).start()
+
+    def submit(self, job, fn, *args):
+        """job = (セッション, 回答と会話のハッシュ, 種類)。fn(*args) の結果を受け取れるFutureを返す"""
+        with self.lock:
+            future = self.futures.get(job)
+            if future is not None:
+                self.counts["attached"] += 1
+                return future
+            # 表を見ている間に来た同じジョブの投入も、このFutureにつなぐ
+            future = self.futures[job] = Future()
+        future.add_done_callback(lambda f: self._forget(job, f))
+        # 表のロック待ち（最大で接続のtimeout）の間も他のジョブの投入を止めないよう、lock の外で引き受ける
+        try:
+            state, result = self.table.claim(job, self.worker, RESULT_JOB_STALE_SEC)
+        except sqlite3.Error:
+            state, result = "claimed", None  # 表に届かなくても、このプロセスでは結果を作る
+        if state == "done":
+            self._count("finished")
+            future.set_result(result)
+        elif state == "claimed":
+            self._count("started")
+            self.pool.submit(self._run, job, future, fn, args)
+        else:
+            self._count("followed")
+            with self.lock:
+                self.following[job] = (future, fn, args)
+        return future
+
+    def _count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def _run(self, job, future, fn, args):
+        try:
+            result = fn(*args)
+        except Exception as e:
+            self._count("failed")
+            self._finish(job, error=repr(e))
+            future.set_exception(e)
+            return
+        self._finish(job, result=result)
+        future.set_result(result)
+
+    def _finish(self, job, result=None, error=None):
+        try:
+            self.table.finish(job, self.worker, result, error)
+        except sqlite3.Error:
+            pass  # 記録できなくても、待っている画面にはFutureで結果を返せる
+
+    def _follow_loop(self):
+        while True:
+            time.sleep(RESULT_JOB_POLL_SEC)
+            with self.lock:
+                following = list(self.following.items())
+            for job, (future, fn, args) in following:
+                try:
+                    state, result = self.table.claim(job, self.worker, RESULT_JOB_STALE_SEC)
+                except sqlite3.Error:
+                    state, result = "claimed", None
+                if state == "running": continue
+                with self.lock:
+                    del self.following[job]
+                if state == "done":
+                    future.set_result(result)
+                else:
+                    self.pool.submit(self._run, job, future, fn, args)  # 止まっていたので引き取る
+
+    def _forget(self, job, future):
+        # 終わったジョブは表から受け取れるので、Futureは手放す
+        with self.lock:
+            if self.futures.get(job) is future:
+                del self.futures[job]
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(RESULT_JOB_HEARTBEAT_SEC)
+            if not self.futures: continue
+            try:
+                self.table.heartbeat(self.worker)
+            except sqlite3.Error:
+                pass
+
+    def metrics(self):
+        with self.lock:
+            report = {"running_here": len(self.futures) - len(self.following), "following": len(self.following), **self.counts}
+        try:
+            report["table"] = self.table.counts()
+        except sqlite3.Error:
+            report["table"] = None
+        return report
+
+@st.cache_resource(show_spinner=False)
+def get_result_job_runner():
+    return ResultJobRunner(ResultJobTable(RESULT_JOB_DB_PATH, RESULT_JOB_TTL_SEC), get_result_pool())
+
+class OracleUnavailable(RuntimeError):
+    """結果生成が定型文（モデルから応答が得られなかったときの文言）で終わった"""
+
+def generate_result(fn, *args):
+    """結果生成ジョブの本体。定型文は failed として表に残し、done として使い回さない（次の投入で作り直す）"""
+    result = fn(*args)
+    if result == ANALYSIS_FALLBACK or result == ORACLE_FALLBACK_TEXT:
+        raise OracleUnavailable(fn.__name__)
+    return result
+
+class AnalysisStats:
+    """強み分析JSONの解析成功率と修復回数"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {"total": 0, "parsed": 0, "repaired": 0, "failed": 0, "unavailable": 0}
+
+    def add(self, outcome):
+        with self.lock:
+            self.counts["total"] += 1
+            self.counts[outcome] += 1
+
+    def metrics(self):
+        with self.lock:
+            c = dict(self.counts)
+        ok = c["parsed"] + c["repaired"]
+        # 応答が得られなかった回は解析の成否に含めない
+        answered = c["total"] - c["unavailable"]
+        c["success_rate"] = round(ok / answered, 3) if answered else None
+        return c
+
+@st.cache_resource(show_spinner=False)
+def get_analysis_stats():
+    return AnalysisStats()
+
+def validate_analysis(obj):
+    """ANALYSIS_SCHEMA どおりか確かめ、表示用に整えたdictを返す。合わなければ ValueError"""
+    if not isinstance(obj, dict):
+        raise ValueError("JSONオブジェクトではありません")
+    result = {}
+    for key in ("skills", "jobs"):
+        items = obj.get(key)
+        if not isinstance(items, list) or not items or not all(isinstance(x, str) and x.strip() for x in items):
+            raise ValueError(f"{key} は空でない文字列の配列である必要があります")
+        result[key] = [x.strip() for x in items]
+    desc = obj.get("desc")
+    if not isinstance(desc, str) or not desc.strip():
+        raise ValueError("desc は空でない文字列である必要があります")
+    result["desc"] = desc.strip()
+    return result
+
+def parse_analysis(res):
+    """JSONモードの応答を検証する。前後に余計な文字が付いていても {...} 部分を拾う。"""
+    try:
+        return validate_analysis(json.loads(res))
+    except ValueError:
+        match = re.search(r'\{.*\}', res, re.DOTALL)
+        if not match: raise
+        return validate_analysis(json.loads(match.group(0)))
+
+def run_analysis(api_key, history):
+    with span("analysis") as attrs:
+        result, outcome = _run_analysis(api_key, history)
+        attrs["outcome"] = outcome
+    get_analysis_stats().add(outcome)
+    return result
+
+def _run_analysis(api_key, history):
+    """(結果, "parsed" / "repaired" / "failed" / "unavailable") を返す"""
+    res = get_gemini_response(build_analysis_prompt(history), api_key, generation_config=ANALYSIS_CONFIG)
+    if res == ORACLE_FALLBACK_TEXT:
+        # モデル全滅や流量制限で断られた定型文は直しようがないので、修復の呼び出しはしない
+        return dict(ANALYSIS_FALLBACK), "unavailable"
+    try:
+        return parse_analysis(res), "parsed"
+    except ValueError as e:
+        error = e
+
+    # 会話全体は送り直さず、壊れた出力だけを1回だけ直させる
+    fixed = get_gemini_response(build_repair_prompt(res, error), api_key, generation_config=ANALYSIS_CONFIG)
+    try:
+        return parse_analysis(fixed), "repaired"
+    except ValueError:
+        return dict(ANALYSIS_FALLBACK), "failed"
+
+def start_result_jobs(api_key, history, r_type):
+    """強み分析とアドバイスをジョブとして同時に投げ、待つためのFutureをセッションに保持する。
+    同じ回答と会話のジョブがあれば（再読み込みで画面のセッションが変わっても）投げ直さずにそれを待つ。"""
+    key = hashlib.sha256(json.dumps([st.session_state.get("answers", {}), history], ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+    jobs = st.session_state.get("result_jobs")
+    if jobs and jobs["key"] == key:
+        return jobs
+
+    history = [dict(m) for m in history]
+    card_title = CARDS.get(r_type, CARDS["fire"])["title"]
+    # ジョブは再読み込みをまたいで変わらない ?s= のトークンでまとめる。トークンは URL に入れればセッションを
+    # 開ける値なので、流量制限の行列やスパンに残す呼び出し元にはその一方向ハッシュを使う
+    token = st.session_state.get("session_token")
+    session = token or current_owner()
+    owner = hashlib.sha256(token.encode()).hexdigest()[:16] if token else session
+    runner = get_result_job_runner()
+    jobs = {
+        "key": key,
+        "owner": owner,
+        "analysis": runner.submit((session, key, "analysis"), run_as, owner, generate_result, run_analysis, api_key, history),
+        "advice": runner.submit((session, key, "advice"), run_as, owner, generate_result, get_gemini_response,
+                                build_advice_prompt(history, card_title), api_key, ORACLE_PERSONA),
+    }
+    st.session_state.result_jobs = jobs
+    return jobs
+
+def take_result(future, fallback):
+    """ジョブの結果を受け取る。終わっていない・定型文で終わっていたら fallback を返し、やり直せるよう印を付ける"""
+    try:
+        return future.result(timeout=0)
+    except TimeoutError:
+        st.session_state.result_failed = True
+        return fallback
+    except Exception as e:
+        # ジョブは前の実行で投げたものもあり、再実行ごとにクラスが作り直されるので名前で見分ける
+        if type(e).__name__ != "OracleUnavailable": raise
+        st.session_state.result_failed = True
+        return fallback
+
+def retry_result():
+    """定型文で終わった結果を捨てて、STEP3の結果生成をやり直す"""
+    st.session_state.dynamic_result = None
+    st.session_state.final_advice = ""
+    st.session_state.pop("result_jobs", None)
+    st.session_state.pop("result_failed", None)
+
+def encode_answers(answers):
+    """{質問ID: 選択肢テキスト} を質問順の選択肢番号の配列にする（未回答・不明な選択肢は -1）"""
+    idx = np.full(len(QUESTIONS), -1, dtype=np.int8)
+    for q_id, val in answers.items():
+        i = QUESTION_INDEX.get(q_id)
+        if i is not None:
+            idx[i] = OPTION_INDEX[i].get(val, -1)
+    return idx
+
+def score_batch(answer_idx):
+    """encode_answers() の結果を縦に積んだ (人数, 質問数) 配列をまとめて採点する。
+    属性スコア (人数, 3)・レーダー軸 (人数, 5)・タイプ名・主属性のリストを返す。"""
+    answer_idx = np.atleast_2d(answer_idx)
+    answered = answer_idx >= 0
+    picked = OPTION_MATRIX[np.arange(len(QUESTIONS)), np.where(answered, answer_idx, 0)]
+    scores = (picked * answered[..., None]).sum(axis=1)
+    radar = scores @ RADAR_MATRIX
+
+    # 同点は ELEMENTS の並び順を優先（旧実装の sorted と同じ）
+    order = np.argsort(-scores, axis=1, kind="stable")
+    rows = np.arange(len(scores))
+    t1, t2 = order[:, 0], order[:, 1]
+    gap = scores[rows, t1] - scores[rows, t2]
+    types = []
+    for a, b, g in zip(t1, t2, gap):
+        if g >= 2:
+            types.append(ELEMENTS[a])
+        else:
+            n1, n2 = ELEMENTS[a], ELEMENTS[b]
+            types.append(f"{min(n1, n2)}-{max(n1, n2)}")
+    return {"scores": scores, "radar": radar, "types": types, "main": [ELEMENTS[a] for a in t1]}
+
+def score_answers(answers):
+    """1人分の採点結果（属性スコア・タイプ・主属性・レーダー軸）"""
+    res = score_batch(encode_answers(answers))
+    return {
+        "scores": dict(zip(ELEMENTS, res["scores"][0].tolist())),
+        "type": res["types"][0],
+        "main": res["main"][0],
+        "radar": res["radar"][0].tolist(),
+    }
+
+def get_score():
+    """セッションの回答の採点結果。回答が変わらない限り再計算しない。"""
+    key = tuple(sorted(st.session_state.answers.items()))
+    cached = st.session_state.get("score_cache")
+    if cached is None or cached[0] != key:
+        cached = (key, score_answers(st.session_state.answers))
+        st.session_state.score_cache = cached
+    return cached[1]
+
+def calculate_type():
+    score = get_score()
+    return score["type"], score["main"]
+
+# --- レーダーチャート（STEP3） ---
+# 10問×3択なのでスコアの組は限られる。組ごとに1度だけ作って使い回す
+def radar_key(radar):
+    return tuple(round(float(v), 3) for v in radar)
+
+@st.cache_resource(show_spinner=False, max_entries=512)
+def build_radar_figure(key):
+    """スコアの組ごとのplotlyの図（描画側で書き換えないこと）。共有できるのは図の組み立てまでで、
+    st.plotly_chart は再実行のたびに図をJSONにして送るので、既定は送る量の少ないSVGにしている。"""
+    import plotly.graph_objects as go
+    vals = list(key) + [key[0]]
+    fig = go.Figure(data=go.Scatterpolar(r=vals, theta=RADAR_AXES + RADAR_AXES[:1], fill='toself', line_color='#FFD700'))
+    fig.update_layout(
+        paper_bgcolor='rgba(0,0,0,0)',
+        plot_bgcolor='rgba(0,0,0,0)',
+        polar=dict(
+            bgcolor='rgba(0,0,0,0.5)',
+            radialaxis=dict(visible=True, range=[0, 10], showticklabels=False),
+            angularaxis=dict(tickfont=dict(color='white', size=16))
+        ),
+        margin=dict(l=40, r=40, t=40, b=40),
+        height=400
+    )
+    return fig
+
+@st.cache_data(show_spinner=False, max_entries=512)
+def build_radar_svg(key, size=400):
+    """plotly.js を使わない軽量版。plotlyと同じく最初の軸を真上に置き、反時計回りに並べる。"""
+    n = len(RADAR_AXES)
+    c, r_max = size / 2, size / 2 - 60
+
+    def point(i, value):
+        angle = np.pi / 2 + 2 * np.pi * i / n
+        r = r_max * min(max(value, 0), 10) / 10
+        return c + r * np.cos(angle), c - r * np.sin(angle)
+
+    def polygon(values):
+        return " ".join(f"{x:.1f},{y:.1f}" for x, y in (point(i, v) for i, v in enumerate(values)))
+
+    parts = [f'<polygon points="{polygon([10] * n)}" fill="rgba(0,0,0,0.5)"/>']
+    for level in (2.5, 5, 7.5, 10):
+        parts.append(f'<polygon points="{polygon([level] * n)}" fill="none" stroke="rgba(255,255,255,0.25)"/>')
+    for i, label in enumerate(RADAR_AXES):
+        x, y = point(i, 10)
+        parts.append(f'<line x1="{c}" y1="{c}" x2="{x:.1f}" y2="{y:.1f}" stroke="rgba(255,255,255,0.25)"/>')
+        lx, ly = point(i, 11.5)
+        anchor = "middle" if abs(lx - c) < 1 else ("start" if lx > c else "end")
+        parts.append(f'<text x="{lx:.1f}" y="{ly:.1f}" fill="white" font-size="16" text-anchor="{anchor}" dominant-baseline="middle">{label}</text>')
+    parts.append(f'<polygon points="{polygon(key)}" fill="rgba(255,215,0,0.5)" stroke="#FFD700" stroke-width="2"/>')
+    return (f'<div style="max-width:{size}px; margin:auto;">'
+            f'<svg viewBox="0 0 {size} {size}" width="100%" style="font-family:var(--jp-font);">{"".join(parts)}</svg></div>')
+
+def render_radar_chart(radar):
+    key = radar_key(radar)
+    if st.query_params.get("chart", RADAR_CHART_MODE) == "plotly":
+        st.plotly_chart(build_radar_figure(key), width="stretch")
+    else:
+        st.markdown(build_radar_svg(key), unsafe_allow_html=True)
+
+def create_result_html(card_data, dynamic_data, final_advice, img_base64):
+    try:
+        # ローカル画像がない場合はWebのプレースホルダーを使用（URL形式に修正済み）
+        if img_base64:
+            img_src = f"data:image/jpeg;base64,{img_base64}"
+        else:
+            img_src = "https://placehold.co/400x400/1a0f2e/FFD700?text=Fortune+Card"
+
+        return f"""
+        <html>
+        <body style="background:#050510; color:#E0E0E0; font-family:serif; text-align:center; padding:20px;">
+            <div style="border:4px double #FFD700; padding:40px; background:#1a0f2e; border-radius:20px;">
+                <h1 style="color:#FFD700; font-family:serif;">{card_data['title']}</h1>
+                <img src="{img_src}" style="width:200px; border-radius:10px; border:2px solid #FFD700; margin: 15px 0;">
+                <h3 style="color:#FFF;">“{dynamic_data.get('desc','')}”</h3>
+                <div style="text-align:left; background:rgba(255,255,255,0.1); padding:20px; border-radius:10px;">
+                    <p><b>適職:</b> {', '.join(dynamic_data['jobs'])}</p>
+                    <p><b>助言:</b> {final_advice}</p>
+                </div>
+            </div>
+        </body>
+        </html>
+        """
+    except: return "<html><body>Error</body></html>"
+
+# --- 鑑定書の書き出し（STEP3） ---
+# 保存ボタンが押されたときだけ作る（画面には載せない）。PDFは同梱のIPAexフォントで描く
+@st.cache_resource(show_spinner=False)
+def get_export_pool():
+    return ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export")
+
+class ExportCache:
+    """書き出した鑑定書を (形式, タイプ, 分析結果のハッシュ, 助言のハッシュ) ごとに保持する。
+    生成はワーカープールで行い、同じ鑑定書への同時リクエストは1回の生成を待ち合わせる。"""
+    def __init__(self, pool, max_entries):
+        self.pool = pool
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> Future
+
+    def get(self, key, builder, *args):
+        with self.lock:
+            future = self.entries.get(key)
+            if future is None or (future.done() and future.exception() is not None):
+                future = self.pool.submit(builder, *args)
+                self.entries[key] = future
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return future.result(timeout=EXPORT_TIMEOUT_SEC)
+
+@st.cache_resource(show_spinner=False)
+def get_export_cache():
+    return ExportCache(get_export_pool(), EXPORT_CACHE_MAX_ENTRIES)
+
+def export_key(fmt, r_type, dynamic_data, final_advice):
+    def digest(value):
+        return hashlib.sha256(json.dumps(value, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return (fmt, r_type, digest(dynamic_data), digest(final_advice))
+
+def _card_image_path(card_data):
+    path = os.path.join(SCRIPT_DIR, card_data['file'])
+    return path if os.path.exists(path) else None
+
+def build_result_html(card_data, dynamic_data, final_advice):
+    # 単体で開けるよう画像はbase64で埋め込む（スクリプトの外で動くので st.cache_data は使わない）
+    path = _card_image_path(card_data)
+    img_b64 = None
+    if path:
+        with open(path, "rb") as f:
+            img_b64 = base64.b64encode(f.read()).decode()
+    return create_result_html(card_data, dynamic_data, final_advice, img_b64)
+
+def _pdf_font_path():
+    return os.path.join(FONT_DIR, PDF_FONT_FILE)
+
+@st.cache_resource(show_spinner=False)
+def pdf_export_available():
+    """fpdf2 と IPAexフォントが揃っているときだけPDFの保存ボタンを出す"""
+    try:
+        import fpdf  # noqa: F401
+    except ImportError:
+        return False
+    return os.path.exists(_pdf_font_path())
+
+def build_result_pdf(card_data, dynamic_data, final_advice):
+    from fpdf import FPDF
+    gold, text = (255, 215, 0), (224, 224, 224)
+    pdf = FPDF(format="A4")
+    pdf.set_auto_page_break(True, margin=20)
+    pdf.add_font("IPAexGothic", fname=_pdf_font_path())
+    pdf.set_page_background((26, 15, 46))  # 助言が長くて2ページ目に入っても背景をそろえる
+    pdf.add_page()
+    pdf.set_draw_color(*gold)
+    pdf.set_line_width(1.2)
+    pdf.rect(10, 10, pdf.w - 20, pdf.h - 20)
+
+    pdf.set_y(24)
+    pdf.set_font("IPAexGothic", size=24)
+    pdf.set_text_color(*gold)
+    pdf.cell(0, 14, card_data['title'], align="C", new_x="LMARGIN", new_y="NEXT")
+
+    path = _card_image_path(card_data)
+    if path:
+        pdf.image(path, x=(pdf.w - 60) / 2, y=pdf.get_y() + 4, w=60, h=60)
+        pdf.set_y(pdf.get_y() + 70)
+
+    pdf.set_font("IPAexGothic", size=14)
+    pdf.set_text_color(255, 255, 255)
+    pdf.multi_cell(0, 9, f"“{dynamic_data.get('desc', '')}”", align="C", new_x="LMARGIN", new_y="NEXT")
+    pdf.ln(6)
+
+    pdf.set_left_margin(22)
+    pdf.set_right_margin(22)
+    pdf.set_font("IPAexGothic", size=11)
+    pdf.set_text_color(*text)
+    advice = re.sub(r"<[^>]+>", "", final_advice or "")
+    for label, body in [("スキル", " / ".join(dynamic_data.get('skills', []))),
+                        ("適職", ", ".join(dynamic_data.get('jobs', []))),
+                        ("助言", advice)]:
+        pdf.set_text_color(*gold)
+        pdf.cell(0, 8, label, new_x="LMARGIN", new_y="NEXT")
+        pdf.set_text_color(*text)
+        pdf.multi_cell(0, 7, body, new_x="LMARGIN", new_y="NEXT")
+        pdf.ln(3)
+    return bytes(pdf.output())
+
+def render_metrics_page():
+    """?page=metrics で開く運用向けの簡易ページ（&format=prometheus でPrometheusのテキスト形式）。
+    誰でも見られるのは集計値だけで、個々の呼び出し・スパン・プロファイルは ?ops= を付けたときだけ出す。"""
+    if st.query_params.get("format") == "prometheus":
+        st.code(metrics_text(), language=None)
+        return
+    st.markdown('<div class="main-title">Oracle Metrics</div>', unsafe_allow_html=True)
+    report = {
+        "models": get_health_board().metrics(),
+        "analysis": get_analysis_stats().metrics(),
+        "rate_limit": get_rate_limiter().metrics(),
+        "result_jobs": get_result_job_runner().metrics(),
+    }
+    if not ops_access():
+        st.json(report)
+        return
+    profiles = list(get_profile_log())
+    report["recent"] = list(get_hedge_events())[-20:]
+    report["spans"] = list(get_tracer().recent)[-50:]
+    report["profiles"] = [{k: v for k, v in p.items() if k != "summary"} for p in profiles]
+    st.json(report)
+    if profiles:
+        st.code(profiles[-1]["summary"], language=None)
+
+# --- 画面の部品（fragmentとして個別に再実行される） ---
+def fragment(func):
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        # fragmentだけの再実行も1回の実行としてスパンに残す
+        with traced_run(f"fragment:{func.__name__}"):
+            return func(*args, **kwargs)
+    return st.fragment(run) if USE_FRAGMENTS else run
+
+def rerun_fragment():
+    """fragmentの再実行中ならそのfragmentだけを、アプリ全体の実行中ならアプリ全体を再実行する"""
+    ctx = get_script_run_ctx()
+    in_fragment_run = USE_FRAGMENTS and ctx is not None and bool(ctx.fragment_ids_this_run)
+    st.rerun(scope="fragment" if in_fragment_run else "app")
+
+@fragment
+def render_quiz_form(api_key):
+    with st.form("quiz"):
+        for q_data in QUESTIONS:
+            st.markdown(f"<h3 style='color:#FFD700; text-shadow:1px 1px 2px #000;'>{q_data['q']}</h3>", unsafe_allow_html=True)
+            st.radio("選択肢", list(q_data['options'].keys()), key=f"ans_{q_data['id']}", index=None, label_visibility="collapsed")
+
+        st.markdown("<div style='height: 40px;'></div>", unsafe_allow_html=True)
+
+        if st.form_submit_button("🔮 真実を明らかにする"):
+            valid = True
+            temp_ans = {}
+            for q in QUESTIONS:
+                val = st.session_state.get(f"ans_{q['id']}")
+                if val is None:
+                    valid = False
+                    break
+                temp_ans[q['id']] = val
+
+            if valid:
+                st.session_state.answers = temp_ans
+                # チャット画面を開く前に、この属性の作り置きを用意し始める
+                get_opening_pool().refill(calculate_type()[1])
+                st.session_state.step = 2
+                st.rerun()
+            else:
+                st.error("全ての問いに答えてください。")
+
+@fragment
+def render_chat_panel(api_key):
+    # 会話の1往復ごとにこのfragmentだけが再実行されるので、ここでも保存する
+    save_session()
+    _, main_attr = calculate_type()
+    opening = build_opening_prompt(main_attr)
+
+    for msg in st.session_state.chat_history:
+        icon = "🔮" if msg["role"] == "assistant" else "🧑‍🎓"
+        with st.chat_message(msg["role"], avatar=icon):
+            st.write(msg["content"])
+
+    # 最初の質問は作り置きがあればそれを使い、なければ届いた分から順に表示する
+    if not st.session_state.chat_history:
+        opening_pool = get_opening_pool()
+        with st.chat_message("assistant", avatar="🔮"):
+            reply = opening_pool.take(main_attr)
+            if reply:
+                st.write(reply)
+            else:
+                reply = st.write_stream(stream_gemini_response(build_chat_contents([], opening), api_key, ORACLE_PERSONA))
+        st.session_state.chat_history.append({"role": "assistant", "content": reply})
+        opening_pool.refill(main_attr)
+
+    user_count = len([m for m in st.session_state.chat_history if m["role"] == "user"])
+
+    if user_count < MAX_TURN_COUNT:
+        if val := st.chat_input("回答を入力..."):
+            st.session_state.chat_history.append({"role": "user", "content": val})
+            with st.chat_message("user", avatar="🧑‍🎓"):
+                st.write(val)
+
+            instruction = CLOSING_INSTRUCTION if user_count + 1 >= MAX_TURN_COUNT else FOLLOW_UP_INSTRUCTION
+            contents = build_chat_contents(st.session_state.chat_history, opening, instruction)
+
+            with st.chat_message("assistant", avatar="🔮"):
+                reply = st.write_stream(stream_gemini_response(contents, api_key, ORACLE_PERSONA))
+            st.session_state.chat_history.append({"role": "assistant", "content": reply})
+            if user_count + 1 >= MAX_TURN_COUNT:
+                # 結果画面に進む前に分析とアドバイスの生成を始めておく
+                start_result_jobs(api_key, st.session_state.chat_history, calculate_type()[0])
+            rerun_fragment()
+    else:
+        st.success("運命の結果が出ました。")
+        if st.button("📜 運命の書を開く"): st.session_state.step = 3; st.rerun()
+
+@fragment
+def render_result_actions(card_data, r_type):
+    # 鑑定書はボタンが押されたときに作る（data に関数を渡すとクリック時に別スレッドで呼ばれる）
+    d_res, advice = st.session_state.dynamic_result, st.session_state.final_advice
+    cache = get_export_cache()
+
+    def html_data():
+        return cache.get(export_key("html", r_type, d_res, advice), build_result_html, card_data, d_res, advice)
+
+    def pdf_data():
+        return cache.get(export_key("pdf", r_type, d_res, advice), build_result_pdf, card_data, d_res, advice)
+
+    st.download_button("📄 鑑定書を保存", data=html_data, file_name="result.html", mime="text/html", on_click="ignore")
+    if pdf_export_available():
+        st.download_button("📕 PDFで保存", data=pdf_data, file_name="result.pdf", mime="application/pdf", on_click="ignore")
+    if st.button("↩️ 戻る"): reset_session(); st.rerun()
+
+# --- メイン処理 ---
+def main():
+    # ページ設定（batch.py などから import したときに画面まわりの処理が走らないよう main() の中で行う）
+    st.set_page_config(
+        page_title="FORTUNE CAREER",
+        page_icon="🔮",
+        layout="wide",
+        initial_sidebar_state="collapsed"
+    )
+    start_metrics_exporter()
+
+    if st.query_params.get("page") == "metrics":
+        render_metrics_page()
+        return
+
+    if "session_token" not in st.session_state: restore_session()
+    if "step" not in st.session_state: st.session_state.step = 0
+    if "answers" not in st.session_state: st.session_state.answers = {}
+    if "chat_history" not in st.session_state: st.session_state.chat_history = []
+    if "dynamic_result" not in st.session_state: st.session_state.dynamic_result = None
+    if "final_advice" not in st.session_state: st.session_state.final_advice = ""
+
+    api_key = get_api_key()
+    
+    # 背景切り替えロジック（静的配信が使えればURL参照、なければbase64埋め込み）
+    if st.session_state.step == 0:
+        bg_css = get_background_css("mansion.jpg", URL_BG_MANSION)
+    else:
+        bg_css = get_background_css("room.jpg", URL_BG_ROOM)
+    
+    apply_custom_css(bg_css)
+
+    # --- STEP 0: トップ ---
+    if st.session_state.step == 0:
+        st.markdown('<div class="main-title">FORTUNE CAREER</div>', unsafe_allow_html=True)
+        st.markdown('<div style="text-align:center; margin-bottom:40px;">〜 学生のためのAI職業診断 〜</div>', unsafe_allow_html=True)
+        
+        col1, col2, col3 = st.columns([1, 2, 1])
+        with col2:
+            st.markdown("""
+            <div class="intro-box">
+                ようこそ、迷える若き魂よ。<br>
+                ここは星々の導きと、就活の叡智が交わる場所。<br>
+                あなたの真の才能と、未来のキャリアを紐解いて進ぜよう。
+            </div>
+            """, unsafe_allow_html=True)
+            if st.button("🚪 運命の扉を開く"):
+                if not api_key and not TEST_MODE:
+                    st.error("左のサイドバーからAPIキーを入力してください")
+                else:
+                    st.session_state.step = 1
+                    st.rerun()
+        # 画面を返し終えてから、STEP2・3で使うライブラリを先読みする
+        start_warmup()
+
+    # --- STEP 1: 質問 ---
+    elif st.session_state.step == 1:
+        st.markdown('<div class="main-title">The 10 Prophecies</div>', unsafe_allow_html=True)
+        st.markdown('<p style="text-align:center; color:#DDD; font-size:1.2rem;">そなたの価値観について、10の問いに答えよ…</p>', unsafe_allow_html=True)
+        
+        col1, col2, col3 = st.columns([1, 3, 1])
+        with col2:
+            render_quiz_form(api_key)
+
+    # --- STEP 2: チャット ---
+    elif st.session_state.step == 2:
+        st.markdown('<div class="main-title">Talk with Spirits</div>', unsafe_allow_html=True)
+        
+        col1, col2, col3 = st.columns([1, 3, 1])
+        with col2:
+            render_chat_panel(api_key)
+
+    # --- STEP 3: 結果 ---
+    elif st.session_state.step == 3:
+        # 演出は結果画面に入った最初の1回だけ
+        if not st.session_state.get("celebrated"):
+            st.balloons()
+            st.session_state.celebrated = True
+        st.markdown('<div class="main-title">Your Destiny Card</div>', unsafe_allow_html=True)
+        r_type, _ = calculate_type()
+        card_data = CARDS.get(r_type, CARDS["fire"])
+
+        if not st.session_state.dynamic_result:
+            with st.spinner("分析中..."):
+                # 多くの場合はSTEP2の最後の返信時点で投機的に開始済み
+                jobs = start_result_jobs(api_key, st.session_state.chat_history, r_type)
+                waited_from = time.time()
+                notice = st.empty()
+                while (wait([jobs["analysis"], jobs["advice"]], timeout=0.5).not_done
+                       and time.time() - waited_from < RESULT_WAIT_TIMEOUT_SEC):
+                    pos = get_rate_limiter().position(jobs["owner"])
+                    if pos:
+                        notice.info(RATE_LIMIT_NOTICE.format(pos=pos))
+                    else:
+                        notice.empty()
+                notice.empty()
+                # 結果画面で分析・アドバイスを待った時間（TTFTと同じく計測用に残す）
+                st.session_state.setdefault("result_wait_log", []).append(time.time() - waited_from)
+                st.session_state.dynamic_result = take_result(jobs["analysis"], dict(ANALYSIS_FALLBACK))
+                st.session_state.final_advice = take_result(jobs["advice"], ORACLE_FALLBACK_TEXT)
+
+        d_res = st.session_state.dynamic_result
+        col1, col2 = st.columns(2)
+        
+        with col1:
+            # 表示用画像（静的配信のURL参照。使えない環境ではbase64）
+            card_img = get_card_img_html(card_data['file'], "width:100%; border-radius:10px; margin:10px 0;")
+            
+            st.markdown(f"""
+            <div class="card-frame">
+                <div class="card-content">
+                    <h2 style="color:#FFD700;">{card_data['title']}</h2>
+                    {card_img}
+                    <p class="oracle-text" style="color:#FFF; font-weight:bold;">“{d_res.get('desc','')}”</p>
+                </div>
+            </div>
+            """, unsafe_allow_html=True)
+        
+        with col2:
+            render_radar_chart(get_score()["radar"])
+            
+            st.markdown(f"""
+            <div class="oracle-text" style="background:rgba(0,0,0,0.7); padding:20px; border-radius:10px; border:1px solid #FFD700; font-size:1.1rem;">
+                <p><b>🗝️ スキル:</b> {' / '.join(d_res.get('skills', []))}</p>
+                <p><b>💼 適職:</b> {' / '.join(d_res.get('jobs', []))}</p>
+            </div>
+            """, unsafe_allow_html=True)
+
+        st.markdown(f"<div class='advice-box'><h3>📜 Oracle's Message</h3>{st.session_state.final_advice}</div>", unsafe_allow_html=True)
+
+        if st.session_state.get("result_failed"):
+            st.warning("星々の声が一部届きませんでした。少し時間をおいて、もう一度占うことができます。")
+            if st.button("🔄 もう一度占う"): retry_result(); st.rerun()
+        
+        render_result_actions(card_data, r_type)
+
+    # ここまでの状態を保存しておく（別のプロセスや再起動後でも ?s= で続きから再開できる）
+    save_session()
+
+if __name__ == "__main__":
+    with traced_run("app"):
+        main()
@@ -0,0 +1,194 @@
+"""学生の回答ファイル（CSV / JSONL）をまとめて診断し、結果をJSONLに書き出す
+
+    python batch.py answers.csv results.jsonl                 # GEMINI_API_KEY の鍵で診断
+    python batch.py answers.jsonl results.jsonl --fake        # 疑似応答（TEST_MODE）でオフライン実行
+    python batch.py answers.csv results.jsonl --workers 32 --rpm 600
+
+入力は1行に1人。id 列（なければ行番号）と q1〜q10 の列を持つ。回答は選択肢の文言そのもの、
+または 1〜3 の番号で書ける。JSONL では {"id": ..., "answers": {"q1": ...}} の形で、
+"chat_history"（[{"role": "assistant"|"user", "content": ...}]）があれば分析の材料に加える。
+
+結果は1人終わるごとに追記する。途中で止まっても、同じ出力先を指定して実行し直せば
+書き出し済みの人を飛ばして続きから再開する。エラーになった人はやり直すが、回答が足りないなど
+やり直しても変わらないエラー（"permanent": true）は飛ばす。やり直した人の結果は後ろに追記されるので、
+出力を読む側は同じ id の行のうち最後の行をその人の結果として扱うこと。
+入力に同じ id が2回以上出てきたら、最初の行だけを診断する（以降は duplicate として数えて飛ばす）。
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+app = None  # 引数を読んでから import する（--fake は import 前に TEST_MODE を決める必要がある）
+
+
+def read_rows(path):
+    """入力を1行ずつ読む（ファイル全体は読み込まない）"""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if path.endswith(".jsonl"):
+            for n, line in enumerate(f, 1):
+                if not line.strip(): continue
+                row = json.loads(line)
+                row.setdefault("id", str(n))
+                yield row
+        else:
+            for n, row in enumerate(csv.DictReader(f), 1):
+                answers = {q["id"]: row.get(q["id"], "") for q in app.QUESTIONS}
+                yield {"id": row.get("id") or str(n), "answers": answers}
+
+
+def normalize_answers(raw):
+    """選択肢の番号(1始まり)も文言に直す。どの選択肢にも当たらない回答は未回答として扱う"""
+    answers = {}
+    for q in app.QUESTIONS:
+        val = str(raw.get(q["id"], "")).strip()
+        options = list(q["options"])
+        if val.isdigit() and 1 <= int(val) <= len(options):
+            val = options[int(val) - 1]
+        if val in q["options"]:
+            answers[q["id"]] = val
+    return answers
+
+
+def quiz_history(answers, chat_history=()):
+    """分析・アドバイスのプロンプトに渡す会話。チャットがなければ質問と回答をやり取りとして並べる"""
+    history = []
+    for q in app.QUESTIONS:
+        if q["id"] in answers:
+            history.append({"role": "assistant", "content": q["q"]})
+            history.append({"role": "user", "content": answers[q["id"]]})
+    return history + [dict(m) for m in chat_history]
+
+
+def diagnose(row, api_key):
+    """1人分: 採点 → 強み分析とアドバイス（アプリのSTEP3と同じプロンプト）"""
+    started = time.time()
+    answers = normalize_answers(row.get("answers", {}))
+    if len(answers) < len(app.QUESTIONS):
+        return {"id": row["id"], "error": f"回答が足りません（{len(answers)}/{len(app.QUESTIONS)}問）", "permanent": True}
+
+    score = app.score_answers(answers)
+    card = app.CARDS.get(score["type"], app.CARDS["fire"])
+    history = quiz_history(answers, row.get("chat_history", ()))
+    analysis = app.run_analysis(api_key, history)
+    advice = app.get_gemini_response(app.build_advice_prompt(history, card["title"]), api_key, app.ORACLE_PERSONA)
+    if analysis == app.ANALYSIS_FALLBACK or advice == app.ORACLE_FALLBACK_TEXT:
+        # 混雑やモデル障害で定型文になった結果は残さず、再開時にやり直す
+        return {"id": row["id"], "error": "モデルの応答が得られませんでした"}
+    return {
+        "id": row["id"],
+        "type": score["type"],
+        "title": card["title"],
+        "main": score["main"],
+        "scores": score["scores"],
+        "radar": [round(v, 3) for v in score["radar"]],
+        "analysis": analysis,
+        "advice": advice,
+        "seconds": round(time.time() - started, 3),
+    }
+
+
+def load_done(path):
+    """やり直さなくてよい人のID。同じ id の行は最後の行で判断し、成功かやり直しても変わらないエラーなら済みとする。
+    書きかけで壊れた最後の行は無視する"""
+    last = {}
+    if not os.path.exists(path): return set()
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            last[str(rec["id"])] = rec
+    return {rid for rid, rec in last.items() if "error" not in rec or rec.get("permanent")}
+
+
+def open_output(path):
+    out = open(path, "a+", encoding="utf-8")
+    # 中断で最後の行が改行なしで終わっていたら、次の結果がつながらないよう改行を入れる
+    out.seek(0, os.SEEK_END)
+    if out.tell() > 0:
+        out.seek(out.tell() - 1)
+        if out.read(1) != "\n":
+            out.write("\n")
+    return out
+
+
+def run(input_path, output_path, api_key, workers):
+    done = load_done(output_path)
+    counts = {"skipped": 0, "duplicate": 0, "ok": 0, "error": 0}
+    seen = set()
+    started = time.time()
+    with open_output(output_path) as out, ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch") as pool:
+        pending = set()
+
+        def drain(until):
+            # 終わった分から書き出し、処理中を until 件以下にする
+            nonlocal pending
+            while len(pending) > until:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for f in finished:
+                    rec = f.result()
+                    out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                    out.flush()
+                    counts["error" if "error" in rec else "ok"] += 1
+
+        for row in read_rows(input_path):
+            row_id = str(row["id"])
+            if row_id in seen:
+                counts["duplicate"] += 1
+                continue
+            seen.add(row_id)
+            if row_id in done:
+                counts["skipped"] += 1
+                continue
+            pending.add(pool.submit(safe_diagnose, row, api_key))
+            drain(workers * 2)
+        drain(0)
+    counts["seconds"] = round(time.time() - started, 1)
+    return counts
+
+
+def safe_diagnose(row, api_key):
+    try:
+        return diagnose(row, api_key)
+    except Exception as e:
+        return {"id": row["id"], "error": repr(e)}
+
+
+def main(argv=None):
+    global app
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input", help="回答ファイル（.csv / .jsonl）")
+    parser.add_argument("output", help="結果のJSONL（既存なら続きから再開）")
+    parser.add_argument("--workers", type=int, default=16, help="同時に診断する人数")
+    parser.add_argument("--fake", action="store_true", help="Geminiを呼ばず疑似応答で動かす（TEST_MODE）")
+    parser.add_argument("--api-key", default=os.environ.get("GEMINI_API_KEY"), help="省略時は環境変数 GEMINI_API_KEY")
+    parser.add_argument("--rpm", type=int, help="APIキーあたりの回数/分の上限（アプリの設定を上書き）")
+    parser.add_argument("--tpm", type=int, help="APIキーあたりのトークン数/分の上限（アプリの設定を上書き）")
+    args = parser.parse_args(argv)
+
+    if args.fake:
+        os.environ["FORTUNE_TEST_MODE"] = "1"
+    import app as app_module
+    app = app_module
+    # 流量制限は最初に使うときに作られるので、それより前に上書きする
+    if args.rpm:
+        app.RATE_LIMIT_KEY_RPM = args.rpm
+        app.RATE_LIMIT_GLOBAL_RPM = max(app.RATE_LIMIT_GLOBAL_RPM, args.rpm)
+    if args.tpm:
+        app.RATE_LIMIT_KEY_TPM = args.tpm
+        app.RATE_LIMIT_GLOBAL_TPM = max(app.RATE_LIMIT_GLOBAL_TPM, args.tpm)
+    if not args.api_key and not app.TEST_MODE:
+        parser.error("GEMINI_API_KEY（または --api-key）を指定するか、--fake で実行してください")
+
+    counts = run(args.input, args.output, args.api_key, args.workers)
+    json.dump(counts, sys.stdout, ensure_ascii=False)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
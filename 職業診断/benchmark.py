@@ -0,0 +1,267 @@
+"""4ステップの操作を疑似ユーザーに通しで行わせ、操作ごとの時間・再実行回数・送信量・LLM待ちを計測する
+
+    python benchmark.py                                  # 1人分をfragmentあり・なしで計測してJSONで出力
+    python benchmark.py --mode on                        # fragmentありだけ
+    python benchmark.py --inline-assets                  # 静的配信なし（画像をbase64で埋め込む）で計測
+    python benchmark.py --users 40 --concurrency 8       # 40人を8人ずつ同時に流し、p50/p95/p99で集計
+    python benchmark.py --latency 2 --jitter 0.3 --error-rate 0.05 --first-token 0.8 --token-delay 0.02
+
+streamlit.testing の AppTest で STEP0〜3 を操作し、操作ごとに
+スクリプトの実行回数・実行時間・ブラウザへ送られるメッセージのバイト数（再実行1回あたりも）・
+LLMの応答待ち（チャットの初回トークンまで / 結果画面で分析を待った時間）を記録する。
+Geminiは TEST_MODE の疑似クライアントで置き換え、遅延・ばらつき・エラー率・ストリーミング速度を
+FORTUNE_FAKE_CLIENT 経由で指定できる。
+AppTest はウィジェット操作を常にアプリ全体の再実行として扱うので、ブラウザと同じく
+fragment内のウィジェット操作はそのfragmentだけを再実行するよう RerunData を差し替えている。
+また AppTest は実行中にプロセス全体の状態を書き換えるため、同時に動かすユーザーは別プロセスにしている
+（流量制限やキャッシュはプロセスごとになる）。
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from streamlit import config
+from streamlit.runtime.forward_msg_queue import ForwardMsgQueue
+from streamlit.runtime.scriptrunner import RerunData
+from streamlit.testing.v1 import AppTest, local_script_runner
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+
+class MessageMeter:
+    """ForwardMsgQueue に積まれたメッセージのバイト数と、スクリプトの実行回数（全体 / fragmentのみ）を数える。
+    スクリプトの実行開始時にキューが clear() されるのを実行回数として数えている。"""
+    def __init__(self):
+        self.bytes = 0
+        self.app_runs = 0
+        self.fragment_runs = 0
+        self.widget_fragments = {}  # ウィジェットID -> 属するfragmentのID
+        self.next_fragment = None
+        self._orig_enqueue = ForwardMsgQueue.enqueue
+        self._orig_clear = ForwardMsgQueue.clear
+
+    def __enter__(self):
+        meter = self
+
+        def enqueue(queue, msg):
+            meter.bytes += msg.ByteSize()
+            if msg.WhichOneof("type") == "delta" and msg.delta.fragment_id:
+                element = msg.delta.new_element
+                kind = element.WhichOneof("type")
+                widget_id = getattr(getattr(element, kind), "id", None) if kind else None
+                if widget_id:
+                    meter.widget_fragments[widget_id] = msg.delta.fragment_id
+            return meter._orig_enqueue(queue, msg)
+
+        def rerun_data(**kwargs):
+            # ブラウザと同じく、fragment内のウィジェット操作はそのfragmentだけを再実行させる。
+            # LocalScriptRunner は初期値と実行要求の2回 RerunData を作るので、両方に同じIDを入れる
+            if meter.next_fragment:
+                kwargs["fragment_id"] = meter.next_fragment
+            return RerunData(**kwargs)
+
+        def clear(queue, retain_lifecycle_msgs=False, fragment_ids_this_run=None):
+            if fragment_ids_this_run:
+                meter.fragment_runs += 1
+            else:
+                meter.app_runs += 1
+            return meter._orig_clear(queue, retain_lifecycle_msgs, fragment_ids_this_run)
+
+        ForwardMsgQueue.enqueue = enqueue
+        ForwardMsgQueue.clear = clear
+        local_script_runner.RerunData = rerun_data
+        return self
+
+    def __exit__(self, *exc):
+        ForwardMsgQueue.enqueue = self._orig_enqueue
+        ForwardMsgQueue.clear = self._orig_clear
+        local_script_runner.RerunData = RerunData
+
+    def interact(self, widget):
+        """widget の操作として次の実行を行う（fragment内ならfragmentだけ）"""
+        self.next_fragment = self.widget_fragments.get(widget.id)
+        return widget
+
+    def snapshot(self):
+        return self.bytes, self.app_runs, self.fragment_runs
+
+
+def _check(at):
+    if at.exception:
+        raise RuntimeError(at.exception[0].message)
+    return at
+
+
+def run_flow(use_fragments, static_assets=True, fake_client=None, user=0):
+    """1人分の操作を行い、操作ごとの計測結果を返す。user は回答の選び方を人ごとにずらすための番号"""
+    os.environ["FORTUNE_TEST_MODE"] = "1"
+    os.environ["FORTUNE_FRAGMENTS"] = "1" if use_fragments else "0"
+    os.environ["FORTUNE_FAKE_CLIENT"] = json.dumps(fake_client or {})
+    # 本番の .streamlit/config.toml と同じく静的配信を有効にしておく
+    config.set_option("server.enableStaticServing", static_assets)
+
+    at = AppTest.from_file(APP_PATH, default_timeout=300)
+    at.secrets["GEMINI_API_KEY"] = "benchmark"
+
+    meter = MessageMeter()
+
+    def fill_quiz(at):
+        for i, radio in enumerate(at.radio):
+            radio.set_value(radio.options[(i + user) % len(radio.options)])
+        return meter.interact(at.button[0]).click()
+
+    def chat(at, i):
+        return meter.interact(at.chat_input[0]).set_value(f"回答{i + 1}")
+
+    def llm_waits(at):
+        state = at.session_state
+        return [list(state[k]) if k in state else [] for k in ("ttft_log", "result_wait_log")]
+
+    steps = [
+        ("landing", lambda at: at),
+        ("open_door", lambda at: at.button[0].click()),
+        ("submit_quiz", fill_quiz),
+    ]
+    steps += [(f"chat_{i + 1}", lambda at, i=i: chat(at, i)) for i in range(3)]
+    steps += [
+        ("open_result", lambda at: meter.interact(at.button[0]).click()),
+        ("result_rerun", lambda at: at),
+    ]
+
+    results = []
+    with meter:
+        for name, action in steps:
+            before, waits_before = meter.snapshot(), llm_waits(at)
+            started = time.perf_counter()
+            _check(action(at).run())
+            meter.next_fragment = None
+            after, waits_after = meter.snapshot(), llm_waits(at)
+            runs = (after[1] - before[1]) + (after[2] - before[2])
+            results.append({
+                "interaction": name,
+                "step": at.session_state.step,
+                "seconds": round(time.perf_counter() - started, 4),
+                "app_runs": after[1] - before[1],
+                "fragment_runs": after[2] - before[2],
+                "bytes": after[0] - before[0],
+                "bytes_per_rerun": round((after[0] - before[0]) / max(runs, 1)),
+                # この操作の間に増えたLLM待ち（初回トークンまで＋結果の待ち）
+                "llm_wait": round(sum(sum(a[len(b):]) for a, b in zip(waits_after, waits_before)), 4),
+            })
+    return results
+
+
+def _run_user(args):
+    """別プロセスで1人分を流す（ProcessPoolExecutor 用）"""
+    use_fragments, static_assets, fake_client, user = args
+    try:
+        return run_flow(use_fragments, static_assets, fake_client, user)
+    except Exception as e:
+        return {"error": repr(e)}
+
+
+def percentiles(values):
+    if not values: return None
+    arr = np.asarray(values, dtype=float)
+    p50, p95, p99 = np.percentile(arr, [50, 95, 99])
+    return {"p50": round(p50, 4), "p95": round(p95, 4), "p99": round(p99, 4), "max": round(arr.max(), 4)}
+
+
+def summarize(flows):
+    """ユーザーごとの結果を操作ごとに集計する"""
+    ok = [f for f in flows if isinstance(f, list)]
+    errors = [f["error"] for f in flows if isinstance(f, dict)]
+    per_step = {}
+    for flow in ok:
+        for r in flow:
+            per_step.setdefault(r["interaction"], []).append(r)
+    report = {"users": len(flows), "failed": len(errors), "errors": errors[:5], "steps": {}}
+    for name, rows in per_step.items():
+        report["steps"][name] = {
+            "step": rows[0]["step"],
+            "seconds": percentiles([r["seconds"] for r in rows]),
+            "reruns": round(float(np.mean([r["app_runs"] + r["fragment_runs"] for r in rows])), 2),
+            "app_runs": round(float(np.mean([r["app_runs"] for r in rows])), 2),
+            "fragment_runs": round(float(np.mean([r["fragment_runs"] for r in rows])), 2),
+            "bytes": round(float(np.mean([r["bytes"] for r in rows]))),
+            "bytes_per_rerun": {"mean": round(float(np.mean([r["bytes_per_rerun"] for r in rows]))),
+                                "max": max(r["bytes_per_rerun"] for r in rows)},
+            "llm_wait": percentiles([r["llm_wait"] for r in rows]),
+        }
+    report["flow_seconds"] = percentiles([sum(r["seconds"] for r in flow) for flow in ok])
+    report["llm_wait_total"] = percentiles([sum(r["llm_wait"] for r in flow) for flow in ok])
+    return report
+
+
+def run_users(use_fragments, static_assets, fake_client, users, concurrency):
+    """users 人を concurrency 人ずつ同時に流す"""
+    started = time.perf_counter()
+    jobs = [(use_fragments, static_assets, fake_client, u) for u in range(users)]
+    # AppTest は実行中に sys.modules["__main__"] を app.py に差し替えるので、
+    # ワーカーに渡す関数は __main__ ではなくモジュール名 benchmark から参照させる
+    from benchmark import _run_user as run_user
+    with ProcessPoolExecutor(max_workers=concurrency) as pool:
+        flows = list(pool.map(run_user, jobs))
+    report = summarize(flows)
+    report["wall_seconds"] = round(time.perf_counter() - started, 2)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=["on", "off", "both"], default="both", help="fragmentの有無")
+    parser.add_argument("--inline-assets", action="store_true", help="静的配信を使わずに計測する")
+    parser.add_argument("--users", type=int, default=1, help="流す人数")
+    parser.add_argument("--concurrency", type=int, default=1, help="同時に操作する人数（1人1プロセス）")
+    parser.add_argument("--latency", type=float, default=1.0, help="疑似モデルの応答時間（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="応答時間のばらつき（割合, 0.3なら±30%%）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="先頭モデルがエラーを返す確率")
+    parser.add_argument("--first-token", type=float, default=0.5, help="ストリーミングの初回トークンまでの時間（秒）")
+    parser.add_argument("--token-delay", type=float, default=0.03, help="ストリーミングのトークン間隔（秒）")
+    args = parser.parse_args(argv)
+
+    if args.mode == "both":
+        # キャッシュの持ち越しで差が出ないよう、モードごとに別プロセスで測る
+        report = {}
+        for mode in ("on", "off"):
+            cmd = [sys.executable, os.path.abspath(__file__)] + _forward_args(argv) + ["--mode", mode]
+            out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+            report.update(json.loads(out))
+    else:
+        use_fragments = args.mode == "on"
+        key = "fragments" if use_fragments else "no_fragments"
+        fake_client = {
+            "delay": args.latency, "jitter": args.jitter,
+            "first_token_delay": args.first_token, "token_delay": args.token_delay,
+            "error_rate": {"gemini-2.5-flash": args.error_rate} if args.error_rate else {},
+        }
+        result = run_users(use_fragments, not args.inline_assets, fake_client, args.users, args.concurrency)
+        report = {key: result, "config": {k: v for k, v in vars(args).items() if k != "mode"}}
+    json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    sys.stdout.write("\n")
+
+
+def _forward_args(argv):
+    """--mode 以外の引数をそのまま子プロセスに渡す"""
+    argv = list(sys.argv[1:] if argv is None else argv)
+    out = []
+    skip = False
+    for a in argv:
+        if skip:
+            skip = False
+            continue
+        if a == "--mode":
+            skip = True
+            continue
+        if a.startswith("--mode="): continue
+        out.append(a)
+    return out
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""app.py の import にかかる時間を `python -X importtime` で測り、予算を超えたら失敗にする
+
+    python check_import_time.py                 # 3回測った中央値で判定し、結果をJSONで出力
+    python check_import_time.py --budget-ms 200 # 予算(ミリ秒)を変える
+
+判定するのは次の2つ（どちらかに引っかかると終了コード1）。
+- DEFERRED_MODULES を app.py がトップレベルで直接 import していないか（STEP0の描画を遅くするため）
+- app.py 自身にかかる時間（streamlit本体の読み込みを除く）が予算内か
+streamlit は plotly を自前で読み込むことがあるので、判定は app.py が直接読み込んだものだけを見る。
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# STEP0 では読み込まず、使うステップで import するモジュール
+DEFERRED_MODULES = ["google.generativeai", "google.ai.generativelanguage", "plotly.graph_objects"]
+# streamlit 本体は app.py の工夫では速くならないので予算の対象から外す
+BASELINE_MODULES = ["streamlit"]
+DEFAULT_BUDGET_MS = 150
+
+LINE_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$")
+
+
+def measure_once():
+    """app.py を1回 import して、app 直下で読み込まれたモジュールと所要時間(ミリ秒)を返す"""
+    env = dict(os.environ, FORTUNE_TEST_MODE="1")
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=SCRIPT_DIR, env=env, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+
+    # 出力は子が親より先に並ぶので、深さ1の行を溜めておき app の行で確定させる
+    children = {}
+    total_ms = None
+    for line in proc.stderr.splitlines():
+        m = LINE_RE.match(line)
+        if not m: continue
+        cumulative_ms = int(m.group(2)) / 1000
+        depth = len(m.group(3)) // 2
+        name = m.group(4)
+        if depth == 1:
+            children[name] = cumulative_ms
+        elif depth == 0:
+            if name == "app":
+                total_ms = cumulative_ms
+                break
+            children = {}
+    if total_ms is None:
+        raise RuntimeError("importtime の出力に app が見つかりません")
+    return total_ms, children
+
+
+def check(runs, budget_ms):
+    samples = [measure_once() for _ in range(runs)]
+    children = samples[-1][1]
+    own = [total - sum(c.get(name, 0) for name in BASELINE_MODULES) for total, c in samples]
+    report = {
+        "runs": runs,
+        "budget_ms": budget_ms,
+        "app_total_ms": round(statistics.median(t for t, _ in samples), 1),
+        "app_own_ms": round(statistics.median(own), 1),
+        "deferred_imported": [name for name in DEFERRED_MODULES if name in children],
+        "slowest_imports": {
+            name: round(ms, 1)
+            for name, ms in sorted(children.items(), key=lambda kv: -kv[1])[:8]
+        },
+    }
+    report["ok"] = not report["deferred_imported"] and report["app_own_ms"] <= budget_ms
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3, help="測定回数（中央値で判定）")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS, help="app.py自身の読み込み予算")
+    args = parser.parse_args(argv)
+
+    report = check(args.runs, args.budget_ms)
+    json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    sys.stdout.write("\n")
+    return 0 if report["ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,758 @@
+"""app.py のうち画面を使わない部分のテスト（python -m unittest test_app）。
+Gemini は FakeGeminiClient で置き換え、時刻が関わるものは時計を差し替えて確かめる。"""
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+# import より前に設定する（スパンやメトリクスのファイルを書き出さない）
+os.environ["FORTUNE_TEST_MODE"] = "1"
+os.environ["FORTUNE_TRACE_LOG"] = ""
+os.environ["FORTUNE_METRICS_TEXTFILE"] = ""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+import app
+
+
+class FakeClock:
+    """app.time の代わり。time() / monotonic() は進めた分だけ進む"""
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def outcomes(model):
+    return [e["outcome"] for e in app.get_hedge_events() if e["model"] == model]
+
+
+class HedgedGenerateTest(unittest.TestCase):
+    def setUp(self):
+        # 健康状態と呼び出し履歴は全セッション共通なので、テストごとに作り直す
+        app.get_health_board.clear()
+        app.get_hedge_events.clear()
+
+    def test_hedge_wins_when_first_model_is_slow(self):
+        client = app.FakeGeminiClient(reply="b", delays={"a": 2.0, "b": 0.01})
+        started = time.time()
+        winner = app.hedged_generate(client, "prompt", models=["a", "b"], hedge_after=0.05, timeout=5)
+        self.assertEqual(winner, ("b", "b"))
+        self.assertLess(time.time() - started, 1.0)
+        self.assertEqual(outcomes("a"), ["cancelled"])
+        self.assertEqual(outcomes("b"), ["ok"])
+
+    def test_failover_to_next_model_on_error(self):
+        client = app.FakeGeminiClient(reply="ok", delays={"a": 0.01, "b": 0.01}, errors={"a": RuntimeError("down")})
+        started = time.time()
+        winner = app.hedged_generate(client, "prompt", models=["a", "b"], hedge_after=5, timeout=5)
+        self.assertEqual(winner, ("b", "ok"))
+        # ヘッジ時間を待たずに次のモデルへ移る
+        self.assertLess(time.time() - started, 1.0)
+        self.assertEqual(outcomes("a"), ["error"])
+        self.assertEqual(app.get_health_board().metrics()["a"]["error_rate"], 1.0)
+
+    def test_timeout_returns_none(self):
+        client = app.FakeGeminiClient(delays={"a": 1.0, "b": 1.0})
+        winner = app.hedged_generate(client, "prompt", models=["a", "b"], hedge_after=0.02, timeout=0.1)
+        self.assertEqual(winner, (None, None))
+        self.assertEqual(outcomes("a"), ["timeout"])
+        self.assertEqual(outcomes("b"), ["timeout"])
+
+    def half_open(self, model):
+        board = app.get_health_board()
+        for _ in range(app.CIRCUIT_MIN_CALLS):
+            board.record(model, False, 0.1)
+        board.circuits[model].opened_at -= app.CIRCUIT_COOLDOWN_SEC
+        return board
+
+    def test_trial_slot_is_released_when_another_model_wins(self):
+        board = self.half_open("b")
+        client = app.FakeGeminiClient(reply="a", delays={"a": 0.01, "b": 0.01})
+        self.assertEqual(app.hedged_generate(client, "prompt", models=["a", "b"], hedge_after=5, timeout=5), ("a", "a"))
+        self.assertEqual(outcomes("b"), [])
+        # b は呼ばれなかったので、次の呼び出しでお試しに使える
+        self.assertEqual(board.order(["a", "b"]), ["a", "b"])
+
+    def test_stream_releases_unused_trial_slot(self):
+        board = self.half_open(app.MODELS_TO_TRY[0])
+        client = app.FakeGeminiClient(reply="ok", first_token_delay=0.0, token_delay=0.0)
+        with mock.patch.object(app, "_get_client", return_value=client):
+            self.assertEqual("".join(app._stream_gemini_chunks("prompt", "key")), "ok")
+        self.assertEqual(outcomes(app.MODELS_TO_TRY[0]), [])
+        self.assertIn(app.MODELS_TO_TRY[0], board.order(app.MODELS_TO_TRY))
+
+    def test_admit_refusal_skips_the_call(self):
+        client = app.FakeGeminiClient(delays={"a": 0.01})
+        winner = app.hedged_generate(client, "prompt", models=["a"], admit=lambda block: False)
+        self.assertEqual(winner, (None, None))
+        self.assertEqual(list(app.get_hedge_events()), [])
+
+
+class ModelHealthBoardTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(app, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.board = app.ModelHealthBoard()
+
+    def trip(self, model):
+        for _ in range(app.CIRCUIT_MIN_CALLS):
+            self.board.record(model, False, 0.1)
+
+    def test_closed_open_half_open_closed(self):
+        self.trip("a")
+        self.assertEqual(self.board.circuits["a"].state, "open")
+        self.assertEqual(self.board.order(["a", "b"]), ["b"])
+
+        # 冷却時間が過ぎたらお試しに1本だけ通す（直近の失敗が残っているので順位は後ろ）
+        self.clock.advance(app.CIRCUIT_COOLDOWN_SEC)
+        self.assertEqual(self.board.order(["a", "b"]), ["b", "a"])
+        self.assertEqual(self.board.circuits["a"].state, "half_open")
+        # お試しの1本が返るまでは他の呼び出しに使わない
+        self.assertEqual(self.board.order(["a", "b"]), ["b"])
+
+        self.board.record("a", True, 0.1)
+        self.assertEqual(self.board.circuits["a"].state, "closed")
+        self.assertEqual(self.board.order(["a", "b"]), ["a", "b"])
+
+    def test_failed_trial_reopens(self):
+        self.trip("a")
+        self.clock.advance(app.CIRCUIT_COOLDOWN_SEC)
+        self.board.order(["a"])
+        self.board.record("a", False, 0.1)
+        self.assertEqual(self.board.circuits["a"].state, "open")
+        self.assertEqual(self.board.order(["a", "b"]), ["b"])
+
+    def test_unused_trial_is_released(self):
+        self.trip("a")
+        self.clock.advance(app.CIRCUIT_COOLDOWN_SEC)
+        trials = {}
+        self.assertEqual(self.board.order(["a", "b"], trials), ["b", "a"])
+        self.assertEqual(list(trials), ["a"])
+        self.board.release(trials)
+        self.assertEqual(self.board.order(["a", "b"]), ["b", "a"])
+
+    def test_release_does_not_touch_a_recorded_trial(self):
+        self.trip("a")
+        self.clock.advance(app.CIRCUIT_COOLDOWN_SEC)
+        trials = {}
+        self.board.order(["a"], trials)
+        self.board.record("a", False, 0.1)
+        self.board.release(trials)
+        self.assertEqual(self.board.circuits["a"].state, "open")
+
+    def test_all_open_keeps_configured_order(self):
+        self.trip("a")
+        self.trip("b")
+        self.assertEqual(self.board.order(["a", "b"]), ["a", "b"])
+
+    def test_single_failure_does_not_demote(self):
+        self.board.record("a", False, 0.1)
+        self.assertEqual(self.board.order(["a", "b"]), ["a", "b"])
+
+    def test_old_results_leave_the_window(self):
+        for _ in range(app.CIRCUIT_MIN_CALLS - 1):
+            self.board.record("a", False, 0.1)
+        self.clock.advance(app.CIRCUIT_WINDOW_SEC + 1)
+        self.board.record("a", False, 0.1)
+        self.assertEqual(self.board.circuits["a"].state, "closed")
+
+    def test_per_key_errors_are_not_model_failures(self):
+        def error(code):
+            return types.SimpleNamespace(code=code)
+        self.assertFalse(app._is_model_failure(error(429)))
+        self.assertFalse(app._is_model_failure(error(403)))
+        self.assertTrue(app._is_model_failure(error(503)))
+        self.assertTrue(app._is_model_failure(error(404)))
+        self.assertTrue(app._is_model_failure(ConnectionError("reset")))
+
+
+class RateLimiterTest(unittest.TestCase):
+    def make(self, rpm, max_wait=1.0):
+        return app.RateLimiter(rpm, 1_000_000, rpm, 1_000_000, max_queue=10, max_wait=max_wait)
+
+    def test_non_blocking_skips_when_full(self):
+        limiter = self.make(1)
+        self.assertTrue(limiter.acquire("key", 10, owner="s1", block=False))
+        self.assertFalse(limiter.acquire("key", 10, owner="s2", block=False))
+        self.assertEqual(limiter.metrics()["admitted"], 1)
+        self.assertEqual(limiter.metrics()["skipped"], 1)
+
+    def test_blocking_times_out(self):
+        limiter = self.make(1, max_wait=0.1)
+        limiter.acquire("key", 10, owner="s1")
+        self.assertFalse(limiter.acquire("key", 10, owner="s2"))
+        self.assertEqual(limiter.metrics()["timeout"], 1)
+        self.assertEqual(limiter.position("s2"), 0)
+
+    def test_queued_call_is_admitted_when_the_bucket_refills(self):
+        # 1分に600回 = 0.1秒で1回分空く
+        limiter = self.make(600, max_wait=2.0)
+        for _ in range(600):
+            limiter.acquire("key", 1, block=False)
+        positions = []
+        self.assertTrue(limiter.acquire("key", 1, owner="s1", on_wait=positions.append))
+        self.assertEqual(positions, [1])
+        self.assertEqual(limiter.metrics()["queued"], 1)
+
+    def test_keys_have_separate_buckets(self):
+        limiter = app.RateLimiter(100, 1_000_000, 1, 1_000_000, max_queue=10, max_wait=1.0)
+        self.assertTrue(limiter.acquire("k1", 10, block=False))
+        self.assertTrue(limiter.acquire("k2", 10, block=False))
+        self.assertFalse(limiter.acquire("k1", 10, block=False))
+
+    def test_busy_key_is_not_evicted(self):
+        limiter = app.RateLimiter(1_000_000, 1_000_000_000, 1, 1_000_000, max_queue=10, max_wait=1.0)
+        self.assertTrue(limiter.acquire("busy", 1, block=False))
+        # 他のキーが1000件以上来ても、その間に使われ続けたキーの残量は引き継がれる
+        for i in range(1200):
+            limiter.acquire(f"k{i}", 1, block=False)
+            self.assertFalse(limiter.acquire("busy", 1, block=False))
+        self.assertIn("busy", limiter.key_buckets)
+
+
+def reference_score(answers):
+    """分割前の calculate_type() とレーダーの計算をそのまま書いたもの"""
+    raw = {"fire": 0, "water": 0, "wind": 0}
+    for q_id, val in answers.items():
+        for q in app.QUESTIONS:
+            if q["id"] == q_id:
+                raw[q["options"][val]] += 1
+    sorted_scores = sorted(raw.items(), key=lambda x: x[1], reverse=True)
+    t1, s1 = sorted_scores[0]
+    t2, s2 = sorted_scores[1]
+    r_type = t1 if s1 - s2 >= 2 else f"{min(t1, t2)}-{max(t1, t2)}"
+    radar = [raw["fire"], raw["water"], raw["wind"], (raw["fire"] + raw["wind"]) / 1.5, (raw["fire"] + raw["water"]) / 1.5]
+    return raw, r_type, t1, radar
+
+
+class ScoreBatchTest(unittest.TestCase):
+    def random_answers(self, rng):
+        # 未回答の質問も混ぜる
+        return {q["id"]: rng.choice(list(q["options"])) for q in app.QUESTIONS if rng.random() < 0.9}
+
+    def test_matches_reference_loop(self):
+        rng = random.Random(0)
+        people = [self.random_answers(rng) for _ in range(500)] + [{}]
+        res = app.score_batch(np.stack([app.encode_answers(a) for a in people]))
+        for i, answers in enumerate(people):
+            raw, r_type, main, radar = reference_score(answers)
+            self.assertEqual(dict(zip(app.ELEMENTS, res["scores"][i].tolist())), raw)
+            self.assertEqual(res["types"][i], r_type)
+            self.assertEqual(res["main"][i], main)
+            np.testing.assert_allclose(res["radar"][i], radar)
+
+    def test_score_answers_matches_batch(self):
+        answers = self.random_answers(random.Random(1))
+        single = app.score_answers(answers)
+        raw, r_type, main, radar = reference_score(answers)
+        self.assertEqual((single["scores"], single["type"], single["main"]), (raw, r_type, main))
+        np.testing.assert_allclose(single["radar"], radar)
+
+    def test_unknown_option_is_unanswered(self):
+        idx = app.encode_answers({"q1": "存在しない選択肢", "zz": "x"})
+        self.assertTrue((idx == -1).all())
+
+
+class SessionCodecTest(unittest.TestCase):
+    def state(self):
+        answers = {q["id"]: list(q["options"])[i % 3] for i, q in enumerate(app.QUESTIONS)}
+        return {
+            "step": 3,
+            "answers": answers,
+            "chat_history": [{"role": "assistant", "content": "ようこそ"}, {"role": "user", "content": "はい"}],
+            "dynamic_result": {"skills": ["行動力"], "jobs": ["企画職"], "desc": "星"},
+            "final_advice": "進め",
+        }
+
+    def test_round_trip(self):
+        state = self.state()
+        self.assertEqual(app.decode_session(app.encode_session(state)), state)
+
+    def test_long_turns_are_truncated(self):
+        state = self.state()
+        state["chat_history"] = [{"role": "user", "content": "あ" * (app.SESSION_MAX_TURN_CHARS + 10)}]
+        decoded = app.decode_session(app.encode_session(state))
+        self.assertEqual(len(decoded["chat_history"][0]["content"]), app.SESSION_MAX_TURN_CHARS)
+
+    def test_fallback_result_is_not_saved(self):
+        state = self.state()
+        state["result_failed"] = True
+        decoded = app.decode_session(app.encode_session(state))
+        self.assertIsNone(decoded["dynamic_result"])
+        self.assertEqual(decoded["final_advice"], "")
+
+    def test_broken_or_other_version(self):
+        self.assertIsNone(app.decode_session(b"not zlib"))
+        with mock.patch.object(app, "SESSION_FORMAT_VERSION", app.SESSION_FORMAT_VERSION + 1):
+            data = app.encode_session(self.state())
+        self.assertIsNone(app.decode_session(data))
+
+
+class SessionStoreTest(unittest.TestCase):
+    def check_store(self, store):
+        self.assertIsNone(store.get("t1"))
+        store.put("t1", b"data")
+        self.assertEqual(store.get("t1"), b"data")
+        store.put("t1", b"newer")
+        self.assertEqual(store.get("t1"), b"newer")
+        store.delete("t1")
+        self.assertIsNone(store.get("t1"))
+
+    def test_memory_store(self):
+        self.check_store(app.MemorySessionStore(60, 10))
+
+    def test_memory_store_drops_oldest_over_capacity(self):
+        store = app.MemorySessionStore(60, 2)
+        for token in ("a", "b", "c"):
+            store.put(token, token.encode())
+        self.assertIsNone(store.get("a"))
+        self.assertEqual(store.get("c"), b"c")
+
+    def test_memory_store_expires(self):
+        clock = FakeClock()
+        with mock.patch.object(app, "time", clock):
+            store = app.MemorySessionStore(60, 10)
+            store.put("a", b"a")
+            clock.advance(61)
+            self.assertIsNone(store.get("a"))
+
+    def test_sqlite_store_is_shared_between_instances(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "sessions.sqlite3")
+            self.check_store(app.SqliteSessionStore(path, 60))
+            app.SqliteSessionStore(path, 60).put("t2", b"x")
+            # 別のプロセス（別のインスタンス）からも読める
+            self.assertEqual(app.SqliteSessionStore(path, 60).get("t2"), b"x")
+
+
+class ResultJobRunnerTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "jobs.sqlite3")
+        for name, value in (("RESULT_JOB_POLL_SEC", 0.02), ("RESULT_JOB_STALE_SEC", 0.3)):
+            patcher = mock.patch.object(app, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.pool = ThreadPoolExecutor(4)
+        self.addCleanup(self.pool.shutdown)
+        self.calls = []
+
+    def runner(self):
+        """同じ表を見る別のプロセスの代わり"""
+        return app.ResultJobRunner(app.ResultJobTable(self.path, 3600), self.pool)
+
+    def work(self, value, delay=0.0):
+        self.calls.append(value)
+        time.sleep(delay)
+        return {"v": value}
+
+    def test_same_job_runs_once(self):
+        runner = self.runner()
+        job = ("s", "k", "analysis")
+        first = runner.submit(job, self.work, 1, 0.2)
+        self.assertIs(runner.submit(job, self.work, 1), first)
+        self.assertEqual(first.result(timeout=5), {"v": 1})
+        # 終わった後の投入（再起動後も）は表の結果を返す
+        again = self.runner().submit(job, self.work, 1)
+        self.assertTrue(again.done())
+        self.assertEqual(again.result(), {"v": 1})
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(runner.metrics()["attached"], 1)
+
+    def test_follows_a_job_running_elsewhere(self):
+        job = ("s", "k", "advice")
+        other = app.ResultJobTable(self.path, 3600)
+        other.claim(job, "other", 60)
+        runner = self.runner()
+        future = runner.submit(job, self.work, 2)
+        self.assertEqual(runner.metrics()["following"], 1)
+        # 生きている間は待つだけで、自分では実行しない
+        for _ in range(5):
+            other.heartbeat("other")
+            time.sleep(0.05)
+        self.assertFalse(future.done())
+        other.finish(job, "other", result={"v": "other"})
+        self.assertEqual(future.result(timeout=5), {"v": "other"})
+        self.assertEqual(self.calls, [])
+
+    def test_takes_over_a_stale_job(self):
+        job = ("s", "k", "advice")
+        app.ResultJobTable(self.path, 3600).claim(job, "dead", 60)
+        runner = self.runner()
+        future = runner.submit(job, self.work, 3)
+        self.assertEqual(future.result(timeout=5), {"v": 3})
+        self.assertEqual(self.calls, [3])
+        self.assertEqual(runner.metrics()["following"], 0)
+
+    def test_failed_job_is_run_again(self):
+        runner = self.runner()
+        job = ("s", "k", "analysis")
+        failed = runner.submit(job, app.generate_result, lambda: app.ORACLE_FALLBACK_TEXT)
+        with self.assertRaises(app.OracleUnavailable):
+            failed.result(timeout=5)
+        self.assertEqual(runner.table.counts(), {"failed": 1})
+        retried = runner.submit(job, app.generate_result, self.work, 4)
+        self.assertEqual(retried.result(timeout=5), {"v": 4})
+        self.assertEqual(runner.table.counts(), {"done": 1})
+
+    def test_slow_table_does_not_block_other_jobs(self):
+        runner = self.runner()
+        release = threading.Event()
+        claim = runner.table.claim
+
+        def slow_claim(job, *args):
+            if job[2] == "slow":
+                release.wait(5)
+            return claim(job, *args)
+
+        with mock.patch.object(runner.table, "claim", slow_claim):
+            slow = threading.Thread(target=runner.submit, args=(("s", "k", "slow"), self.work, 5))
+            slow.start()
+            time.sleep(0.05)
+            started = time.time()
+            fast = runner.submit(("s", "k", "fast"), self.work, 6)
+            self.assertEqual(fast.result(timeout=5), {"v": 6})
+            self.assertLess(time.time() - started, 1.0)
+            release.set()
+            slow.join(5)
+        # 遅れた方も、表の待ちが明けたら普通に終わる
+        self.assertEqual(runner.submit(("s", "k", "slow"), self.work, 5).result(timeout=5), {"v": 5})
+
+    def test_take_result_falls_back(self):
+        fake_st = types.SimpleNamespace(session_state=types.SimpleNamespace())
+        with mock.patch.object(app, "st", fake_st):
+            self.assertEqual(app.take_result(Future(), "fallback"), "fallback")
+            self.assertTrue(fake_st.session_state.result_failed)
+            done = Future()
+            done.set_result("ok")
+            self.assertEqual(app.take_result(done, "fallback"), "ok")
+
+
+VALID_ANALYSIS = {"skills": ["行動力", "分析力"], "jobs": ["企画職"], "desc": "星に導かれし者"}
+
+
+class AnalysisTest(unittest.TestCase):
+    def replies(self, *texts):
+        """get_gemini_response の代わり。呼ばれるたびに texts を順に返し、受け取ったプロンプトを残す"""
+        prompts = []
+        queue = list(texts)
+
+        def fake(prompt, api_key, system_instruction=None, generation_config=None):
+            prompts.append(prompt)
+            return queue.pop(0)
+        patcher = mock.patch.object(app, "get_gemini_response", fake)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return prompts
+
+    def test_parse_strips_and_accepts_surrounding_text(self):
+        raw = "結果です:\n" + json.dumps({"skills": [" 行動力 "], "jobs": ["企画職"], "desc": " 星 "}, ensure_ascii=False) + "\n以上"
+        self.assertEqual(app.parse_analysis(raw), {"skills": ["行動力"], "jobs": ["企画職"], "desc": "星"})
+
+    def test_parse_rejects_schema_violations(self):
+        for bad in ('[]', '{"skills": [], "jobs": ["a"], "desc": "d"}', '{"skills": ["a"], "jobs": [1], "desc": "d"}',
+                    '{"skills": ["a"], "jobs": ["b"]}', "JSONではない"):
+            with self.subTest(bad=bad), self.assertRaises(ValueError):
+                app.parse_analysis(bad)
+
+    def test_valid_reply_is_parsed_without_repair(self):
+        prompts = self.replies(json.dumps(VALID_ANALYSIS, ensure_ascii=False))
+        self.assertEqual(app._run_analysis("key", []), (VALID_ANALYSIS, "parsed"))
+        self.assertEqual(len(prompts), 1)
+
+    def test_broken_reply_is_repaired_once(self):
+        prompts = self.replies('{"skills": ["行動力"', json.dumps(VALID_ANALYSIS, ensure_ascii=False))
+        self.assertEqual(app._run_analysis("key", []), (VALID_ANALYSIS, "repaired"))
+        # 修復には壊れた出力だけを送る
+        self.assertIn('{"skills": ["行動力"', prompts[1])
+
+    def test_unrepairable_reply_falls_back(self):
+        self.replies("壊れた出力", "まだ壊れている")
+        self.assertEqual(app._run_analysis("key", []), (app.ANALYSIS_FALLBACK, "failed"))
+
+    def test_fallback_text_skips_repair(self):
+        prompts = self.replies(app.ORACLE_FALLBACK_TEXT)
+        self.assertEqual(app._run_analysis("key", []), (app.ANALYSIS_FALLBACK, "unavailable"))
+        self.assertEqual(len(prompts), 1)
+
+    def test_stats_exclude_unavailable_from_success_rate(self):
+        stats = app.AnalysisStats()
+        for outcome in ("parsed", "repaired", "failed", "unavailable"):
+            stats.add(outcome)
+        self.assertAlmostEqual(stats.metrics()["success_rate"], round(2 / 3, 3))
+
+
+class OpeningQuestionPoolTest(unittest.TestCase):
+    def setUp(self):
+        app.get_health_board.clear()
+        app.get_rate_limiter.clear()
+        patcher = mock.patch.object(app, "FAKE_CLIENT_OPTIONS", {"delay": 0.0, "first_token_delay": 0.0, "token_delay": 0.0})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_pool(self, store=None, api_key="server-key"):
+        pool = app.OpeningQuestionPool(store or app.MemoryResponseStore(ttl=60, max_entries=50), 3, api_key)
+        self.addCleanup(pool.executor.shutdown)
+        return pool
+
+    def test_refill_fills_up_to_size_and_take_consumes(self):
+        pool = self.make_pool()
+        pool.refill("fire")
+        pool.executor.shutdown(wait=True)
+        key = pool._key("fire")
+        self.assertEqual(pool.store.count(key), 3)
+        self.assertTrue(pool.take("fire"))
+        self.assertEqual(pool.store.count(key), 2)
+        self.assertIsNone(pool.take("water"))
+
+    def test_no_refill_without_server_key(self):
+        pool = self.make_pool(api_key=None)
+        with mock.patch.object(app, "TEST_MODE", False), mock.patch.object(app, "_get_client") as get_client:
+            pool.refill("fire")
+            pool.executor.shutdown(wait=True)
+        get_client.assert_not_called()
+        self.assertEqual(pool.store.count(pool._key("fire")), 0)
+
+    def test_memory_store_expires_and_drops_oldest(self):
+        clock = FakeClock()
+        store = app.MemoryResponseStore(ttl=10, max_entries=2)
+        with mock.patch.object(app, "time", clock):
+            store.put("k", "a")
+            clock.advance(11)
+            store.put("k", "b")
+            store.put("other", "c")
+            self.assertEqual(store.count("k"), 1)
+            store.put("other", "d")  # 上限2なので最も古い b が捨てられる
+            self.assertIsNone(store.take("k"))
+            self.assertEqual((store.take("other"), store.take("other")), ("c", "d"))
+
+    def test_sqlite_store_is_shared_and_taken_once(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "opening.sqlite3")
+        first = app.SqliteResponseStore(path, ttl=60, max_entries=10)
+        second = app.SqliteResponseStore(path, ttl=60, max_entries=10)
+        first.put("k", "a")
+        first.put("k", "b")
+        self.assertEqual(second.count("k"), 2)
+        self.assertEqual((second.take("k"), first.take("k"), first.take("k")), ("a", "b", None))
+
+
+class ExportCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = ThreadPoolExecutor(4)
+        self.addCleanup(self.pool.shutdown)
+        self.calls = []
+
+    def builder(self, value, delay=0.0):
+        self.calls.append(value)
+        time.sleep(delay)
+        return value.upper()
+
+    def test_concurrent_requests_share_one_build(self):
+        cache = app.ExportCache(self.pool, max_entries=4)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get("k", self.builder, "html", 0.1))) for _ in range(5)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(results, ["HTML"] * 5)
+        self.assertEqual(self.calls, ["html"])
+
+    def test_failed_build_is_retried(self):
+        cache = app.ExportCache(self.pool, max_entries=4)
+        with self.assertRaises(RuntimeError):
+            cache.get("k", mock.Mock(side_effect=RuntimeError("font")))
+        self.assertEqual(cache.get("k", self.builder, "pdf"), "PDF")
+
+    def test_least_recently_used_is_evicted(self):
+        cache = app.ExportCache(self.pool, max_entries=2)
+        cache.get("a", self.builder, "a")
+        cache.get("b", self.builder, "b")
+        cache.get("a", self.builder, "a")
+        cache.get("c", self.builder, "c")  # b が最も長く使われていない
+        cache.get("a", self.builder, "a")
+        cache.get("b", self.builder, "b")
+        self.assertEqual(self.calls, ["a", "b", "c", "b"])
+
+    def test_key_follows_content(self):
+        key = app.export_key("pdf", "fire", VALID_ANALYSIS, "助言")
+        self.assertEqual(key, app.export_key("pdf", "fire", dict(reversed(VALID_ANALYSIS.items())), "助言"))
+        self.assertNotEqual(key, app.export_key("html", "fire", VALID_ANALYSIS, "助言"))
+        self.assertNotEqual(key, app.export_key("pdf", "fire", VALID_ANALYSIS, "別の助言"))
+
+
+def make_span(name, duration, status="ok", **attrs):
+    return {"name": name, "trace_id": "t", "span_id": "s", "parent_id": None, "session": None,
+            "start": 0.0, "duration": duration, "status": status, "attrs": attrs}
+
+
+class TracerTest(unittest.TestCase):
+    def make_tracer(self, log_path="", buffer_size=10, log_max_bytes=1_000_000):
+        # 書き出しスレッドの周期は長くして、flush() を呼んだときだけ書かれるようにする
+        tracer = app.Tracer(buffer_size, log_path, log_max_bytes, [0.1, 1], flush_interval=3600)
+        self.addCleanup(tracer.stopped.set)
+        return tracer
+
+    def test_histogram_and_counters(self):
+        tracer = self.make_tracer()
+        tracer.record(make_span("oracle.attempt", 0.05, model="m", prompt_tokens=10, response_tokens=3))
+        tracer.record(make_span("oracle.attempt", 0.5, model="m", prompt_tokens=5))
+        tracer.record(make_span("oracle.generate", 2.0, retries=1, fallback=True))
+        text = tracer.prometheus([("fortune_rate_limit_waiting", "gauge", (), 2)])
+        attempt = 'span="oracle.attempt",model="m",status="ok"'
+        self.assertIn(f'fortune_span_duration_seconds_bucket{{{attempt},le="0.1"}} 1', text)
+        self.assertIn(f'fortune_span_duration_seconds_bucket{{{attempt},le="1"}} 2', text)
+        self.assertIn(f'fortune_span_duration_seconds_bucket{{{attempt},le="+Inf"}} 2', text)
+        self.assertIn(f"fortune_span_duration_seconds_sum{{{attempt}}} 0.550000", text)
+        self.assertIn('fortune_tokens_total{span="oracle.attempt",model="m",kind="prompt"} 15', text)
+        self.assertIn('fortune_tokens_total{span="oracle.attempt",model="m",kind="response"} 3', text)
+        self.assertIn('fortune_retries_total{span="oracle.generate"} 1', text)
+        self.assertIn('fortune_fallback_total{span="oracle.generate"} 1', text)
+        self.assertIn("# TYPE fortune_rate_limit_waiting gauge\nfortune_rate_limit_waiting 2", text)
+        # 種類の宣言はメトリクスごとに1回だけ
+        self.assertEqual(text.count("# TYPE fortune_tokens_total counter"), 1)
+
+    def test_label_values_are_escaped(self):
+        self.assertEqual(app._prom_labels((("model", 'a"b\\c\nd'),)), '{model="a\\"b\\\\c\\nd"}')
+        self.assertEqual(app._prom_labels(()), "")
+
+    def test_spans_are_written_on_flush(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "traces.jsonl")
+        tracer = self.make_tracer(path)
+        tracer.record(make_span("a", 0.1))
+        tracer.record(make_span("b", 0.1))
+        self.assertFalse(os.path.exists(path))  # record() 自体は書き込まない
+        tracer.flush()
+        with open(path, encoding="utf-8") as f:
+            self.assertEqual([json.loads(line)["name"] for line in f], ["a", "b"])
+        self.assertEqual([s["name"] for s in tracer.recent], ["a", "b"])
+
+    def test_log_is_rotated(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "traces.jsonl")
+        tracer = self.make_tracer(path, log_max_bytes=10)
+        tracer.record(make_span("a", 0.1))
+        tracer.flush()
+        tracer.record(make_span("b", 0.1))
+        tracer.flush()
+        with open(path + ".1", encoding="utf-8") as f:
+            self.assertEqual(json.loads(f.read())["name"], "a")
+        with open(path, encoding="utf-8") as f:
+            self.assertEqual(json.loads(f.read())["name"], "b")
+
+    def test_backlog_is_bounded(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        tracer = self.make_tracer(os.path.join(tmp.name, "traces.jsonl"), buffer_size=1)
+        for i in range(15):
+            tracer.record(make_span(f"s{i}", 0.1))
+        self.assertEqual(len(tracer.pending), 10)
+        self.assertIn("fortune_trace_dropped_total 5", tracer.prometheus())
+
+
+class FakeService:
+    """GenerativeServiceClient の代わり。受け取ったリクエストを残し、決まった応答を返す"""
+    def __init__(self, client_options=None):
+        self.requests = []
+        self.transport = mock.Mock()
+
+    def generate_content(self, request, timeout=None):
+        from google.generativeai import protos
+        self.requests.append(request)
+        return protos.GenerateContentResponse(candidates=[{"content": {"parts": [{"text": "じゃ"}], "role": "model"}}])
+
+
+class GeminiClientPoolTest(unittest.TestCase):
+    def setUp(self):
+        from google.ai import generativelanguage as glm
+        patcher = mock.patch.object(glm, "GenerativeServiceClient", FakeService)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_request_is_built_like_generative_model(self):
+        pool = app.GeminiClientPool(max_keys=2)
+        with pool.model("key", "gemini-x", "占い師") as model:
+            res = model.generate_content([{"parts": ["問い"]}], generation_config={"response_mime_type": "application/json"})
+        self.assertEqual(res.text, "じゃ")
+        request = model.service.requests[0]
+        self.assertEqual(request.model, "models/gemini-x")
+        self.assertEqual(request.system_instruction.parts[0].text, "占い師")
+        self.assertEqual(request.contents[-1].role, "user")
+        self.assertEqual(request.generation_config.response_mime_type, "application/json")
+
+    def test_models_and_connections_are_reused(self):
+        pool = app.GeminiClientPool(max_keys=2)
+        with pool.model("key", "a") as first, pool.model("key", "a") as second, pool.model("key", "b") as other:
+            self.assertIs(first, second)
+            self.assertIs(first.service, other.service)
+
+    def test_evicted_connection_is_closed_after_release(self):
+        pool = app.GeminiClientPool(max_keys=1)
+        with pool.model("busy", "m") as busy:
+            with pool.model("idle", "m") as idle:
+                pass
+            with pool.model("next", "m"):
+                pass
+            # 使い終わっていた idle はすぐ閉じ、貸し出し中の busy は返るまで閉じない
+            idle.service.transport.close.assert_called_once()
+            busy.service.transport.close.assert_not_called()
+        busy.service.transport.close.assert_called_once()
+
+
+class StaticAssetBuilderTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for patcher in (mock.patch.object(app, "STATIC_DIR", tmp.name), mock.patch.object(app, "_build_image_variants", self.variants)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.encoded = threading.Event()
+        self.addCleanup(self.encoded.set)
+
+    def variants(self, name, widths, encode=True):
+        # 書き出し済みのものはなく、変換は encoded がセットされるまで終わらない
+        if not encode: return None
+        self.encoded.wait(5)
+        return {"formats": [("webp", "image/webp")], "variants": [{"width": 400, "webp": f"static/{name}.webp"}]}
+
+    def test_card_uses_static_original_while_building(self):
+        builder = app.StaticAssetBuilder([("icon_fire.jpg", [400])], originals=["icon_fire.jpg"])
+        self.assertTrue(builder.building)
+        with mock.patch.object(app, "build_static_assets", lambda: builder):
+            html = app.get_card_img_html("icon_fire.jpg", "width:100%")
+            self.assertIn(f'src="{builder.original("icon_fire.jpg")}"', html)
+            self.assertNotIn("base64", html)
+            with open(os.path.join(app.STATIC_DIR, os.path.basename(builder.original("icon_fire.jpg"))), "rb") as f, \
+                    open(os.path.join(app.SCRIPT_DIR, "icon_fire.jpg"), "rb") as src:
+                self.assertEqual(f.read(), src.read())
+
+            self.encoded.set()
+            for _ in range(100):
+                if not builder.building: break
+                time.sleep(0.01)
+            self.assertIn("<picture>", app.get_card_img_html("icon_fire.jpg", "width:100%"))
+
+
+if __name__ == "__main__":
+    unittest.main()
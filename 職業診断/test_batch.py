@@ -0,0 +1,86 @@
+"""batch.py のテスト（python -m unittest test_batch）。Gemini は疑似応答（TEST_MODE）で動かす。"""
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+os.environ["FORTUNE_TEST_MODE"] = "1"
+os.environ["FORTUNE_TRACE_LOG"] = ""
+os.environ["FORTUNE_METRICS_TEXTFILE"] = ""
+
+import app
+import batch
+
+batch.app = app  # main() を通さずに使うので、ここで渡しておく
+
+
+def write_lines(path, records):
+    with open(path, "w", encoding="utf-8") as f:
+        for rec in records:
+            f.write((rec if isinstance(rec, str) else json.dumps(rec, ensure_ascii=False)) + "\n")
+
+
+def read_records(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class LoadDoneTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "results.jsonl")
+
+    def test_missing_file(self):
+        self.assertEqual(batch.load_done(self.path), set())
+
+    def test_last_record_per_id_decides(self):
+        write_lines(self.path, [
+            {"id": "retried", "error": "一時的"},
+            {"id": "retried", "type": "fire"},
+            {"id": "regressed", "type": "fire"},
+            {"id": "regressed", "error": "一時的"},
+            {"id": "invalid", "error": "回答が足りません", "permanent": True},
+            {"id": "transient", "error": "一時的"},
+            '{"id": "cut',  # 書きかけで止まった行
+        ])
+        self.assertEqual(batch.load_done(self.path), {"retried", "invalid"})
+
+
+class RunTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.input = os.path.join(tmp.name, "answers.csv")
+        self.output = os.path.join(tmp.name, "results.jsonl")
+        patcher = mock.patch.object(app, "FAKE_CLIENT_OPTIONS", {"delay": 0.0, "first_token_delay": 0.0, "token_delay": 0.0})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        header = "id," + ",".join(q["id"] for q in app.QUESTIONS)
+        full = ",".join("1" for _ in app.QUESTIONS)
+        with open(self.input, "w", encoding="utf-8") as f:
+            f.write("\n".join([header, f"a,{full}", f"b,{full[:-2]},", f"a,{full}"]) + "\n")
+
+    def test_results_and_resume(self):
+        counts = batch.run(self.input, self.output, None, workers=2)
+        self.assertEqual((counts["ok"], counts["error"], counts["duplicate"]), (1, 1, 1))
+        records = {rec["id"]: rec for rec in read_records(self.output)}
+        self.assertEqual(records["a"]["scores"], {"fire": 10, "water": 0, "wind": 0})
+        self.assertIsInstance(records["a"]["scores"]["fire"], int)
+        self.assertTrue(records["b"]["permanent"])
+
+        # 回答の足りない人もやり直さず、何も追記しない
+        counts = batch.run(self.input, self.output, None, workers=2)
+        self.assertEqual((counts["skipped"], counts["ok"], counts["error"]), (2, 0, 0))
+        self.assertEqual(len(read_records(self.output)), 2)
+
+    def test_transient_error_is_retried(self):
+        write_lines(self.output, [{"id": "a", "error": "モデルの応答が得られませんでした"}])
+        batch.run(self.input, self.output, None, workers=2)
+        last = {rec["id"]: rec for rec in read_records(self.output)}
+        self.assertNotIn("error", last["a"])
+
+
+if __name__ == "__main__":
+    unittest.main()